@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class AnnotationsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "annotations"
+
+    def ready(self):
+        from .instrumentation import install_query_recorder
+
+        # Before any connection opens, so the ORM's queries are counted in every thread
+        connection_created.connect(install_query_recorder)
@@ -0,0 +1,427 @@
+"""
+Bulk export and import of a user's notes as NDJSON archives.
+
+An archive holds one JSON object per line, one line per live context:
+
+    {"context": "https://example.com/", "type": "WEB", "title": "Example",
+     "notes": [{"type": "TEXT", "content": "<p>...</p>", "order": 0}, ...]}
+
+Notes also carry their "position" and "metadata" when set, image notes their
+"image" storage name, "image_hash" and "image_variants" (the files themselves
+are not part of the archive and must exist in the target's storage), and
+drawings their packed "strokes", base64-encoded. Imported notes are sanitized
+like every other write (see annotations.sanitize) and their strokes must
+decode; an image that is not in the storage fails the line, a missing variant
+is left out.
+
+`export_archive` reads contexts through a server-side cursor and their notes
+with one query per chunk of contexts, so memory stays bounded by the chunk
+size however many notes a user has; `aexport_archive` does the same for async
+code, one keyset page of contexts per sync_to_async call. `import_archive`
+consumes lines lazily and writes each batch of contexts in one transaction
+with a handful of bulk statements, streaming the notes with COPY on
+PostgreSQL. Archives may be gzipped; see `open_archive`. Both back the
+export_notes/import_notes management commands and the /api/notes/export and
+/api/notes/import endpoints.
+"""
+import base64
+import gzip
+import zlib
+from itertools import groupby
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import SuspiciousFileOperation
+from django.db import connections, router, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .cache import invalidate_notes
+from .drawing import InvalidDrawing, decode as decode_drawing
+from .events import emit
+from .identifiers import canonicalize
+from .models import Annotation, AnnotationContext, ChangeCounter, annotation_image_storage
+from .sanitize import normalize_html
+from .search import SEARCH_CONFIG, index_annotations
+from .serialization import dumps, loads
+
+# Contexts read per round trip on export, and contexts written per transaction on import
+EXPORT_CHUNK_SIZE = 500
+IMPORT_BATCH_SIZE = 500
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# PostgreSQL: temporary table the notes of an import batch are copied into
+STAGING_TABLE = "overnote_import_notes"
+
+CONTEXT_TYPES = {context_type for context_type, _ in AnnotationContext.CONTEXT_TYPES}
+ANNOTATION_TYPES = {annotation_type for annotation_type, _ in Annotation.ANNOTATION_TYPES}
+
+NOTE_ARCHIVE_FIELDS = (
+    "context_id",
+    "annotation_type",
+    "content",
+    "order",
+    "position",
+    "metadata",
+    "image",
+    "image_hash",
+    "image_variants",
+    "strokes",
+)
+
+
+class ArchiveError(ValueError):
+    """A line of an archive is not a valid context."""
+
+    def __init__(self, line_number, message):
+        super().__init__(f"Line {line_number}: {message}")
+        self.line_number = line_number
+
+
+def open_archive(fileobj):
+    """
+    Wraps the binary file `fileobj` so it reads decompressed lines, whether the
+    archive is gzipped or not. Needs a file that supports peek() (a buffered
+    reader) or seek(), which covers regular files and stdin.
+    """
+    if hasattr(fileobj, "peek"):
+        magic = fileobj.peek(2)[:2]
+    else:
+        magic = fileobj.read(2)
+        fileobj.seek(0)
+    return gzip.GzipFile(fileobj=fileobj, mode="rb") if magic == GZIP_MAGIC else fileobj
+
+
+def gzip_lines(lines, level=6):
+    """Gzips an iterable of byte strings chunk by chunk."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for line in lines:
+        data = compressor.compress(line)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def agzip_lines(lines, level=6):
+    """gzip_lines for an async iterable."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    async for line in lines:
+        data = compressor.compress(line)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _archive_note(annotation_type, content, order, position, metadata, image, image_hash, image_variants, strokes):
+    note = {"type": annotation_type, "content": content or "", "order": order}
+    if position is not None:
+        note["position"] = position
+    if metadata is not None:
+        note["metadata"] = metadata
+    if image:
+        note["image"] = image
+        note["image_hash"] = image_hash
+        note["image_variants"] = image_variants
+    if strokes is not None:
+        note["strokes"] = base64.b64encode(strokes).decode("ascii")
+    return note
+
+
+def _export_chunk(contexts):
+    notes = (
+        Annotation.objects.filter(context_id__in=[context_id for context_id, *_ in contexts])
+        .order_by("context_id", "order", "id")
+        .values_list(*NOTE_ARCHIVE_FIELDS)
+    )
+    by_context = {
+        context_id: [_archive_note(*row[1:]) for row in rows]
+        for context_id, rows in groupby(notes.iterator(), key=lambda row: row[0])
+    }
+    for context_id, identifier, context_type, title in contexts:
+        line = {"context": identifier, "type": context_type, "notes": by_context.get(context_id, [])}
+        if title:
+            line["title"] = title
+        yield dumps(line) + b"\n"
+
+
+def export_archive(user, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yields `user`'s live contexts with their notes as NDJSON lines (bytes), in creation order."""
+    contexts = (
+        AnnotationContext.objects.filter(user=user)
+        .order_by("id")
+        .values_list("id", "identifier", "context_type", "title")
+        .iterator(chunk_size=chunk_size)
+    )
+    chunk = []
+    for context in contexts:
+        chunk.append(context)
+        if len(chunk) == chunk_size:
+            yield from _export_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield from _export_chunk(chunk)
+
+
+def _export_page(user, after, chunk_size):
+    contexts = list(
+        AnnotationContext.objects.filter(user=user, id__gt=after)
+        .order_by("id")
+        .values_list("id", "identifier", "context_type", "title")[:chunk_size]
+    )
+    return contexts, list(_export_chunk(contexts))
+
+
+async def aexport_archive(user, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    export_archive for async code, e.g. streaming under ASGI: each chunk of
+    contexts is a keyset page read with its notes in one sync_to_async call.
+    """
+    after = 0
+    while True:
+        contexts, lines = await sync_to_async(_export_page)(user, after, chunk_size)
+        for line in lines:
+            yield line
+        if len(contexts) < chunk_size:
+            return
+        after = contexts[-1][0]
+
+
+def _is_stored(storage, name):
+    if not isinstance(name, str) or not name:
+        return False
+    try:
+        return storage.exists(name)
+    except SuspiciousFileOperation:
+        # e.g. a path escaping the storage's root
+        return False
+
+
+def _parse_images(line_number, annotation_type, note):
+    """The image, image hash and variants of an archived note, checked against the image storage."""
+    image = note.get("image") or None
+    image_hash = note.get("image_hash") or ""
+    variants = note.get("image_variants") or {}
+    if image is None:
+        if annotation_type == "IMG":
+            raise ArchiveError(line_number, "image notes need an image.")
+        return None, "", {}
+    if not isinstance(image_hash, str) or not isinstance(variants, dict):
+        raise ArchiveError(line_number, "image_hash must be a string and image_variants an object.")
+    storage = annotation_image_storage()
+    if not _is_stored(storage, image):
+        raise ArchiveError(line_number, f"image {image!r} is not in the image storage.")
+    variants = {
+        variant: name for variant, name in variants.items() if isinstance(variant, str) and _is_stored(storage, name)
+    }
+    return image, image_hash, variants
+
+
+def _parse_note(line_number, note):
+    if not isinstance(note, dict):
+        raise ArchiveError(line_number, "notes must be objects.")
+    annotation_type = note.get("type", "TEXT")
+    if annotation_type not in ANNOTATION_TYPES:
+        raise ArchiveError(line_number, f"unknown note type {annotation_type!r}.")
+    content = note.get("content") or ""
+    order = note.get("order", 0)
+    if not isinstance(content, str) or not isinstance(order, int):
+        raise ArchiveError(line_number, "note content must be a string and order an integer.")
+    strokes = note.get("strokes")
+    if strokes is not None:
+        try:
+            strokes = base64.b64decode(strokes, validate=True)
+        except (TypeError, ValueError):
+            raise ArchiveError(line_number, "strokes must be base64.")
+        try:
+            decode_drawing(strokes)
+        except InvalidDrawing as e:
+            raise ArchiveError(line_number, f"invalid strokes: {e}")
+    image, image_hash, image_variants = _parse_images(line_number, annotation_type, note)
+    # Sanitized like any other write; empty text notes are dropped
+    try:
+        html, text, content_hash = normalize_html(content)
+    except (AssertionError, ValueError) as e:
+        # HTMLParser's own errors, should it still give up on some markup
+        raise ArchiveError(line_number, f"note content could not be parsed: {e}")
+    if not html and annotation_type not in Annotation.MEDIA_TYPES:
+        return None
+    annotation = Annotation(
+        annotation_type=annotation_type,
+        content=html,
+        content_hash="" if annotation_type in Annotation.MEDIA_TYPES else content_hash,
+        order=order,
+        position=note.get("position"),
+        metadata=note.get("metadata"),
+        image=image,
+        image_hash=image_hash,
+        image_variants=image_variants,
+        strokes=strokes,
+    )
+    return annotation, text
+
+
+def parse_line(line_number, line):
+    """
+    Returns (CanonicalIdentifier, context type, title, [(unsaved Annotation,
+    plain text)]) for one archive line. Identifiers are canonicalized like
+    in the views, so lines for the same page end up in one context.
+    """
+    try:
+        data = loads(line)
+    except ValueError:
+        raise ArchiveError(line_number, "not valid JSON.")
+    if not isinstance(data, dict):
+        raise ArchiveError(line_number, "expected an object.")
+    identifier, notes = data.get("context"), data.get("notes", [])
+    if not identifier or not isinstance(identifier, str) or not identifier.strip():
+        raise ArchiveError(line_number, "context is required.")
+    if not isinstance(notes, list):
+        raise ArchiveError(line_number, "notes must be a list.")
+    canonical = canonicalize(identifier)
+    # Archives from before context types were set carry an empty one
+    context_type = data.get("type") or canonical.context_type
+    if context_type not in CONTEXT_TYPES:
+        raise ArchiveError(line_number, f"unknown context type {context_type!r}.")
+    title = data.get("title") or ""
+    if not isinstance(title, str):
+        raise ArchiveError(line_number, "title must be a string.")
+    notes = [_parse_note(line_number, note) for note in notes]
+    return canonical, context_type, title, [note for note in notes if note is not None]
+
+
+def _insert_notes(notes, texts):
+    """
+    Inserts unsaved `notes` with their search index entries, built from
+    `texts`, the notes' plain text. On PostgreSQL
+    the rows are streamed with COPY into a staging table and moved over with
+    one INSERT ... SELECT that also computes the search vectors, which is
+    several times faster than a bulk_create with a SearchVector expression
+    compiled per row.
+    """
+    connection = connections[router.db_for_write(Annotation)]
+    if connection.vendor != "postgresql":
+        notes = Annotation.objects.bulk_create(notes, batch_size=IMPORT_BATCH_SIZE)
+        index_annotations(notes, texts=texts)
+        return
+
+    fields = [
+        field
+        for field in Annotation._meta.concrete_fields
+        if not field.primary_key and field.name != "search_vector"
+    ]
+    table = connection.ops.quote_name(Annotation._meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TEMP TABLE {STAGING_TABLE} ON COMMIT DROP AS "
+            f"SELECT {columns}, ''::text AS search_text FROM {table} WITH NO DATA"
+        )
+        with cursor.cursor.copy(f"COPY {STAGING_TABLE} ({columns}, search_text) FROM STDIN") as copy:
+            for note, text in zip(notes, texts):
+                copy.write_row(
+                    [field.get_db_prep_save(field.pre_save(note, True), connection) for field in fields] + [text]
+                )
+        cursor.execute(
+            f"INSERT INTO {table} ({columns}, search_vector) "
+            f"SELECT {columns}, to_tsvector(%s::regconfig, search_text) FROM {STAGING_TABLE}",
+            [SEARCH_CONFIG],
+        )
+        cursor.execute(f"DROP TABLE {STAGING_TABLE}")
+
+
+def _import_batch(user, batch, skip_existing):
+    """Writes one batch of parsed lines; returns (contexts, notes) imported."""
+    # A later line for the same context wins
+    canonicals = {canonical.identifier: canonical for canonical, *_ in batch}
+    batch = {canonical.identifier: parsed for canonical, *parsed in batch}
+    now = timezone.now()
+
+    with transaction.atomic():
+        existing = {
+            context.identifier: context
+            for context in AnnotationContext.all_objects.filter(user=user, identifier__in=batch).only(
+                "id", "identifier", "deleted_at"
+            )
+        }
+        if skip_existing:
+            for identifier, context in existing.items():
+                if context.deleted_at is None:
+                    del batch[identifier]
+            existing = {identifier: context for identifier, context in existing.items() if identifier in batch}
+        if not batch:
+            return 0, 0
+
+        change_seq = ChangeCounter.next_seq(user.pk)
+        if existing:
+            # Restoring over a context replaces its notes, like save_all_notes
+            existing_ids = [context.id for context in existing.values()]
+            Annotation.all_objects.filter(context_id__in=existing_ids, deleted_at__isnull=True).update(
+                deleted_at=now, change_seq=change_seq
+            )
+            AnnotationContext.all_objects.filter(id__in=existing_ids).update(
+                deleted_at=None, change_seq=change_seq, version=F("version") + 1
+            )
+
+        new = [
+            AnnotationContext(
+                user=user,
+                identifier=identifier,
+                title=title,
+                change_seq=change_seq,
+                **{**canonicals[identifier].fields(), "context_type": context_type},
+            )
+            for identifier, (context_type, title, _) in batch.items()
+            if identifier not in existing
+        ]
+        created = AnnotationContext.objects.bulk_create(new)
+        if not all(context.pk for context in created):
+            # Backends that cannot return ids from bulk inserts
+            created = list(AnnotationContext.objects.filter(user=user, identifier__in=[c.identifier for c in new]))
+        context_ids = {context.identifier: context.id for context in created}
+        context_ids.update((identifier, context.id) for identifier, context in existing.items())
+
+        notes, texts = [], []
+        for identifier, (_, _, annotations) in batch.items():
+            for annotation, text in annotations:
+                annotation.context_id = context_ids[identifier]
+                annotation.user_id = user.pk
+                annotation.change_seq = change_seq
+                notes.append(annotation)
+                texts.append(text)
+        _insert_notes(notes, texts)
+
+    invalidate_notes(user.pk, *batch)
+    for identifier in existing:
+        # New contexts have no cached state a client could hold
+        emit(user.pk, identifier, "notes.updated")
+    return len(batch), len(notes)
+
+
+def import_archive(user, lines, batch_size=IMPORT_BATCH_SIZE, skip_existing=False):
+    """
+    Imports NDJSON `lines` (bytes or str) as `user`'s contexts and returns
+    (contexts, notes) imported.
+
+    A context that already exists has its notes replaced by the archive's,
+    unless `skip_existing` is set; deleted contexts are revived. Each batch of
+    `batch_size` contexts commits on its own, so an ArchiveError raised for a
+    bad line leaves the batches before it imported. Since importing is
+    idempotent, the whole archive can simply be imported again once fixed.
+    """
+    totals = [0, 0]
+    batch = []
+
+    def flush():
+        for total, count in enumerate(_import_batch(user, batch, skip_existing)):
+            totals[total] += count
+        batch.clear()
+
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        batch.append(parse_line(line_number, line))
+        if len(batch) == batch_size:
+            flush()
+    if batch:
+        flush()
+    return tuple(totals)
@@ -0,0 +1,122 @@
+"""
+Authentication for the annotations API.
+
+API clients send `Authorization: Bearer <token>` with a token issued by the
+obtain_token view or `manage.py create_api_token`; browser sessions keep
+working too. TokenAuthenticationMiddleware resolves a token's user once per
+request (from the cache for OVERNOTE_TOKEN_CACHE_TIMEOUT seconds, so most
+requests cost no query). Views wrapped in `api_login_required` answer 401 JSON
+instead of redirecting to a login page, and async views find a concrete
+`request.user` they can filter on without touching the database.
+"""
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.http import JsonResponse
+
+from .models import ApiToken, hash_token
+
+TOKEN_CACHE_TIMEOUT = getattr(settings, "OVERNOTE_TOKEN_CACHE_TIMEOUT", 60)
+
+
+def _cache_key(key_hash):
+    return "apitoken:" + key_hash
+
+
+def _bearer_token(request):
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    return token.strip() if scheme.lower() == "bearer" and token.strip() else None
+
+
+def user_for_token(raw):
+    """The active user owning token `raw`, or None."""
+    key_hash = hash_token(raw)
+    user = cache.get(_cache_key(key_hash))
+    if user is None:
+        token = ApiToken.objects.select_related("user").filter(key_hash=key_hash).first()
+        if token is None or not token.user.is_active:
+            return None
+        user = token.user
+        cache.set(_cache_key(key_hash), user, TOKEN_CACHE_TIMEOUT)
+    return user
+
+
+async def auser_for_token(raw):
+    key_hash = hash_token(raw)
+    user = await cache.aget(_cache_key(key_hash))
+    if user is None:
+        token = await ApiToken.objects.select_related("user").filter(key_hash=key_hash).afirst()
+        if token is None or not token.user.is_active:
+            return None
+        user = token.user
+        await cache.aset(_cache_key(key_hash), user, TOKEN_CACHE_TIMEOUT)
+    return user
+
+
+def revoke_token(token):
+    """Deletes `token` and drops its cached user, so it stops working immediately."""
+    cache.delete(_cache_key(token.key_hash))
+    token.delete()
+
+
+class TokenAuthenticationMiddleware:
+    """Goes after django.contrib.auth's AuthenticationMiddleware."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        raw = _bearer_token(request)
+        if raw is not None:
+            # A bad token never falls back to the session
+            self._set_user(request, user_for_token(raw))
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        raw = _bearer_token(request)
+        if raw is not None:
+            self._set_user(request, await auser_for_token(raw))
+        return await self.get_response(request)
+
+    @staticmethod
+    def _set_user(request, user):
+        user = user or AnonymousUser()
+
+        async def auser():
+            return user
+
+        request.user = user
+        request.auser = auser
+
+
+def _unauthorized():
+    return JsonResponse({"error": "Authentication required."}, status=401)
+
+
+def api_login_required(view):
+    """Rejects anonymous requests with 401. Works for sync and async views."""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            # A session user is loaded lazily, which async code cannot do
+            request.user = await request.auser()
+            if not request.user.is_authenticated:
+                return _unauthorized()
+            return await view(request, *args, **kwargs)
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not request.user.is_authenticated:
+                return _unauthorized()
+            return view(request, *args, **kwargs)
+    return wrapper
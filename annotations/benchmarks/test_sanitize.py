@@ -0,0 +1,66 @@
+"""
+Parse cost of note normalization (annotations.sanitize) per KB of HTML, next
+to a bare text extraction with the same parser, and a check that a save
+parses every note exactly once.
+
+    python manage.py test annotations.benchmarks.test_sanitize \
+        --settings=overnote_backend.settings_test
+
+Uses OVERNOTE_BENCH_ITERATIONS like test_views.
+"""
+import json
+import random
+from html.parser import HTMLParser
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import Client, TestCase
+
+from annotations.benchmarks.test_serialization import timed
+from annotations.benchmarks.test_views import ITERATIONS
+from annotations.datagen import random_note_html
+from annotations.models import Annotation, ApiToken
+from annotations.sanitize import normalize_html
+from annotations.search import html_to_text
+
+NOTE_SIZES = (256, 1024, 4096, 16384)
+NOTES_PER_SIZE = 50
+# Normalizing may cost at most this many bare parses of the same HTML
+MAX_PARSE_RATIO = 4
+
+
+class SanitizeBenchmarks(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("bench")
+        _, cls.token = ApiToken.issue(cls.user, "bench")
+
+    def test_parse_cost_per_kb(self):
+        rng = random.Random(1)
+        iterations = max(3, ITERATIONS // 3)
+        print(f"\n{'note bytes':>10} {'normalize us/KB':>16} {'extract us/KB':>14} {'ratio':>6}")
+        for size in NOTE_SIZES:
+            notes = [random_note_html(rng, size) for _ in range(NOTES_PER_SIZE)]
+            kilobytes = sum(len(note.encode("utf-8")) for note in notes) / 1024
+            _, normalize_ms = timed(lambda: [normalize_html(note) for note in notes], iterations)
+            _, extract_ms = timed(lambda: [html_to_text(note) for note in notes], iterations)
+            ratio = normalize_ms / extract_ms
+            print(
+                f"{size:>10} {normalize_ms * 1000 / kilobytes:>16.1f} "
+                f"{extract_ms * 1000 / kilobytes:>14.1f} {ratio:>6.2f}"
+            )
+            self.assertLess(ratio, MAX_PARSE_RATIO)
+
+    def test_update_parses_each_note_once(self):
+        rng = random.Random(2)
+        notes = [random_note_html(rng, 1024) for _ in range(10)]
+        client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        with mock.patch.object(HTMLParser, "feed", autospec=True, side_effect=HTMLParser.feed) as feed:
+            response = client.put(
+                "/api/notes/update",
+                json.dumps({"context": "https://bench.example/sanitize", "notes": notes}),
+                content_type="application/json",
+            )
+        self.assertEqual(response.status_code, 200, response.content[:200])
+        self.assertEqual(feed.call_count, len(notes))
+        self.assertEqual(Annotation.objects.filter(user=self.user).count(), len(notes))
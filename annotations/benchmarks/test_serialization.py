@@ -0,0 +1,82 @@
+"""
+Bytes on the wire and encode time of the get_all_notes payload for each
+encoder (stdlib json, orjson, MessagePack) and content coding (identity, gzip,
+Brotli). Encoders or codecs whose package is not installed are skipped.
+
+    python manage.py test annotations.benchmarks.test_serialization \
+        --settings=overnote_backend.settings_test
+
+Uses the same OVERNOTE_BENCH_* scale variables as test_views.
+"""
+import gzip
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.test import Client, TestCase
+
+from annotations import compression, serialization
+from annotations.benchmarks.test_views import CONTEXTS, HTML_SIZE, ITERATIONS, NOTES_PER_CONTEXT, percentile
+from annotations.datagen import generate_dataset
+from annotations.models import ApiToken
+from annotations.views import iter_all_notes
+
+
+def timed(function, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        result = function()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return result, percentile(timings, 50)
+
+
+class SerializationBenchmarks(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("bench")
+        _, cls.token = ApiToken.issue(cls.user, "bench")
+        generate_dataset(CONTEXTS, NOTES_PER_CONTEXT, html_size=HTML_SIZE, user=cls.user)
+
+    def setUp(self):
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+
+    def test_encoders_and_codings(self):
+        payload = [item for _, item in iter_all_notes(self.user)]
+        iterations = max(3, ITERATIONS // 3)
+
+        encoders = {"json": lambda: json.dumps(payload, cls=DjangoJSONEncoder).encode("utf-8")}
+        if serialization.orjson is not None:
+            encoders["orjson"] = lambda: serialization.dumps(payload)
+        if serialization.msgpack is not None:
+            encoders["msgpack"] = lambda: serialization.packb(payload)
+
+        codings = {"identity": None, "gzip": "gzip"}
+        if compression.brotli is not None:
+            codings["br"] = "br"
+
+        print(f"\n{'encoder':<10} {'coding':<10} {'bytes':>10} {'encode ms':>10} {'compress ms':>12}")
+        for encoder_name, encoder in encoders.items():
+            body, encode_ms = timed(encoder, iterations)
+            for coding_name, coding in codings.items():
+                if coding is None:
+                    wire, compress_ms = body, 0.0
+                else:
+                    wire, compress_ms = timed(
+                        lambda: compression._Compressor(coding).compress_all(body), iterations
+                    )
+                print(f"{encoder_name:<10} {coding_name:<10} {len(wire):>10} {encode_ms:>10.2f} {compress_ms:>12.2f}")
+                if coding is not None:
+                    self.assertLess(len(wire), len(body))
+
+    def test_get_all_notes_negotiation(self):
+        response = self.client.get("/api/all-notes", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))), CONTEXTS)
+
+        streamed = self.client.get("/api/all-notes?stream=1", HTTP_ACCEPT_ENCODING="gzip")
+        body = gzip.decompress(b"".join(streamed.streaming_content))
+        self.assertEqual(len(json.loads(body)), CONTEXTS)
@@ -0,0 +1,231 @@
+"""
+Benchmarks for the annotations API.
+
+Drives the views through the Django test client against a generated dataset,
+prints latency percentiles and query counts, and fails when a view issues more
+queries than recorded in baselines.json. Runs on SQLite, as part of
+`manage.py test annotations` or on its own:
+
+    python manage.py test annotations.benchmarks.test_views \
+        --settings=overnote_backend.settings_test
+
+Query counts include the SAVEPOINT and RELEASE that a write's transaction
+becomes inside TestCase, so a write costs two queries more here than in
+production.
+
+Scale with OVERNOTE_BENCH_CONTEXTS, OVERNOTE_BENCH_NOTES, OVERNOTE_BENCH_HTML_SIZE
+and OVERNOTE_BENCH_ITERATIONS. Set OVERNOTE_BENCH_UPDATE_BASELINES=1 to rewrite
+baselines.json with the query counts of the current run; the recorded baselines
+assume the default scale.
+"""
+import json
+import os
+import random
+import time
+from pathlib import Path
+from unittest import mock
+from urllib.parse import quote
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from annotations.archive import export_archive
+from annotations.auth import user_for_token
+from annotations.cache import invalidate_notes
+from annotations.datagen import generate_dataset, random_note_html
+from annotations.models import Annotation, ApiToken
+from annotations.writebehind import WriteBehindBuffer
+
+BASELINES_PATH = Path(__file__).with_name("baselines.json")
+
+CONTEXTS = int(os.environ.get("OVERNOTE_BENCH_CONTEXTS", 200))
+NOTES_PER_CONTEXT = int(os.environ.get("OVERNOTE_BENCH_NOTES", 10))
+HTML_SIZE = int(os.environ.get("OVERNOTE_BENCH_HTML_SIZE", 500))
+ITERATIONS = int(os.environ.get("OVERNOTE_BENCH_ITERATIONS", 30))
+UPDATE_BASELINES = os.environ.get("OVERNOTE_BENCH_UPDATE_BASELINES") == "1"
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class ViewBenchmarks(TestCase):
+    results = {}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("bench")
+        _, cls.token = ApiToken.issue(cls.user, "bench")
+        cls.identifiers = generate_dataset(CONTEXTS, NOTES_PER_CONTEXT, html_size=HTML_SIZE, user=cls.user)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        print(f"\n{'benchmark':<28} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8}")
+        for name, result in sorted(cls.results.items()):
+            print(
+                f"{name:<28} {result['p50']:>9.2f} {result['p95']:>9.2f} "
+                f"{result['p99']:>9.2f} {result['queries']:>8}"
+            )
+        if UPDATE_BASELINES:
+            baselines = {name: result["queries"] for name, result in sorted(cls.results.items())}
+            BASELINES_PATH.write_text(json.dumps(baselines, indent=2) + "\n")
+
+    def setUp(self):
+        self.rng = random.Random(1)
+        cache.clear()
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        # Token lookups are cached; keep the one-off miss out of the counts
+        user_for_token(self.token)
+
+    def measure(self, name, request, iterations=ITERATIONS, prepare=None):
+        """
+        Runs `request` `iterations` times, recording latency and the largest
+        query count seen, and checks the latter against the recorded baseline.
+        When given, `prepare()` runs untimed before each request and its result
+        is passed to `request`.
+        """
+        timings = []
+        max_queries = 0
+        for _ in range(iterations):
+            args = (prepare(),) if prepare is not None else ()
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = request(*args)
+                timings.append((time.perf_counter() - started) * 1000)
+            self.assertLess(response.status_code, 400, b"" if response.streaming else response.content[:200])
+            max_queries = max(max_queries, len(queries))
+
+        timings.sort()
+        self.results[name] = {
+            "p50": percentile(timings, 50),
+            "p95": percentile(timings, 95),
+            "p99": percentile(timings, 99),
+            "queries": max_queries,
+        }
+        if not UPDATE_BASELINES:
+            baselines = json.loads(BASELINES_PATH.read_text())
+            self.assertIn(name, baselines, f"No baseline recorded for {name}")
+            self.assertLessEqual(
+                max_queries,
+                baselines[name],
+                f"{name} issued {max_queries} queries, baseline is {baselines[name]}",
+            )
+
+    def notes_url(self, identifier):
+        return f"/api/notes?context={quote(identifier, safe='')}"
+
+    def update(self, identifier, notes):
+        return self.client.put(
+            "/api/notes/update",
+            json.dumps({"context": identifier, "notes": notes}),
+            content_type="application/json",
+        )
+
+    def test_get_notes_cold(self):
+        def uncached_identifier():
+            identifier = self.rng.choice(self.identifiers)
+            invalidate_notes(self.user.pk, identifier)
+            return identifier
+
+        self.measure(
+            "get_notes_cold",
+            lambda identifier: self.client.get(self.notes_url(identifier)),
+            prepare=uncached_identifier,
+        )
+
+    def test_get_notes_cached(self):
+        identifier = self.identifiers[0]
+        self.client.get(self.notes_url(identifier))
+        self.measure("get_notes_cached", lambda: self.client.get(self.notes_url(identifier)))
+
+    def test_get_notes_batch(self):
+        self.measure(
+            "get_notes_batch",
+            lambda: self.client.get(
+                "/api/notes/batch?"
+                + "&".join(f"context={quote(i, safe='')}" for i in self.rng.sample(self.identifiers, 20))
+            ),
+        )
+
+    def test_update_all_notes_edit_one(self):
+        def edit_one():
+            identifier = self.rng.choice(self.identifiers)
+            notes = [note["content"] for note in self.client.get(self.notes_url(identifier)).json()]
+            notes[self.rng.randrange(len(notes))] = random_note_html(self.rng, HTML_SIZE)
+            return identifier, notes
+
+        self.measure("update_all_notes_edit_one", lambda args: self.update(*args), prepare=edit_one)
+
+    def test_update_all_notes_new_context(self):
+        counter = iter(range(10**6))
+        notes = [random_note_html(self.rng, HTML_SIZE) for _ in range(NOTES_PER_CONTEXT)]
+        self.measure(
+            "update_all_notes_new_context",
+            lambda: self.update(f"https://bench.example/new/{next(counter)}", notes),
+        )
+
+    def test_update_all_notes_buffered(self):
+        # A window longer than the run, so every autosave of a context but the last is coalesced
+        buffer = WriteBehindBuffer(window=3600)
+        identifiers = self.identifiers[:5]
+        with mock.patch("annotations.views.get_write_behind", return_value=buffer):
+            self.measure(
+                "update_all_notes_buffered",
+                lambda identifier: self.update(identifier, [random_note_html(self.rng, HTML_SIZE)]),
+                prepare=lambda: self.rng.choice(identifiers),
+            )
+            buffer.close()
+        for identifier in identifiers:
+            self.assertEqual(Annotation.objects.filter(user=self.user, context__identifier=identifier).count(), 1)
+
+    def test_get_all_notes(self):
+        self.measure("get_all_notes", lambda: self.client.get("/api/all-notes"), iterations=max(3, ITERATIONS // 10))
+
+    def test_get_all_notes_page(self):
+        self.measure("get_all_notes_page", lambda: self.client.get("/api/all-notes?limit=100"))
+
+    def test_get_site_notes(self):
+        # Every generated context is on the same site
+        self.measure(
+            "get_site_notes",
+            lambda: self.client.get(f"/api/notes/site?context={quote(self.identifiers[0], safe='')}&limit=100"),
+        )
+
+    def test_export_notes(self):
+        def export():
+            response = self.client.get("/api/notes/export")
+            # The archive is streamed; its queries run as it is consumed
+            b"".join(response.streaming_content)
+            return response
+
+        self.measure("export_notes", export, iterations=max(3, ITERATIONS // 10))
+
+    def test_import_notes(self):
+        archive = b"".join(export_archive(self.user))
+        # Replaces every context's notes with the same ones
+        self.measure(
+            "import_notes",
+            lambda: self.client.post("/api/notes/import", archive, content_type="application/x-ndjson"),
+            iterations=max(3, ITERATIONS // 10),
+        )
+        self.assertEqual(
+            Annotation.objects.filter(user=self.user).count(), len(self.identifiers) * NOTES_PER_CONTEXT
+        )
+
+    def test_delete_context(self):
+        identifiers = iter(self.rng.sample(self.identifiers, min(ITERATIONS, len(self.identifiers))))
+        self.measure(
+            "delete_context",
+            lambda identifier: self.client.delete(
+                "/api/notes/delete-context/",
+                json.dumps({"context": identifier}),
+                content_type="application/json",
+            ),
+            iterations=min(ITERATIONS, len(self.identifiers)),
+            prepare=lambda: next(identifiers),
+        )
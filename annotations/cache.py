@@ -0,0 +1,109 @@
+"""
+Read-through cache for get_notes.
+
+Stores the serialized body of a user's context's notes together with its ETag, so
+repeat reads (and conditional If-None-Match reads) are answered without touching
+the database. Every view that writes notes must call `invalidate_notes` for the
+contexts it changed, after its transaction commits. Bodies are cached per
+response format (see annotations.serialization). ETags start with the context's
+version, so clients can send them back in If-Match when they update the context.
+
+Bodies are keyed by a generation of the context: a random token, also cached,
+that a reader fetches (or creates) before reading the database and that
+`invalidate_notes` deletes. A reader that read the notes from before a write
+therefore stores them under a generation nobody looks up any more, instead of
+over the invalidation.
+"""
+import hashlib
+import secrets
+
+from django.conf import settings
+from django.core.cache import caches
+
+NOTES_CACHE_ALIAS = getattr(settings, "OVERNOTE_NOTES_CACHE", "default")
+NOTES_CACHE_TIMEOUT = getattr(settings, "OVERNOTE_NOTES_CACHE_TIMEOUT", 300)
+
+
+def _notes_cache():
+    return caches[NOTES_CACHE_ALIAS]
+
+
+def _context_key(user_id, identifier):
+    # Identifiers are arbitrary URLs; hash them to stay within backend key limits.
+    return f"{user_id}:" + hashlib.sha1(identifier.encode("utf-8")).hexdigest()
+
+
+def generation_key(user_id, identifier):
+    return "notes-gen:" + _context_key(user_id, identifier)
+
+
+def notes_cache_key(user_id, identifier, generation, fmt="json"):
+    key = f"notes:{_context_key(user_id, identifier)}:{generation}"
+    return key if fmt == "json" else f"{key}:{fmt}"
+
+
+def _generation_keys(user_id, identifiers):
+    return [generation_key(user_id, identifier) for identifier in identifiers if identifier]
+
+
+def make_etag(body, version=0):
+    return '"%s-%s"' % (version, hashlib.sha1(body).hexdigest())
+
+
+def etag_version(etag):
+    """The context version in an ETag from `make_etag` (or a bare '"<version>"'), or None."""
+    version = etag.removeprefix("W/").strip('"').partition("-")[0]
+    return int(version) if version.isdigit() else None
+
+
+def get_cached_notes(user_id, identifier, fmt="json"):
+    """
+    Returns (cached, generation): the cached (body, etag), or None on a miss,
+    and the generation to pass to `set_cached_notes` after a miss.
+    """
+    cache, key = _notes_cache(), generation_key(user_id, identifier)
+    generation = cache.get(key)
+    if generation is None:
+        generation = secrets.token_hex(8)
+        if not cache.add(key, generation, NOTES_CACHE_TIMEOUT):
+            # Created by a concurrent reader meanwhile
+            generation = cache.get(key, generation)
+        return None, generation
+    return cache.get(notes_cache_key(user_id, identifier, generation, fmt)), generation
+
+
+def set_cached_notes(user_id, identifier, generation, body, fmt="json", version=0):
+    etag = make_etag(body, version)
+    _notes_cache().set(notes_cache_key(user_id, identifier, generation, fmt), (body, etag), NOTES_CACHE_TIMEOUT)
+    return etag
+
+
+def invalidate_notes(user_id, *identifiers):
+    keys = _generation_keys(user_id, identifiers)
+    if keys:
+        _notes_cache().delete_many(keys)
+
+
+async def aget_cached_notes(user_id, identifier, fmt="json"):
+    cache, key = _notes_cache(), generation_key(user_id, identifier)
+    generation = await cache.aget(key)
+    if generation is None:
+        generation = secrets.token_hex(8)
+        if not await cache.aadd(key, generation, NOTES_CACHE_TIMEOUT):
+            generation = await cache.aget(key, generation)
+        return None, generation
+    return await cache.aget(notes_cache_key(user_id, identifier, generation, fmt)), generation
+
+
+async def aset_cached_notes(user_id, identifier, generation, body, fmt="json", version=0):
+    etag = make_etag(body, version)
+    await _notes_cache().aset(
+        notes_cache_key(user_id, identifier, generation, fmt), (body, etag), NOTES_CACHE_TIMEOUT
+    )
+    return etag
+
+
+async def ainvalidate_notes(user_id, *identifiers):
+    keys = _generation_keys(user_id, identifiers)
+    if keys:
+        await _notes_cache().adelete_many(keys)
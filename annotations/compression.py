@@ -0,0 +1,153 @@
+"""
+Negotiated response compression.
+
+CompressionMiddleware compresses responses of at least
+OVERNOTE_COMPRESS_MIN_BYTES with Brotli (when the `brotli` package is installed
+and the client accepts `br`) or gzip. Streaming responses are compressed chunk
+by chunk, flushing after each one so a consumer still sees every chunk as it is
+produced. Event streams, images, gzipped archives and responses that already
+carry a Content-Encoding are left alone.
+
+Install it after InstrumentationMiddleware so the recorded response sizes are
+the bytes actually sent.
+"""
+import re
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = getattr(settings, "OVERNOTE_COMPRESS_MIN_BYTES", 1024)
+GZIP_LEVEL = getattr(settings, "OVERNOTE_GZIP_LEVEL", 6)
+BROTLI_QUALITY = getattr(settings, "OVERNOTE_BROTLI_QUALITY", 5)
+
+SKIP_CONTENT_TYPES = ("text/event-stream", "image/", "application/gzip")
+
+_coding_re = re.compile(r"^\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([\d.]+))?\s*$")
+
+
+def accepted_encodings(header):
+    """Content codings named in an Accept-Encoding header with a non-zero q."""
+    accepted = set()
+    for part in header.split(","):
+        match = _coding_re.match(part)
+        if not match:
+            continue
+        coding, quality = match.group(1).lower(), match.group(2)
+        try:
+            if quality is not None and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding)
+    return accepted
+
+
+def choose_encoding(header):
+    accepted = accepted_encodings(header)
+    if brotli is not None and ("br" in accepted or "*" in accepted):
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+class _Compressor:
+    def __init__(self, encoding):
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self.compress, self._flush, self._finish = (
+                self._compressor.process,
+                self._compressor.flush,
+                self._compressor.finish,
+            )
+        else:
+            # wbits=31 writes a gzip header and trailer
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self.compress = self._compressor.compress
+            self._flush = lambda: self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = self._compressor.flush
+
+    def compress_chunk(self, chunk):
+        return self.compress(chunk) + self._flush()
+
+    def finish(self):
+        return self._finish()
+
+    def compress_all(self, data):
+        return self.compress(data) + self._finish()
+
+
+def _compress_sequence(chunks, encoding):
+    compressor = _Compressor(encoding)
+    for chunk in chunks:
+        data = compressor.compress_chunk(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+async def _acompress_sequence(chunks, encoding):
+    compressor = _Compressor(encoding)
+    async for chunk in chunks:
+        data = compressor.compress_chunk(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class CompressionMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.compress(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.compress(request, await self.get_response(request))
+
+    def compress(self, request, response):
+        if response.has_header("Content-Encoding") or response.status_code in (204, 304):
+            return response
+        if response.get("Content-Type", "").startswith(SKIP_CONTENT_TYPES):
+            return response
+        if not response.streaming and len(response.content) < COMPRESS_MIN_BYTES:
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        encoding = choose_encoding(request.headers.get("Accept-Encoding", ""))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = _acompress_sequence(response.streaming_content, encoding)
+            else:
+                response.streaming_content = _compress_sequence(response.streaming_content, encoding)
+            del response.headers["Content-Length"]
+        else:
+            compressed = _Compressor(encoding).compress_all(response.content)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers["Content-Length"] = str(len(compressed))
+
+        # The body changed, so a strong validator no longer holds (RFC 9110 8.8.1)
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = encoding
+        return response
@@ -0,0 +1,91 @@
+"""
+Synthetic AnnotationContext/Annotation data for benchmarks and load tests.
+
+Notes are built from the markup the editor actually produces (paragraphs,
+inline formatting, lists, links) and padded to roughly the requested size.
+"""
+import random
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from .identifiers import canonicalize
+from .models import Annotation, AnnotationContext
+from .sanitize import normalize_html
+from .search import index_annotations
+
+WORDS = (
+    "note idea todo review remember follow up meeting draft article reference "
+    "quote summary question answer research link source detail highlight"
+).split()
+
+
+def random_sentence(rng, words=8):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def random_note_html(rng, size):
+    """Returns editor-style HTML of roughly `size` characters."""
+    blocks = []
+    length = 0
+    while length < size:
+        kind = rng.random()
+        if kind < 0.6:
+            block = f"<p>{random_sentence(rng, rng.randint(4, 16))}</p>"
+        elif kind < 0.75:
+            block = f"<p><strong>{random_sentence(rng, 3)}</strong> <em>{random_sentence(rng, 5)}</em></p>"
+        elif kind < 0.9:
+            items = "".join(f"<li>{random_sentence(rng, 4)}</li>" for _ in range(rng.randint(2, 5)))
+            block = f"<ul>{items}</ul>"
+        else:
+            block = f'<p><a href="https://example.com/{rng.randint(1, 10**6)}">{random_sentence(rng, 3)}</a></p>'
+        blocks.append(block)
+        length += len(block)
+    return "".join(blocks)
+
+
+def generate_dataset(
+    contexts, notes_per_context, html_size=500, seed=0, prefix="https://bench.example", batch_size=1000, user=None
+):
+    """
+    Bulk-inserts `contexts` contexts with `notes_per_context` notes each, owned
+    by `user` (a "datagen" user by default), and returns the list of created
+    identifiers.
+    """
+    if user is None:
+        user, _ = get_user_model().objects.get_or_create(username="datagen")
+    rng = random.Random(seed)
+    identifiers = []
+    for start in range(0, contexts, batch_size):
+        with transaction.atomic():
+            created = AnnotationContext.objects.bulk_create(
+                AnnotationContext(identifier=canonical.identifier, user=user, **canonical.fields())
+                for canonical in (
+                    canonicalize(f"{prefix}/{seed}/{i}") for i in range(start, min(start + batch_size, contexts))
+                )
+            )
+            if not all(context.pk for context in created):
+                # Backends that cannot return ids from bulk inserts.
+                created = list(
+                    AnnotationContext.objects.filter(user=user, identifier__in=[c.identifier for c in created])
+                )
+            notes, texts = [], []
+            for context in created:
+                for order in range(notes_per_context):
+                    # Stored the way the API stores notes
+                    html, text, content_hash = normalize_html(random_note_html(rng, html_size))
+                    notes.append(
+                        Annotation(
+                            annotation_type="TEXT",
+                            content=html,
+                            content_hash=content_hash,
+                            context=context,
+                            user=user,
+                            order=order,
+                        )
+                    )
+                    texts.append(text)
+            notes = Annotation.objects.bulk_create(notes, batch_size=batch_size)
+            index_annotations(notes, texts=texts)
+        identifiers.extend(context.identifier for context in created)
+    return identifiers
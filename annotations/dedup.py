@@ -0,0 +1,73 @@
+"""
+Merging of duplicate AnnotationContext rows.
+
+Before identifiers were unique, concurrent autosaves could race in
+get_or_create and leave several contexts for the same identifier. The helpers
+here take the model classes as arguments so they can run both from the
+management command and from a migration with historical models, and the
+fields that make two contexts the same (the identifier alone before contexts
+had owners, the owner and identifier since). Canonicalizing identifiers
+(annotations.identifiers) merges the contexts whose identifiers became equal
+with merge_contexts.
+"""
+from django.db import transaction
+from django.db.models import Count, F, Max, Min
+
+
+def find_duplicate_identifiers(context_model, key_fields=("identifier",)):
+    return (
+        context_model.objects.values(*key_fields)
+        .annotate(total=Count("id"), keep_id=Min("id"))
+        .filter(total__gt=1)
+        .order_by(*key_fields)
+    )
+
+
+def merge_contexts(context_model, annotation_model, keep_id, extra_ids):
+    """
+    Folds the contexts `extra_ids` into `keep_id` and deletes them.
+
+    Notes of the extra contexts are moved to the kept context and placed after
+    its own notes, preserving their relative order. Once notes carry a content
+    hash, a note identical to a live one the kept context already holds is
+    deleted with its context instead. Call inside a transaction.
+    """
+    dedupe_notes = any(field.name == "content_hash" for field in annotation_model._meta.get_fields())
+    for extra_id in extra_ids:
+        offset = annotation_model.objects.filter(context_id=keep_id).aggregate(top=Max("order"))["top"]
+        moved = annotation_model.objects.filter(context_id=extra_id)
+        if dedupe_notes:
+            moved = moved.exclude(
+                content_hash__in=annotation_model.objects.filter(context_id=keep_id, deleted_at__isnull=True)
+                .exclude(content_hash="")
+                .values("content_hash")
+            )
+        moved.update(
+            context_id=keep_id,
+            order=F("order") + (offset + 1 if offset is not None else 0),
+        )
+    context_model.objects.filter(id__in=extra_ids).delete()
+
+
+def merge_duplicate_contexts(context_model, annotation_model, dry_run=False, key_fields=("identifier",)):
+    """
+    Folds every duplicate context into the oldest one with the same
+    `key_fields`, see merge_contexts. Returns the number of contexts that were
+    (or, with `dry_run`, would be) removed.
+    """
+    removed = 0
+    for duplicate in find_duplicate_identifiers(context_model, key_fields):
+        keep_id = duplicate["keep_id"]
+        extra_ids = list(
+            context_model.objects.filter(**{field: duplicate[field] for field in key_fields})
+            .exclude(id=keep_id)
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        removed += len(extra_ids)
+        if dry_run:
+            continue
+
+        with transaction.atomic():
+            merge_contexts(context_model, annotation_model, keep_id, extra_ids)
+    return removed
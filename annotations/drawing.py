@@ -0,0 +1,190 @@
+"""
+Compact storage for drawing (DRAW) annotations.
+
+Clients send strokes as lists of points, each point being [x, y] or
+[x, y, pressure]. Coordinates are quantized to 1/scale px and stored in
+`Annotation.strokes` as one binary blob:
+
+    version      1 byte
+    dimensions   1 byte, 2 or 3 values per point
+    scale        varint
+    stroke count varint
+    per stroke   varint point count, then every value of every point as the
+                 zigzag varint of its difference to the previous point
+
+The deltas run across strokes, so a stroke starting near where the last one
+ended costs a couple of bytes. Pen input moves in small steps, which makes most
+deltas fit in one byte where the JSON form spends 5-10 characters per value.
+Strokes are simplified with Ramer-Douglas-Peucker before packing.
+"""
+import math
+
+from django.conf import settings
+
+FORMAT_VERSION = 1
+DRAWING_MAX_POINTS = getattr(settings, "OVERNOTE_DRAWING_MAX_POINTS", 100_000)
+# Quantization of coordinates and the default simplification tolerance, in px
+DRAWING_DEFAULT_SCALE = getattr(settings, "OVERNOTE_DRAWING_SCALE", 10)
+DRAWING_DEFAULT_TOLERANCE = getattr(settings, "OVERNOTE_DRAWING_TOLERANCE", 0.5)
+# Largest absolute coordinate, in px; keeps quantized values well inside the 63 bits decode() reads
+DRAWING_MAX_COORDINATE = 1_000_000
+
+
+class InvalidDrawing(Exception):
+    pass
+
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        try:
+            byte = data[pos]
+        except IndexError:
+            raise InvalidDrawing("Truncated drawing data") from None
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise InvalidDrawing("Malformed varint")
+
+
+def _zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def _segment_distance_sq(point, start, end):
+    px, py = point[0], point[1]
+    ax, ay = start[0], start[1]
+    dx, dy = end[0] - ax, end[1] - ay
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return (px - ax) ** 2 + (py - ay) ** 2
+    t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length_sq))
+    return (px - ax - t * dx) ** 2 + (py - ay - t * dy) ** 2
+
+
+def simplify(points, tolerance):
+    """
+    Ramer-Douglas-Peucker: drops points closer than `tolerance` to the line
+    through the points kept around them. Only x and y are considered; any
+    further values (pressure) follow their point.
+    """
+    if tolerance <= 0 or len(points) < 3:
+        return list(points)
+
+    tolerance_sq = tolerance * tolerance
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    # Explicit stack, long strokes would exceed the recursion limit
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, farthest_sq = None, tolerance_sq
+        for i in range(first + 1, last):
+            distance_sq = _segment_distance_sq(points[i], points[first], points[last])
+            if distance_sq > farthest_sq:
+                farthest, farthest_sq = i, distance_sq
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def validate_strokes(strokes):
+    """Checks the JSON form and returns the number of values per point."""
+    if not isinstance(strokes, list):
+        raise InvalidDrawing("strokes must be a list of strokes")
+    dimensions = None
+    total = 0
+    for stroke in strokes:
+        if not isinstance(stroke, list):
+            raise InvalidDrawing("Each stroke must be a list of points")
+        total += len(stroke)
+        for point in stroke:
+            if not isinstance(point, (list, tuple)) or len(point) not in (2, 3):
+                raise InvalidDrawing("Points must be [x, y] or [x, y, pressure]")
+            if dimensions is None:
+                dimensions = len(point)
+            elif len(point) != dimensions:
+                raise InvalidDrawing("All points must have the same number of values")
+            if not all(_is_number(value) and abs(value) <= DRAWING_MAX_COORDINATE for value in point):
+                raise InvalidDrawing(f"Point values must be finite numbers of at most {DRAWING_MAX_COORDINATE}")
+    if total > DRAWING_MAX_POINTS:
+        raise InvalidDrawing(f"Drawings may have at most {DRAWING_MAX_POINTS} points")
+    return dimensions or 2
+
+
+def encode(strokes, scale=DRAWING_DEFAULT_SCALE, tolerance=DRAWING_DEFAULT_TOLERANCE):
+    """Simplifies and packs `strokes` (the JSON form) into the binary form."""
+    dimensions = validate_strokes(strokes)
+    if not isinstance(scale, int) or isinstance(scale, bool) or not 1 <= scale <= 1000:
+        raise InvalidDrawing("scale must be an integer between 1 and 1000")
+    if not _is_number(tolerance) or tolerance < 0:
+        raise InvalidDrawing("tolerance must be a non-negative number")
+
+    out = bytearray((FORMAT_VERSION, dimensions))
+    _write_varint(out, scale)
+    _write_varint(out, len(strokes))
+    previous = [0] * dimensions
+    for stroke in strokes:
+        stroke = simplify(stroke, tolerance)
+        _write_varint(out, len(stroke))
+        for point in stroke:
+            for i, value in enumerate(point):
+                quantized = round(value * scale)
+                _write_varint(out, _zigzag(quantized - previous[i]))
+                previous[i] = quantized
+    return bytes(out)
+
+
+def decode(data):
+    """Unpacks the binary form into the JSON form."""
+    data = bytes(data)
+    if len(data) < 2 or data[0] != FORMAT_VERSION:
+        raise InvalidDrawing("Unsupported drawing format")
+    dimensions = data[1]
+    if dimensions not in (2, 3):
+        raise InvalidDrawing("Unsupported drawing format")
+    scale, pos = _read_varint(data, 2)
+    if scale == 0:
+        raise InvalidDrawing("Unsupported drawing format")
+    stroke_count, pos = _read_varint(data, pos)
+
+    strokes = []
+    total = 0
+    previous = [0] * dimensions
+    for _ in range(stroke_count):
+        point_count, pos = _read_varint(data, pos)
+        total += point_count
+        if total > DRAWING_MAX_POINTS:
+            raise InvalidDrawing(f"Drawings may have at most {DRAWING_MAX_POINTS} points")
+        stroke = []
+        for _ in range(point_count):
+            point = []
+            for i in range(dimensions):
+                delta, pos = _read_varint(data, pos)
+                previous[i] += _unzigzag(delta)
+                point.append(previous[i] / scale if scale != 1 else previous[i])
+            stroke.append(point)
+        strokes.append(stroke)
+    if pos != len(data):
+        raise InvalidDrawing("Trailing bytes after drawing data")
+    return strokes
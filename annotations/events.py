@@ -0,0 +1,161 @@
+"""
+Change events for realtime push.
+
+Mutating views call `emit` once their write has committed, and the note_events
+view streams the events for the contexts a client subscribed to as
+Server-Sent Events. Brokers route on `event_key(user_id, identifier)`, so a
+user only ever receives events for their own contexts. The broker is chosen with OVERNOTE_EVENT_BROKER: the
+in-process broker only reaches subscribers connected to the same worker, so
+deployments with several workers should use RedisBroker (or another pub/sub
+backend implementing the same methods). Async views publish through `aemit`,
+so a broker that does network I/O never blocks the event loop.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+class BaseBroker:
+    def publish(self, key, event):
+        """Delivers `event` to every subscriber of `key`. Safe to call from sync code."""
+        raise NotImplementedError
+
+    async def apublish(self, key, event):
+        """`publish` for async code. By default it runs in a worker thread, off the event loop."""
+        await sync_to_async(self.publish, thread_sensitive=False)(key, event)
+
+    def subscribe(self, keys, timeout=None):
+        """
+        Returns an async iterator of events for `keys`. It yields None
+        whenever `timeout` seconds pass without an event, so callers can send
+        keepalives.
+        """
+        raise NotImplementedError
+
+
+class InProcessBroker(BaseBroker):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def publish(self, key, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(key, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._deliver, queue, event)
+            except RuntimeError:
+                # The subscriber's loop is already closed.
+                pass
+
+    async def apublish(self, key, event):
+        # Only schedules callbacks, so it is safe to call on the event loop
+        self.publish(key, event)
+
+    @staticmethod
+    def _deliver(queue, event):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow consumer: drop rather than let its backlog grow without bound.
+            pass
+
+    async def subscribe(self, keys, timeout=None):
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE))
+        with self._lock:
+            for key in keys:
+                self._subscribers.setdefault(key, set()).add(subscriber)
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(subscriber[1].get(), timeout)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            with self._lock:
+                for key in keys:
+                    subscribers = self._subscribers.get(key)
+                    if subscribers is not None:
+                        subscribers.discard(subscriber)
+                        if not subscribers:
+                            del self._subscribers[key]
+
+
+class RedisBroker(BaseBroker):
+    """Fans events out across workers through Redis pub/sub. Requires the `redis` package."""
+
+    def __init__(self, url, channel_prefix="overnote:context:"):
+        import redis
+
+        self.url = url
+        self.channel_prefix = channel_prefix
+        self._client = redis.Redis.from_url(url)
+
+    def _channel(self, key):
+        return self.channel_prefix + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def publish(self, key, event):
+        self._client.publish(self._channel(key), json.dumps(event))
+
+    async def subscribe(self, keys, timeout=None):
+        import redis.asyncio
+
+        client = redis.asyncio.Redis.from_url(self.url)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(*[self._channel(key) for key in keys])
+        try:
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+                yield json.loads(message["data"]) if message else None
+        finally:
+            await pubsub.aclose()
+            await client.aclose()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                broker_class = import_string(
+                    getattr(settings, "OVERNOTE_EVENT_BROKER", "annotations.events.InProcessBroker")
+                )
+                _broker = broker_class(**getattr(settings, "OVERNOTE_EVENT_BROKER_OPTIONS", {}))
+    return _broker
+
+
+def event_key(user_id, identifier):
+    return f"{user_id}:{identifier}"
+
+
+def emit(user_id, identifier, event_type, **data):
+    """Publishes a change event for `user_id`'s `identifier`. Call only after the write has committed."""
+    try:
+        get_broker().publish(event_key(user_id, identifier), {"type": event_type, "context": identifier, **data})
+    except Exception:
+        # Push is best effort; clients still converge on their next read.
+        logger.exception("Could not publish %s event for context %r", event_type, identifier)
+
+
+async def aemit(user_id, identifier, event_type, **data):
+    """`emit` for async views."""
+    try:
+        await get_broker().apublish(
+            event_key(user_id, identifier), {"type": event_type, "context": identifier, **data}
+        )
+    except Exception:
+        logger.exception("Could not publish %s event for context %r", event_type, identifier)
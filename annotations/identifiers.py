@@ -0,0 +1,164 @@
+"""
+Canonical form of context identifiers.
+
+Clients identify a web context by the URL of the page, and the same page is
+reached through URLs that only differ in ways that do not change what it
+shows: a tracking parameter, a fragment, a trailing slash, the case of the
+host. `canonicalize` maps all of them onto one identifier, and every view
+runs the identifier it receives through it before reading or writing, so they
+share one AnnotationContext. For http(s) URLs it
+
+- lowercases the scheme and host, and drops credentials, the default port
+  and a trailing dot of the host;
+- drops the fragment, unless it is a client-side route ("#/..." or "#!...");
+- drops tracking parameters (TRACKING_PARAMS and TRACKING_PARAM_PREFIXES)
+  and sorts the others by name, keeping the order of repeated names and
+  leaving their encoding alone;
+- drops a trailing slash from the path, and makes an empty path "/".
+
+Other identifiers are only stripped of surrounding whitespace: file: URLs
+are documents (DOC), anything else an application (APP). Canonicalizing is
+idempotent.
+
+It also parses out what AnnotationContext stores next to the identifier: the
+context type and, for web pages, the host, the site (the registrable domain
+of the host, e.g. example.co.uk for docs.example.co.uk) and the path. The
+(user, site, host, path) index on them serves the per-site lookups of
+/api/notes/site without scanning all of a user's contexts: a site, and a host
+within it, are ranges of the index, and path prefixes are matched within the
+host's range.
+"""
+import ipaddress
+from typing import NamedTuple
+from urllib.parse import unquote_plus, urlsplit, urlunsplit
+
+from django.db.models import Q
+
+WEB_SCHEMES = {"http", "https"}
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+TRACKING_PARAMS = {
+    "fbclid", "gclid", "dclid", "gbraid", "wbraid", "msclkid", "yclid", "twclid", "igshid",
+    "mc_cid", "mc_eid", "_ga", "_gl", "_hsenc", "_hsmi", "mkt_tok", "oly_anon_id", "oly_enc_id",
+    "vero_id", "wickedid", "ref_src",
+}
+TRACKING_PARAM_PREFIXES = ("utm_", "pk_")
+
+# Second-level labels under which country-code domains register names, as in example.co.uk
+COUNTRY_SECOND_LEVEL_LABELS = {"ac", "co", "com", "edu", "go", "gov", "ne", "net", "or", "org"}
+
+# Longest valid host name
+HOST_MAX_LENGTH = 253
+# Longer paths are truncated in AnnotationContext.path (not in the identifier) to keep index entries small
+PATH_MAX_LENGTH = 1024
+
+# Scopes of /api/notes/site: the page's site with all of its subdomains, its host, or its path and below
+SITE_SCOPES = ("site", "host", "path")
+
+
+class CanonicalIdentifier(NamedTuple):
+    identifier: str
+    context_type: str
+    host: str = ""
+    site: str = ""
+    path: str = ""
+
+    def fields(self):
+        """The AnnotationContext fields derived from the identifier."""
+        return {"context_type": self.context_type, "host": self.host, "site": self.site, "path": self.path}
+
+
+def registrable_domain(host):
+    """
+    The site `host` belongs to. Without a public suffix list this keeps the
+    last two labels, or three under the usual second-level labels of
+    country-code domains; IP addresses and single labels are their own site.
+    """
+    if "." not in host:
+        return host
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+    labels = host.split(".")
+    keep = 3 if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in COUNTRY_SECOND_LEVEL_LABELS else 2
+    return ".".join(labels[-keep:])
+
+
+def _canonical_query(query):
+    params = []
+    for param in query.split("&"):
+        name = unquote_plus(param.split("=", 1)[0])
+        if not param or name.lower() in TRACKING_PARAMS or name.lower().startswith(TRACKING_PARAM_PREFIXES):
+            continue
+        params.append((name, param))
+    # Stable, so repeated names keep their order
+    params.sort(key=lambda param: param[0])
+    return "&".join(param for _, param in params)
+
+
+def _canonical_web(identifier):
+    parts = urlsplit(identifier)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").rstrip(".")
+    if not host or len(host) > HOST_MAX_LENGTH:
+        return None
+    port = parts.port
+    netloc = f"[{host}]" if ":" in host else host
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        netloc = f"{netloc}:{port}"
+
+    path = parts.path or "/"
+    if len(path) > 1:
+        path = path.rstrip("/") or "/"
+    fragment = parts.fragment if parts.fragment.startswith(("/", "!")) else ""
+    return CanonicalIdentifier(
+        urlunsplit((scheme, netloc, path, _canonical_query(parts.query), fragment)),
+        "WEB",
+        host,
+        registrable_domain(host),
+        path[:PATH_MAX_LENGTH],
+    )
+
+
+def canonicalize(identifier):
+    """Returns the CanonicalIdentifier of a context identifier; see the module docstring."""
+    identifier = (identifier or "").strip()
+    scheme = identifier.split(":", 1)[0].lower() if ":" in identifier else ""
+    if scheme in WEB_SCHEMES:
+        try:
+            canonical = _canonical_web(identifier)
+        except ValueError:
+            # An invalid port or IPv6 address; kept as it is
+            canonical = None
+        if canonical is not None:
+            return canonical
+    return CanonicalIdentifier(identifier, "DOC" if scheme == "file" else "APP")
+
+
+def canonical_identifier(identifier):
+    """The canonical identifier for a client-supplied one; anything but a non-empty string is returned as is."""
+    if not identifier or not isinstance(identifier, str):
+        return identifier
+    return canonicalize(identifier).identifier
+
+
+def site_query(identifier, scope="site"):
+    """
+    A filter for AnnotationContext that selects the contexts on the same
+    site, the same host, or the same host at or below the path (`scope`, see
+    SITE_SCOPES) as the page `identifier`. Raises ValueError for an unknown
+    scope or an identifier that is not a web page.
+    """
+    if scope not in SITE_SCOPES:
+        raise ValueError(f"scope must be one of {', '.join(SITE_SCOPES)}")
+    canonical = canonicalize(identifier)
+    if canonical.context_type != "WEB":
+        raise ValueError("Only web pages have a site.")
+    query = Q(site=canonical.site)
+    if scope != "site":
+        query &= Q(host=canonical.host)
+    if scope == "path" and canonical.path != "/":
+        query &= Q(path=canonical.path) | Q(path__startswith=f"{canonical.path}/")
+    return query
@@ -0,0 +1,160 @@
+"""
+Storage pipeline for image annotations.
+
+Uploads are streamed to a temporary file by Django's upload handlers and copied
+to the image storage in chunks, under a name derived from their SHA-256 so the
+same image is only stored once. Thumbnails and WebP variants are produced off
+the request path, either by the in-process worker pool or by the
+`process_images` management command, and are likewise content-addressed so
+they can be served with far-future cache headers.
+
+The storage is the STORAGES alias named by OVERNOTE_IMAGE_STORAGE, so swapping
+the local filesystem for an object store is a settings change.
+"""
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, connection, transaction
+from PIL import Image, ImageOps
+
+from .cache import invalidate_notes
+from .models import Annotation, ChangeCounter, annotation_image_storage
+
+logger = logging.getLogger(__name__)
+
+IMAGE_MAX_BYTES = getattr(settings, "OVERNOTE_IMAGE_MAX_BYTES", 20 * 1024 * 1024)
+IMAGE_INLINE_WORKERS = getattr(settings, "OVERNOTE_IMAGE_INLINE_WORKERS", 2)
+
+# name -> (longest side in px, Pillow format, file extension)
+IMAGE_VARIANTS = {
+    "thumb": (320, "JPEG", "jpg"),
+    "thumb_webp": (320, "WEBP", "webp"),
+    "display_webp": (1280, "WEBP", "webp"),
+}
+
+ALLOWED_FORMATS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif", "WEBP": "webp"}
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def store_upload(uploaded_file):
+    """
+    Validates `uploaded_file` and copies it to the image storage unless an
+    identical image is already stored. Returns (storage name, sha256 hex).
+    """
+    if uploaded_file.size > IMAGE_MAX_BYTES:
+        raise InvalidImage(f"Images may be at most {IMAGE_MAX_BYTES} bytes")
+
+    try:
+        with Image.open(uploaded_file) as image:
+            image_format = image.format
+            image.verify()
+    except Exception as e:
+        raise InvalidImage("Not a valid image") from e
+    if image_format not in ALLOWED_FORMATS:
+        raise InvalidImage(f"Unsupported image format: {image_format}")
+
+    digest = hashlib.sha256()
+    uploaded_file.seek(0)
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    content_hash = digest.hexdigest()
+
+    name = f"originals/{content_hash[:2]}/{content_hash}.{ALLOWED_FORMATS[image_format]}"
+    uploaded_file.seek(0)
+    return _save_once(annotation_image_storage(), name, uploaded_file), content_hash
+
+
+def _save_once(storage, name, content):
+    """
+    Saves `content` under `name` unless that name is taken. Names are derived
+    from the content, so when a concurrent writer got there first the copy the
+    storage renamed is redundant and is removed again.
+    """
+    if storage.exists(name):
+        return name
+    saved = storage.save(name, content)
+    if saved != name:
+        storage.delete(saved)
+    return name
+
+
+def _render_variant(image, max_side, image_format):
+    variant = image.copy()
+    variant.thumbnail((max_side, max_side))
+    if image_format == "JPEG" and variant.mode not in ("RGB", "L"):
+        variant = variant.convert("RGB")
+    buffer = BytesIO()
+    variant.save(buffer, format=image_format, quality=82, optimize=True)
+    return buffer.getvalue()
+
+
+def generate_variants(annotation):
+    """Creates any missing variants for `annotation` and records them on the row."""
+    storage = annotation_image_storage()
+    content_hash = annotation.image_hash
+    variants = {}
+    with storage.open(annotation.image.name, "rb") as original, Image.open(original) as image:
+        image = ImageOps.exif_transpose(image)
+        for variant_name, (max_side, image_format, extension) in IMAGE_VARIANTS.items():
+            name = f"variants/{content_hash[:2]}/{content_hash}/{variant_name}.{extension}"
+            if not storage.exists(name):
+                _save_once(storage, name, ContentFile(_render_variant(image, max_side, image_format)))
+            variants[variant_name] = name
+
+    with transaction.atomic():
+        Annotation.objects.filter(id=annotation.id).update(
+            image_variants=variants, change_seq=ChangeCounter.next_seq(annotation.user_id)
+        )
+    invalidate_notes(annotation.user_id, annotation.context.identifier)
+    return variants
+
+
+def process_image(annotation_id):
+    close_old_connections()
+    try:
+        annotation = Annotation.objects.select_related("context").get(id=annotation_id)
+        if annotation.image:
+            generate_variants(annotation)
+    except Annotation.DoesNotExist:
+        pass
+    except Exception:
+        logger.exception("Could not generate variants for annotation %s", annotation_id)
+    finally:
+        connection.close()
+
+
+_executor = None
+
+
+def enqueue_variants(annotation_id):
+    """
+    Schedules variant generation once the current transaction commits. Without
+    inline workers the `process_images` command picks the annotation up instead.
+    """
+    if IMAGE_INLINE_WORKERS:
+        transaction.on_commit(lambda: _get_executor().submit(process_image, annotation_id))
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=IMAGE_INLINE_WORKERS, thread_name_prefix="image-variants")
+    return _executor
+
+
+def image_urls(image_name, variants):
+    """URLs of the original and every generated variant, for API responses."""
+    if not image_name:
+        return None
+    storage = annotation_image_storage()
+    urls = {"original": storage.url(image_name)}
+    for variant_name, name in (variants or {}).items():
+        urls[variant_name] = storage.url(name)
+    return urls
@@ -0,0 +1,267 @@
+"""
+Hot-path instrumentation for the annotations views.
+
+InstrumentationMiddleware records, per view, the request latency, the number
+and total time of DB queries (via an execute_wrapper that the app installs on
+every connection, in whichever thread the ORM runs) and the request
+and response payload sizes into in-process histograms. They are exported in
+Prometheus text format by the metrics view, which is off unless
+OVERNOTE_METRICS_ENABLED is set and only answers staff users. Every request is
+also written to the "annotations.metrics" logger so a log pipeline can
+aggregate across workers.
+
+Payload bodies are never logged unless OVERNOTE_LOG_PAYLOADS is enabled, and
+even then only a sample of OVERNOTE_PAYLOAD_LOG_SAMPLE_RATE requests is logged.
+"""
+import bisect
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http.request import RawPostDataException
+
+metrics_logger = logging.getLogger("annotations.metrics")
+payload_logger = logging.getLogger("annotations.payloads")
+
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS_BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+PAYLOAD_LOG_MAX_CHARS = 2000
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Histograms keyed by (metric name, view name), plus process-wide counters."""
+
+    METRICS = {
+        "overnote_view_latency_ms": LATENCY_BUCKETS_MS,
+        "overnote_view_db_queries": QUERY_COUNT_BUCKETS,
+        "overnote_view_db_time_ms": LATENCY_BUCKETS_MS,
+        "overnote_view_request_bytes": SIZE_BUCKETS_BYTES,
+        "overnote_view_response_bytes": SIZE_BUCKETS_BYTES,
+    }
+
+    COUNTERS = (
+        # annotations.writebehind: updates accepted into the buffer, those
+        # replaced by a newer one before being written, and payloads written
+        "overnote_write_behind_buffered_total",
+        "overnote_write_behind_coalesced_total",
+        "overnote_write_behind_written_total",
+    )
+
+    # Gauges computed from two counters as numerator / denominator
+    RATIOS = {
+        "overnote_write_behind_coalesce_ratio": (
+            "overnote_write_behind_coalesced_total",
+            "overnote_write_behind_written_total",
+        ),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def observe(self, name, view, value):
+        with self._lock:
+            key = (name, view)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.METRICS[name])
+            histogram.observe(value)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters[name]
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            for name in self.METRICS:
+                series = sorted(
+                    (view, histogram)
+                    for (metric, view), histogram in self._histograms.items()
+                    if metric == name
+                )
+                if not series:
+                    continue
+                lines.append(f"# TYPE {name} histogram")
+                for view, histogram in series:
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{view="{view}"}} {histogram.total:g}')
+                    lines.append(f'{name}_count{{view="{view}"}} {histogram.count}')
+            for name, value in self._counters.items():
+                lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name} {value}")
+            for name, (numerator, denominator) in self.RATIOS.items():
+                if self._counters[denominator]:
+                    lines.append(f"# TYPE {name} gauge")
+                    lines.append(f"{name} {self._counters[numerator] / self._counters[denominator]:g}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class QueryRecorder:
+    """execute_wrapper that counts queries and the time spent in them."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+
+
+# The recorder of the request being handled. sync_to_async runs the ORM in a
+# worker thread with its own connections but a copy of this context, so the
+# wrapper installed on every connection finds the request's recorder there.
+_current_recorder = ContextVar("overnote_query_recorder", default=None)
+
+
+def _record_query(execute, sql, params, many, context):
+    recorder = _current_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def install_query_recorder(connection, **kwargs):
+    """connection_created receiver: adds the query recorder to a new connection of any thread."""
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def _view_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unresolved"
+    return match.url_name or match.view_name or "unnamed"
+
+
+def _response_size(response):
+    if getattr(response, "streaming", False):
+        return None
+    return len(response.content)
+
+
+def _request_size(request):
+    try:
+        return int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        return 0
+
+
+def _maybe_log_payload(request, view):
+    if not getattr(settings, "OVERNOTE_LOG_PAYLOADS", False):
+        return
+    if random.random() >= getattr(settings, "OVERNOTE_PAYLOAD_LOG_SAMPLE_RATE", 0.01):
+        return
+    try:
+        body = request.body[:PAYLOAD_LOG_MAX_CHARS].decode("utf-8", errors="replace")
+    except RawPostDataException:
+        # Multipart uploads are streamed to disk and never kept in memory.
+        return
+    payload_logger.info("%s %s payload: %s", request.method, view, body)
+
+
+class InstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder, started = QueryRecorder(), time.perf_counter()
+        token = _current_recorder.set(recorder)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_recorder.reset(token)
+        self._record(request, response, recorder, started)
+        return response
+
+    async def __acall__(self, request):
+        recorder, started = QueryRecorder(), time.perf_counter()
+        token = _current_recorder.set(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_recorder.reset(token)
+        self._record(request, response, recorder, started)
+        return response
+
+    def _record(self, request, response, recorder, started):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        view = _view_name(request)
+        request_bytes = _request_size(request)
+        response_bytes = _response_size(response)
+
+        registry.observe("overnote_view_latency_ms", view, elapsed_ms)
+        registry.observe("overnote_view_db_queries", view, recorder.count)
+        registry.observe("overnote_view_db_time_ms", view, recorder.duration * 1000)
+        registry.observe("overnote_view_request_bytes", view, request_bytes)
+        if response_bytes is not None:
+            registry.observe("overnote_view_response_bytes", view, response_bytes)
+
+        metrics_logger.debug(
+            "%s %s %s %.1fms queries=%d db=%.1fms in=%dB out=%sB",
+            request.method,
+            view,
+            response.status_code,
+            elapsed_ms,
+            recorder.count,
+            recorder.duration * 1000,
+            request_bytes,
+            response_bytes if response_bytes is not None else "-",
+            extra={
+                "view": view,
+                "status": response.status_code,
+                "latency_ms": elapsed_ms,
+                "db_queries": recorder.count,
+                "db_time_ms": recorder.duration * 1000,
+                "request_bytes": request_bytes,
+                "response_bytes": response_bytes,
+            },
+        )
+        _maybe_log_payload(request, view)
@@ -0,0 +1,20 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from annotations.models import ApiToken
+
+
+class Command(BaseCommand):
+    help = "Issues an API token for a user and prints it. The token cannot be shown again."
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("--name", default="", help="Label to tell the user's tokens apart.")
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get_by_natural_key(options["username"])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f"User '{options['username']}' does not exist")
+        _, raw = ApiToken.issue(user, options["name"])
+        self.stdout.write(raw)
@@ -0,0 +1,42 @@
+import sys
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from annotations.archive import EXPORT_CHUNK_SIZE, export_archive, gzip_lines
+
+
+class Command(BaseCommand):
+    help = "Writes a user's contexts and notes to an NDJSON archive, one context per line."
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("--output", default="-", help="File to write, or - for stdout (the default).")
+        parser.add_argument(
+            "--gzip", action="store_true", help="Gzip the archive; implied by an --output ending in .gz."
+        )
+        parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE, help="Contexts read per round trip.")
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get_by_natural_key(options["username"])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f"User '{options['username']}' does not exist")
+
+        output = options["output"]
+        lines = export_archive(user, chunk_size=options["chunk_size"])
+        if options["gzip"] or output.endswith(".gz"):
+            lines = gzip_lines(lines)
+
+        started = time.perf_counter()
+        out = sys.stdout.buffer if output == "-" else open(output, "wb")
+        try:
+            for data in lines:
+                out.write(data)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        if output != "-":
+            elapsed = time.perf_counter() - started
+            self.stdout.write(self.style.SUCCESS(f"Exported {user} to {output} in {elapsed:.1f}s."))
@@ -0,0 +1,39 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from annotations.datagen import generate_dataset
+
+
+class Command(BaseCommand):
+    help = "Bulk-generates synthetic contexts and notes for benchmarking."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--contexts", type=int, default=1000)
+        parser.add_argument("--notes-per-context", type=int, default=10)
+        parser.add_argument("--html-size", type=int, default=500, help="Approximate characters of HTML per note.")
+        parser.add_argument("--seed", type=int, default=0, help="Also namespaces the generated identifiers.")
+        parser.add_argument("--prefix", default="https://bench.example")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--user", help="Username to own the data (created if missing); defaults to 'datagen'.")
+
+    def handle(self, *args, **options):
+        user = None
+        if options["user"]:
+            user, _ = get_user_model().objects.get_or_create(username=options["user"])
+        started = time.perf_counter()
+        identifiers = generate_dataset(
+            options["contexts"],
+            options["notes_per_context"],
+            html_size=options["html_size"],
+            seed=options["seed"],
+            prefix=options["prefix"],
+            batch_size=options["batch_size"],
+            user=user,
+        )
+        elapsed = time.perf_counter() - started
+        notes = len(identifiers) * options["notes_per_context"]
+        self.stdout.write(
+            self.style.SUCCESS(f"Created {len(identifiers)} contexts and {notes} notes in {elapsed:.1f}s.")
+        )
@@ -0,0 +1,49 @@
+import sys
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from annotations.archive import IMPORT_BATCH_SIZE, ArchiveError, import_archive, open_archive
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports an NDJSON archive written by export_notes, plain or gzipped, as a user's contexts and notes. "
+        "Contexts the user already has get the archive's notes instead of theirs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("input", nargs="?", default="-", help="Archive to read, or - for stdin (the default).")
+        parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="Contexts per transaction.")
+        parser.add_argument("--skip-existing", action="store_true", help="Leave contexts the user already has alone.")
+        parser.add_argument("--create-user", action="store_true", help="Create the user if it does not exist.")
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        try:
+            user = User.objects.get_by_natural_key(options["username"])
+        except User.DoesNotExist:
+            if not options["create_user"]:
+                raise CommandError(f"User '{options['username']}' does not exist")
+            user = User.objects.create_user(options["username"])
+
+        started = time.perf_counter()
+        source = sys.stdin.buffer if options["input"] == "-" else open(options["input"], "rb")
+        try:
+            contexts, notes = import_archive(
+                user,
+                open_archive(source),
+                batch_size=options["batch_size"],
+                skip_existing=options["skip_existing"],
+            )
+        except (ArchiveError, OSError) as e:
+            raise CommandError(f"Could not import {options['input']}: {e}")
+        finally:
+            if source is not sys.stdin.buffer:
+                source.close()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            self.style.SUCCESS(f"Imported {contexts} contexts and {notes} notes for {user} in {elapsed:.1f}s.")
+        )
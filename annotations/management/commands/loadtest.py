@@ -0,0 +1,137 @@
+"""
+Load-test harness for comparing WSGI and ASGI deployments.
+
+Start the same project under both servers, e.g.
+
+    gunicorn overnote_backend.wsgi -w 4 -b 127.0.0.1:8001
+    uvicorn overnote_backend.asgi:application --workers 4 --port 8002
+
+and point the command at them:
+
+    python manage.py loadtest --target wsgi=http://127.0.0.1:8001 \
+        --target asgi=http://127.0.0.1:8002 --concurrency 200 --requests 5000
+
+Each target gets the same mix of get_notes reads and update_all_notes writes,
+sent from a single asyncio loop through an httpx client that keeps at most
+`--concurrency` connections alive, and the command prints requests per second
+and latency percentiles side by side. Responses other than 2xx count as
+errors and are listed by status. Pass `--token` (see create_api_token) to
+authenticate the requests.
+"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from urllib.parse import quote, urlsplit
+
+import httpx
+from django.core.management.base import BaseCommand, CommandError
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Command(BaseCommand):
+    help = "Compares requests/second and latency percentiles across WSGI/ASGI deployments."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--target",
+            action="append",
+            required=True,
+            help="NAME=BASE_URL of a running deployment; repeat to compare several.",
+        )
+        parser.add_argument("--token", help="API token to send as a Bearer Authorization header.")
+        parser.add_argument("--concurrency", type=int, default=100)
+        parser.add_argument("--requests", type=int, default=2000, help="Requests per target.")
+        parser.add_argument("--contexts", type=int, default=50, help="Distinct contexts to spread load over.")
+        parser.add_argument("--timeout", type=float, default=30, help="Seconds before a request counts as failed.")
+        parser.add_argument(
+            "--write-ratio",
+            type=float,
+            default=0.2,
+            help="Fraction of requests that are update_all_notes autosaves.",
+        )
+
+    def handle(self, *args, **options):
+        targets = []
+        for target in options["target"]:
+            name, sep, url = target.partition("=")
+            if not sep:
+                raise CommandError(f"Expected NAME=URL, got '{target}'")
+            if urlsplit(url).scheme not in ("http", "https"):
+                raise CommandError(f"Expected an http or https URL, got '{url}'")
+            targets.append((name, url.rstrip("/")))
+
+        self.stdout.write(
+            f"{'target':<10} {'req/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'errors':>8}"
+        )
+        for name, url in targets:
+            result = asyncio.run(self.run_target(url, options))
+            self.stdout.write(
+                f"{name:<10} {result['rps']:>10.1f} {result['p50']:>10.1f} "
+                f"{result['p95']:>10.1f} {result['p99']:>10.1f} {sum(result['errors'].values()):>8}"
+            )
+            for error, count in result["errors"].most_common():
+                self.stdout.write(f"{'':<10} {count:>10} {error}")
+
+    async def run_target(self, base_url, options):
+        contexts = [f"https://loadtest.example/{i}" for i in range(options["contexts"])]
+        remaining = options["requests"]
+        latencies = []
+        errors = Counter()
+
+        def next_request():
+            context = random.choice(contexts)
+            if random.random() < options["write_ratio"]:
+                body = json.dumps({
+                    "context": context,
+                    "notes": [f"<p>note {i} {random.random()}</p>" for i in range(5)],
+                }).encode()
+                return "PUT", "api/notes/update", body
+            return "GET", f"api/notes?context={quote(context, safe='')}", None
+
+        async def worker(client):
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                method, path, body = next_request()
+                started = time.perf_counter()
+                try:
+                    response = await client.request(method, path, content=body)
+                    if not response.is_success:
+                        errors[f"HTTP {response.status_code}"] += 1
+                except httpx.HTTPError as e:
+                    errors[type(e).__name__] += 1
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        headers = {"Content-Type": "application/json"}
+        if options["token"]:
+            headers["Authorization"] = f"Bearer {options['token']}"
+        limits = httpx.Limits(
+            max_connections=options["concurrency"], max_keepalive_connections=options["concurrency"]
+        )
+        async with httpx.AsyncClient(
+            # Relative paths resolve below the base URL's own path
+            base_url=base_url + "/",
+            headers=headers,
+            limits=limits,
+            timeout=options["timeout"],
+        ) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(client) for _ in range(options["concurrency"])))
+            elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        return {
+            "rps": len(latencies) / elapsed if elapsed else 0.0,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "errors": errors,
+        }
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from annotations.dedup import find_duplicate_identifiers, merge_duplicate_contexts
+from annotations.models import Annotation, AnnotationContext
+
+
+class Command(BaseCommand):
+    help = "Merges a user's AnnotationContext rows that share an identifier into the oldest one."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report how many duplicate contexts would be merged.",
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        key_fields = ("user", "identifier")
+        identifiers = find_duplicate_identifiers(AnnotationContext, key_fields).count()
+        removed = merge_duplicate_contexts(AnnotationContext, Annotation, dry_run=dry_run, key_fields=key_fields)
+
+        verb = "Would merge" if dry_run else "Merged"
+        self.stdout.write(
+            self.style.SUCCESS(f"{verb} {removed} duplicate contexts across {identifiers} identifiers.")
+        )
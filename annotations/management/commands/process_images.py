@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from annotations.images import generate_variants
+from annotations.models import Annotation
+
+
+class Command(BaseCommand):
+    help = "Generates thumbnails and WebP variants for image notes that do not have them yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        queryset = (
+            Annotation.objects.exclude(image="")
+            .exclude(image__isnull=True)
+            .filter(image_variants={})
+            .select_related("context")
+            .order_by("id")
+        )
+        processed = failed = 0
+        last_id = 0
+        while True:
+            batch = list(queryset.filter(id__gt=last_id)[: options["batch_size"]])
+            if not batch:
+                break
+            for annotation in batch:
+                try:
+                    generate_variants(annotation)
+                    processed += 1
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f"Annotation {annotation.id}: {e}")
+            last_id = batch[-1].id
+        self.stdout.write(self.style.SUCCESS(f"Processed {processed} images, {failed} failed."))
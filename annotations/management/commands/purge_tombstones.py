@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from annotations.tombstones import PURGE_BATCH_SIZE, TOMBSTONE_RETENTION_DAYS, purge_tombstones
+
+
+class Command(BaseCommand):
+    help = "Permanently removes notes and contexts that were deleted longer ago than the retention period."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than-days", type=float, default=TOMBSTONE_RETENTION_DAYS)
+        parser.add_argument("--batch-size", type=int, default=PURGE_BATCH_SIZE)
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to sleep between batches, to spread the load.",
+        )
+
+    def handle(self, *args, **options):
+        notes, contexts = purge_tombstones(
+            older_than=timezone.now() - timedelta(days=options["older_than_days"]),
+            batch_size=options["batch_size"],
+            pause=options["pause"],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Purged {notes} notes and {contexts} contexts."))
@@ -0,0 +1,53 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:58
+
+from django.db import migrations
+from django.db.models import Count, F, Max, Min
+
+
+def merge_duplicates(apps, schema_editor):
+    """
+    Folds every duplicate context into the oldest one with the same identifier,
+    moving its notes after the kept context's own. A frozen copy of what
+    annotations.dedup did when this migration was written.
+    """
+    AnnotationContext = apps.get_model("annotations", "AnnotationContext")
+    Annotation = apps.get_model("annotations", "Annotation")
+    alias = schema_editor.connection.alias
+    contexts = AnnotationContext.objects.using(alias)
+    duplicates = (
+        contexts.values("identifier")
+        .annotate(total=Count("id"), keep_id=Min("id"))
+        .filter(total__gt=1)
+        .order_by("identifier")
+    )
+    for duplicate in duplicates:
+        keep_id = duplicate["keep_id"]
+        extra_ids = list(
+            contexts.filter(identifier=duplicate["identifier"])
+            .exclude(id=keep_id)
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        for extra_id in extra_ids:
+            offset = Annotation.objects.using(alias).filter(context_id=keep_id).aggregate(top=Max("order"))["top"]
+            Annotation.objects.using(alias).filter(context_id=extra_id).update(
+                context_id=keep_id,
+                order=F("order") + (offset + 1 if offset is not None else 0),
+            )
+        contexts.filter(id__in=extra_ids).delete()
+
+
+class Migration(migrations.Migration):
+    """
+    Existing duplicate contexts would make the unique constraint added in the
+    next migration fail to apply. Kept separate so the data changes commit
+    before the schema is altered.
+    """
+
+    dependencies = [
+        ("annotations", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("annotations", "0002_merge_duplicate_contexts"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="annotation",
+            index=models.Index(
+                fields=["context", "order"], name="annotation_context_order_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="annotationcontext",
+            constraint=models.UniqueConstraint(
+                fields=("identifier",), name="annotation_context_identifier_uniq"
+            ),
+        ),
+    ]
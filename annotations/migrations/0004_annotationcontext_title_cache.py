@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("annotations", "0003_context_identifier_unique_and_order_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="annotationcontext",
+            name="title",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="annotationcontext",
+            name="title_fetch_failed",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="annotationcontext",
+            name="title_fetched_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
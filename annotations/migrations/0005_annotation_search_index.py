@@ -0,0 +1,138 @@
+# Generated by Django 5.1.4 on 2026-10-18 14:07
+
+import re
+from collections import Counter
+from html.parser import HTMLParser
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# A frozen copy of the text extraction and tokenizing of annotations.search as
+# of this migration, so later changes to them cannot change what it does.
+
+SEARCH_CONFIG = getattr(settings, "OVERNOTE_SEARCH_CONFIG", "simple")
+TOKEN_MAX_LENGTH = 64
+WORD_RE = re.compile(r"[^\W_]+")
+BLOCK_TAGS = {"p", "div", "br", "li", "ul", "ol", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "tr"}
+
+
+class TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self.parts.append(" ")
+
+    def handle_endtag(self, tag):
+        if tag in BLOCK_TAGS:
+            self.parts.append(" ")
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+
+def html_to_text(html):
+    extractor = TextExtractor()
+    extractor.feed(html or "")
+    extractor.close()
+    return " ".join("".join(extractor.parts).split())
+
+
+class PostgresOnlyAddIndex(migrations.AddIndex):
+    """GIN indexes only exist on PostgreSQL; other backends fall back to SearchToken."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+def index_existing_notes(apps, schema_editor, batch_size=1000):
+    """Builds the search vector (PostgreSQL) or the token index (elsewhere) of every note."""
+    Annotation = apps.get_model("annotations", "Annotation")
+    SearchToken = apps.get_model("annotations", "SearchToken")
+    alias = schema_editor.connection.alias
+    notes = Annotation.objects.using(alias).only("id", "content").order_by("id")
+    last_id = 0
+    while True:
+        batch = list(notes.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        last_id = batch[-1].id
+        if schema_editor.connection.vendor == "postgresql":
+            for note in batch:
+                note.search_vector = django.contrib.postgres.search.SearchVector(
+                    models.Value(html_to_text(note.content)), config=SEARCH_CONFIG
+                )
+            Annotation.objects.using(alias).bulk_update(batch, ["search_vector"])
+            continue
+        SearchToken.objects.using(alias).bulk_create(
+            SearchToken(annotation_id=note.id, token=token, weight=weight)
+            for note in batch
+            for token, weight in Counter(
+                word[:TOKEN_MAX_LENGTH] for word in WORD_RE.findall(html_to_text(note.content).lower())
+            ).items()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("annotations", "0004_annotationcontext_title_cache"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SearchToken",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("token", models.CharField(max_length=64)),
+                ("weight", models.PositiveIntegerField(default=1)),
+                (
+                    "annotation",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="search_tokens",
+                        to="annotations.annotation",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["token", "annotation"], name="search_token_lookup_idx"
+                    )
+                ],
+            },
+        ),
+        migrations.AddField(
+            model_name="annotation",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                blank=True, editable=False, null=True
+            ),
+        ),
+        PostgresOnlyAddIndex(
+            model_name="annotation",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="annotation_search_vector_idx"
+            ),
+        ),
+        migrations.RunPython(index_existing_notes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.4 on 2026-10-18 14:13
+
+import annotations.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("annotations", "0005_annotation_search_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="annotation",
+            name="image_hash",
+            field=models.CharField(
+                blank=True, db_index=True, default="", max_length=64
+            ),
+        ),
+        migrations.AddField(
+            model_name="annotation",
+            name="image_variants",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AlterField(
+            model_name="annotation",
+            name="image",
+            field=models.ImageField(
+                blank=True,
+                null=True,
+                storage=annotations.models.annotation_image_storage,
+                upload_to="annotations/",
+            ),
+        ),
+    ]
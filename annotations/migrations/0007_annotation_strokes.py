@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 14:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("annotations", "0006_annotation_image_variants"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="annotation",
+            name="strokes",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
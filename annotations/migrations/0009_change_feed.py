@@ -0,0 +1,47 @@
+# Generated by Django 5.1.4 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+def create_global_counter(apps, schema_editor):
+    # ChangeCounter.next_seq increments the row in place, so it has to exist
+    apps.get_model("annotations", "ChangeCounter").objects.using(
+        schema_editor.connection.alias
+    ).get_or_create(scope="global")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("annotations", "0008_tombstones"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ChangeCounter",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("scope", models.CharField(max_length=64, unique=True)),
+                ("value", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="annotation",
+            name="change_seq",
+            field=models.BigIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name="annotationcontext",
+            name="change_seq",
+            field=models.BigIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(create_global_counter, migrations.RunPython.noop),
+    ]
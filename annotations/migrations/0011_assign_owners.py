@@ -0,0 +1,51 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:05
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+def assign_owners(apps, schema_editor):
+    """
+    Gives contexts saved before accounts existed to OVERNOTE_LEGACY_OWNER, makes
+    every note belong to its context's owner, and starts each owner's change
+    counter where the global one left off so existing cursors stay valid.
+    """
+    alias = schema_editor.connection.alias
+    AnnotationContext = apps.get_model("annotations", "AnnotationContext")
+    Annotation = apps.get_model("annotations", "Annotation")
+    ChangeCounter = apps.get_model("annotations", "ChangeCounter")
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+
+    orphans = AnnotationContext.objects.using(alias).filter(user__isnull=True)
+    if orphans.exists():
+        owner, _ = User.objects.using(alias).get_or_create(
+            username=getattr(settings, "OVERNOTE_LEGACY_OWNER", "legacy")
+        )
+        orphans.update(user=owner)
+
+    Annotation.objects.using(alias).update(
+        user_id=Subquery(
+            AnnotationContext.objects.using(alias).filter(id=OuterRef("context_id")).values("user_id")[:1]
+        )
+    )
+
+    global_counter = ChangeCounter.objects.using(alias).filter(scope="global").first()
+    if global_counter is not None:
+        owner_ids = AnnotationContext.objects.using(alias).values_list("user_id", flat=True).distinct()
+        ChangeCounter.objects.using(alias).bulk_create(
+            [ChangeCounter(scope=f"user:{user_id}", value=global_counter.value) for user_id in owner_ids],
+            ignore_conflicts=True,
+        )
+        global_counter.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("annotations", "0010_context_user_apitoken"),
+    ]
+
+    operations = [
+        migrations.RunPython(assign_owners, migrations.RunPython.noop),
+    ]
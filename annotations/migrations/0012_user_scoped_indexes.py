@@ -0,0 +1,83 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("annotations", "0011_assign_owners"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="annotationcontext",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="annotation_contexts",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="annotation",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.RemoveConstraint(
+            model_name="annotationcontext",
+            name="annotation_context_identifier_uniq",
+        ),
+        migrations.AddConstraint(
+            model_name="annotationcontext",
+            constraint=models.UniqueConstraint(
+                fields=("user", "identifier"),
+                name="annotation_context_user_identifier_uniq",
+            ),
+        ),
+        migrations.RemoveIndex(
+            model_name="annotation",
+            name="annotation_context_order_idx",
+        ),
+        migrations.AddIndex(
+            model_name="annotation",
+            index=models.Index(
+                fields=["user", "context", "order"],
+                name="annotation_user_context_idx",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="annotation",
+            name="change_seq",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="annotation",
+            index=models.Index(
+                fields=["user", "change_seq"],
+                name="annotation_user_change_seq_idx",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="annotationcontext",
+            name="change_seq",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="annotationcontext",
+            index=models.Index(fields=["user", "id"], name="context_user_id_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="annotationcontext",
+            index=models.Index(
+                fields=["user", "change_seq"],
+                name="context_user_change_seq_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("annotations", "0012_user_scoped_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="annotationcontext",
+            name="version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:20
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_contents(apps, schema_editor, batch_size=1000):
+    """
+    Stores the hash of every text note's content as it is. Notes saved before
+    normalization existed are normalized, and rehashed, when next saved.
+    """
+    Annotation = apps.get_model("annotations", "Annotation")
+    notes = (
+        Annotation.objects.using(schema_editor.connection.alias)
+        .exclude(annotation_type__in=["DRAW", "IMG"])
+        .only("id", "content")
+        .order_by("id")
+    )
+    last_id = 0
+    while True:
+        batch = list(notes.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        for note in batch:
+            note.content_hash = hashlib.sha256((note.content or "").encode("utf-8")).hexdigest()
+        Annotation.objects.using(schema_editor.connection.alias).bulk_update(batch, ["content_hash"])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("annotations", "0013_annotationcontext_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="annotation",
+            name="content_hash",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.RunPython(hash_contents, migrations.RunPython.noop),
+    ]
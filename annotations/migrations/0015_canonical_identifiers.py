@@ -0,0 +1,178 @@
+# Generated by Django 5.1.4 on 2026-10-18 20:05
+
+import ipaddress
+from urllib.parse import unquote_plus, urlsplit, urlunsplit
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+# A frozen copy of annotations.identifiers and annotations.dedup.merge_contexts
+# as of this migration, so later changes to them cannot change what it does.
+
+WEB_SCHEMES = {"http", "https"}
+DEFAULT_PORTS = {"http": 80, "https": 443}
+TRACKING_PARAMS = {
+    "fbclid", "gclid", "dclid", "gbraid", "wbraid", "msclkid", "yclid", "twclid", "igshid",
+    "mc_cid", "mc_eid", "_ga", "_gl", "_hsenc", "_hsmi", "mkt_tok", "oly_anon_id", "oly_enc_id",
+    "vero_id", "wickedid", "ref_src",
+}
+TRACKING_PARAM_PREFIXES = ("utm_", "pk_")
+COUNTRY_SECOND_LEVEL_LABELS = {"ac", "co", "com", "edu", "go", "gov", "ne", "net", "or", "org"}
+HOST_MAX_LENGTH = 253
+PATH_MAX_LENGTH = 1024
+
+
+def registrable_domain(host):
+    if "." not in host:
+        return host
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+    labels = host.split(".")
+    keep = 3 if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in COUNTRY_SECOND_LEVEL_LABELS else 2
+    return ".".join(labels[-keep:])
+
+
+def canonical_query(query):
+    params = []
+    for param in query.split("&"):
+        name = unquote_plus(param.split("=", 1)[0])
+        if not param or name.lower() in TRACKING_PARAMS or name.lower().startswith(TRACKING_PARAM_PREFIXES):
+            continue
+        params.append((name, param))
+    params.sort(key=lambda param: param[0])
+    return "&".join(param for _, param in params)
+
+
+def canonical_web(identifier):
+    parts = urlsplit(identifier)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").rstrip(".")
+    if not host or len(host) > HOST_MAX_LENGTH:
+        return None
+    port = parts.port
+    netloc = f"[{host}]" if ":" in host else host
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        netloc = f"{netloc}:{port}"
+    path = parts.path or "/"
+    if len(path) > 1:
+        path = path.rstrip("/") or "/"
+    fragment = parts.fragment if parts.fragment.startswith(("/", "!")) else ""
+    return (
+        urlunsplit((scheme, netloc, path, canonical_query(parts.query), fragment)),
+        {"context_type": "WEB", "host": host, "site": registrable_domain(host), "path": path[:PATH_MAX_LENGTH]},
+    )
+
+
+def canonicalize(identifier):
+    """Returns (canonical identifier, AnnotationContext fields derived from it)."""
+    identifier = (identifier or "").strip()
+    scheme = identifier.split(":", 1)[0].lower() if ":" in identifier else ""
+    if scheme in WEB_SCHEMES:
+        try:
+            canonical = canonical_web(identifier)
+        except ValueError:
+            canonical = None
+        if canonical is not None:
+            return canonical
+    return identifier, {"context_type": "DOC" if scheme == "file" else "APP", "host": "", "site": "", "path": ""}
+
+
+def merge_contexts(AnnotationContext, Annotation, alias, keep_id, extra_ids):
+    """
+    Moves the notes of `extra_ids` after those of `keep_id`, except the ones
+    identical to a live note it holds, and deletes the extra contexts.
+    """
+    for extra_id in extra_ids:
+        offset = Annotation.objects.using(alias).filter(context_id=keep_id).aggregate(top=Max("order"))["top"]
+        Annotation.objects.using(alias).filter(context_id=extra_id).exclude(
+            content_hash__in=Annotation.objects.using(alias)
+            .filter(context_id=keep_id, deleted_at__isnull=True)
+            .exclude(content_hash="")
+            .values("content_hash")
+        ).update(context_id=keep_id, order=F("order") + (offset + 1 if offset is not None else 0))
+    AnnotationContext.objects.using(alias).filter(id__in=extra_ids).delete()
+
+
+def canonicalize_user(AnnotationContext, Annotation, alias, contexts):
+    """Canonicalizes one user's (id, identifier, deleted_at) `contexts`, merging those that collide."""
+    groups, fields_of = {}, {}
+    for context in contexts:
+        canonical, fields_of[context[0]] = canonicalize(context[1])
+        groups.setdefault(canonical, []).append(context)
+
+    updated = []
+    for canonical, group in groups.items():
+        # The oldest live context is kept, or the oldest one if all are deleted
+        keep = min(group, key=lambda context: (context[2] is not None, context[0]))
+        extras = [context for context in group if context is not keep]
+        if extras:
+            for context_id, _, deleted_at in extras:
+                if deleted_at is not None:
+                    # Notes of a deleted context stay deleted once moved to a live one
+                    Annotation.objects.using(alias).filter(context_id=context_id, deleted_at__isnull=True).update(
+                        deleted_at=deleted_at
+                    )
+            merge_contexts(AnnotationContext, Annotation, alias, keep[0], [context[0] for context in extras])
+            # Clients that saw one of the merged contexts must reload before overwriting it
+            AnnotationContext.objects.using(alias).filter(id=keep[0]).update(version=F("version") + 1)
+        updated.append(AnnotationContext(id=keep[0], identifier=canonical, **fields_of[keep[0]]))
+    AnnotationContext.objects.using(alias).bulk_update(
+        updated, ["identifier", "context_type", "host", "site", "path"], batch_size=500
+    )
+
+
+def canonicalize_identifiers(apps, schema_editor):
+    """
+    Rewrites every identifier to its canonical form and fills in the fields
+    parsed from it. Contexts of a user whose identifiers become equal are
+    merged into the oldest live one, dropping notes it already holds.
+    """
+    AnnotationContext = apps.get_model("annotations", "AnnotationContext")
+    Annotation = apps.get_model("annotations", "Annotation")
+    alias = schema_editor.connection.alias
+    contexts = AnnotationContext.objects.using(alias)
+    for user_id in list(contexts.order_by("user_id").values_list("user_id", flat=True).distinct()):
+        canonicalize_user(
+            AnnotationContext,
+            Annotation,
+            alias,
+            list(contexts.filter(user_id=user_id).order_by("id").values_list("id", "identifier", "deleted_at")),
+        )
+
+
+class Migration(migrations.Migration):
+    """
+    The data migration runs last: merging moves notes between contexts, and
+    PostgreSQL refuses to alter a table with deferred foreign key checks
+    pending in the same transaction.
+    """
+
+    dependencies = [
+        ("annotations", "0014_annotation_content_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="annotationcontext",
+            name="host",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+        migrations.AddField(
+            model_name="annotationcontext",
+            name="path",
+            field=models.CharField(blank=True, default="", max_length=1024),
+        ),
+        migrations.AddField(
+            model_name="annotationcontext",
+            name="site",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name="annotationcontext",
+            index=models.Index(fields=["user", "site", "host", "path"], name="context_user_site_idx"),
+        ),
+        migrations.RunPython(canonicalize_identifiers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 21:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("annotations", "0015_canonical_identifiers"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="changecounter",
+            name="purged_seq",
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-18 22:40
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("annotations", "0016_changecounter_purged_seq"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="annotationcontext",
+            name="annotation_context_user_identifier_uniq",
+        ),
+        migrations.AddConstraint(
+            model_name="annotationcontext",
+            constraint=models.UniqueConstraint(
+                models.F("user"),
+                django.db.models.functions.text.MD5("identifier"),
+                name="annotation_context_user_identifier_uniq",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="annotationcontext",
+            index=django.contrib.postgres.indexes.HashIndex(
+                fields=["identifier"], name="context_identifier_hash_idx"
+            ),
+        ),
+    ]
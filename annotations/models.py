@@ -1,11 +1,71 @@
-from django.db import models
+import hashlib
+import secrets
+
+from django.contrib.postgres.indexes import GinIndex, HashIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.conf import settings
+from django.db import connections, models, router
+from django.db.models import F, Q
+from django.db.models.functions import MD5
 from django.contrib.auth.models import User
+from django.core.files.storage import storages
+
+from .identifiers import PATH_MAX_LENGTH, canonicalize
 
 # Create your models here.
+def annotation_image_storage():
+    return storages[getattr(settings, 'OVERNOTE_IMAGE_STORAGE', 'annotation_images')]
+
+
+class AnnotationContextManager(models.Manager):
+    """
+    Hides deleted (tombstoned) contexts. Use AnnotationContext.all_objects to
+    include them.
+    """
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+    def get_or_create_live(self, user, identifier):
+        """
+        get_or_create for writers. A deleted context with the same identifier is
+        revived instead of colliding with the unique constraint; its old notes
+        stay deleted. `identifier` must be canonical (see annotations.identifiers);
+        a new context gets its type, host, site and path from it. Call inside a
+        transaction.
+        """
+        context, created = AnnotationContext.all_objects.get_or_create(
+            user=user,
+            identifier=identifier,
+            # A callable, so a number is only allocated when the context is created
+            defaults={**canonicalize(identifier).fields(), "change_seq": lambda: ChangeCounter.next_seq(user.pk)},
+        )
+        if context.deleted_at is not None:
+            change_seq = ChangeCounter.next_seq(context.user_id)
+            # Only notes from before the deletion, so a concurrent revive cannot
+            # tombstone notes written after the first one.
+            Annotation.all_objects.filter(
+                context=context, deleted_at__isnull=True, created_at__lte=context.deleted_at
+            ).update(deleted_at=context.deleted_at, change_seq=change_seq)
+            AnnotationContext.all_objects.filter(id=context.id).update(deleted_at=None, change_seq=change_seq)
+            context.deleted_at, context.change_seq = None, change_seq
+        return context, created
+
+
+class AnnotationManager(models.Manager):
+    """Hides deleted notes and the notes of deleted contexts."""
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True, context__deleted_at__isnull=True)
+
+
 class AnnotationContext(models.Model):
     """
     Stores the context where the annotation is applied.
     Example: Webpage URL, App window, or Document metadata.
+
+    Contexts and their notes belong to one user, and every query filters on
+    user_id first, so a user's reads stay within their range of the user-led
+    indexes (and within one partition if the tables are hash-partitioned by
+    user_id).
     """
     CONTEXT_TYPES = [
         ('WEB', 'Webpage'),
@@ -13,9 +73,46 @@ class AnnotationContext(models.Model):
         ('DOC', 'Document')
     ]
     
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="annotation_contexts")  # Owner
     context_type = models.CharField(max_length=10, choices=CONTEXT_TYPES)
-    identifier = models.TextField()  # e.g., URL, App name, or unique document ID
+    identifier = models.TextField()  # e.g., URL, App name, or unique document ID; canonical, see annotations.identifiers
+    # Parsed from the identifier of WEB contexts for the per-site lookups, see annotations.identifiers
+    host = models.CharField(max_length=255, blank=True, default='')
+    site = models.CharField(max_length=255, blank=True, default='')
+    path = models.CharField(max_length=PATH_MAX_LENGTH, blank=True, default='')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Cached page title for WEB contexts, see annotations.titles
+    title = models.TextField(blank=True, default='')
+    title_fetched_at = models.DateTimeField(null=True, blank=True)
+    title_fetch_failed = models.BooleanField(default=False)
+    # Set instead of deleting the row; purged later by `manage.py purge_tombstones`
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    # Sequence number of the last change to this row, see annotations.changes
+    change_seq = models.BigIntegerField(default=0)
+    # Bumped by every change to the context's text notes; clients pass the version
+    # they last saw to update_all_notes, which refuses to overwrite newer notes.
+    version = models.PositiveIntegerField(default=0)
+
+    objects = AnnotationContextManager()
+    all_objects = models.Manager()
+    
+    class Meta:
+        constraints = [
+            # Stops concurrent get_or_create calls from creating duplicates. On the
+            # MD5 of the identifier, as URLs can be longer than a btree entry may be.
+            models.UniqueConstraint(F('user'), MD5('identifier'), name='annotation_context_user_identifier_uniq'),
+        ]
+        indexes = [
+            # The identifier lookups of get_notes/update_all_notes; a hash index
+            # has no limit on the key size (a plain index on SQLite)
+            HashIndex(fields=['identifier'], name='context_identifier_hash_idx'),
+            # get_all_notes keyset pagination and the change feed
+            models.Index(fields=['user', 'id'], name='context_user_id_idx'),
+            models.Index(fields=['user', 'change_seq'], name='context_user_change_seq_idx'),
+            # /api/notes/site: a site, and a host within it, are ranges of it
+            models.Index(fields=['user', 'site', 'host', 'path'], name='context_user_site_idx'),
+            models.Index(fields=['deleted_at'], condition=Q(deleted_at__isnull=False), name='context_tombstone_idx'),
+        ]
     
     def __str__(self):
         return f"{self.context_type} - {self.identifier}"
@@ -29,17 +126,127 @@ class Annotation(models.Model):
         ('DRAW', 'Drawing'),
         ('IMG', 'Image'),
     ]
+    # Notes that are not part of the text note list synced by update_all_notes
+    MEDIA_TYPES = ['DRAW', 'IMG']
     
     annotation_type = models.CharField(max_length=10, choices=ANNOTATION_TYPES)
     content = models.TextField(blank=True, null=True)
-    image = models.ImageField(upload_to='annotations/', blank=True, null=True) # For image annotations
+    content_hash = models.CharField(max_length=64, blank=True, default='')  # SHA-256 of a text note's content, see annotations.sanitize
+    image = models.ImageField(upload_to='annotations/', storage=annotation_image_storage, blank=True, null=True) # For image annotations
+    image_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)  # SHA-256 of the original
+    image_variants = models.JSONField(default=dict, blank=True)  # Variant name -> storage name, see annotations.images
+    strokes = models.BinaryField(null=True, blank=True)  # Packed stroke data of drawings, see annotations.drawing
     position = models.JSONField(null=True, blank=True) # Store position/coordinates (e.g., {'x': 100, 'y': 200})
     context = models.ForeignKey(AnnotationContext, on_delete=models.CASCADE, related_name="annotation")
-    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)  # Optional user association
+    user = models.ForeignKey(User, on_delete=models.CASCADE)  # Owner, always the context's; lets note queries filter on user_id
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     order = models.IntegerField(default=0)
     metadata = models.JSONField(blank=True, null=True)  # Optional metadata (e.g., tags, timestamp)
+    # Full-text index of the HTML-stripped content, maintained by annotations.search (PostgreSQL only)
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+    # Set instead of deleting the row; purged later by `manage.py purge_tombstones`
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    # Sequence number of the last change to this row, see annotations.changes
+    change_seq = models.BigIntegerField(default=0)
+
+    objects = AnnotationManager()
+    all_objects = models.Manager()
     
+    class Meta:
+        indexes = [
+            # Serves the per-context order_by('order') reads
+            models.Index(fields=['user', 'context', 'order'], name='annotation_user_context_idx'),
+            models.Index(fields=['user', 'change_seq'], name='annotation_user_change_seq_idx'),
+            GinIndex(fields=['search_vector'], name='annotation_search_vector_idx'),
+            models.Index(fields=['deleted_at'], condition=Q(deleted_at__isnull=False), name='annotation_tombstone_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.annotation_type} - {self.context.identifier}"
+
+class SearchToken(models.Model):
+    """
+    Inverted index entry used for search on databases without PostgreSQL
+    full-text search (e.g. SQLite in tests). One row per distinct word of a note.
+    """
+    token = models.CharField(max_length=64)
+    annotation = models.ForeignKey(Annotation, on_delete=models.CASCADE, related_name="search_tokens")
+    weight = models.PositiveIntegerField(default=1)  # Occurrences of the word in the note
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['token', 'annotation'], name='search_token_lookup_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.token} - {self.annotation_id}"
+
+
+class ChangeCounter(models.Model):
+    """
+    Last change sequence number handed out in a scope, one scope per user.
+    Every write stamps the rows it touches with a fresh number, which the
+    change feed (annotations.changes) uses as its cursor. `purged_seq` is the
+    highest number among the scope's rows purged so far: cursors below it may
+    have missed a deletion.
+    """
+    scope = models.CharField(max_length=64, unique=True)
+    value = models.BigIntegerField(default=0)
+    purged_seq = models.BigIntegerField(default=0)
+
+    @staticmethod
+    def scope_for(user_id):
+        return f'user:{user_id}'
+
+    @classmethod
+    def next_seq(cls, user_id):
+        """
+        Allocates the next number of `user_id`'s scope. Must be called inside the write's
+        transaction: the counter row stays locked until it commits, so numbers
+        become visible in the order they were handed out and a reader can never
+        skip over a change that commits late.
+        """
+        scope = cls.scope_for(user_id)
+        connection = connections[router.db_for_write(cls)]
+        if connection.vendor in ('postgresql', 'sqlite'):
+            # One round trip: the upsert creates a user's row on first use, takes
+            # the row lock and returns the value
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {cls._meta.db_table} (scope, value, purged_seq) VALUES (%s, 1, 0) '
+                    f'ON CONFLICT (scope) DO UPDATE SET value = {cls._meta.db_table}.value + 1 RETURNING value',
+                    [scope],
+                )
+                return cursor.fetchone()[0]
+        counter, _ = cls.objects.select_for_update().get_or_create(scope=scope)
+        counter.value += 1
+        counter.save(update_fields=['value'])
+        return counter.value
+
     def __str__(self):
-        return f"{self.annotation_type} - {self.context.identifier}"
\ No newline at end of file
+        return f"{self.scope} - {self.value}"
+
+
+class ApiToken(models.Model):
+    """
+    Bearer token for API clients, see annotations.auth. Only a SHA-256 of the
+    token is stored.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="api_tokens")
+    key_hash = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=100, blank=True, default='')  # e.g. the device it was issued to
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def issue(cls, user, name=''):
+        """Creates a token for `user` and returns (token row, raw token); the raw token is not stored."""
+        raw = secrets.token_urlsafe(32)
+        return cls.objects.create(user=user, key_hash=hash_token(raw), name=name), raw
+
+    def __str__(self):
+        return f"{self.user} - {self.name or self.key_hash[:8]}"
+
+
+def hash_token(raw):
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
@@ -0,0 +1,130 @@
+"""
+Read-replica routing.
+
+When OVERNOTE_READ_REPLICAS lists database aliases, views wrapped in
+`replica_reads` (get_notes, get_notes_batch, get_all_notes) run their reads
+against a randomly chosen replica; everything else, and every write, uses the
+primary. Replicas lag behind the primary, so a user who just wrote is pinned
+to the primary for OVERNOTE_REPLICA_PIN_SECONDS (see ReplicaPinMiddleware):
+otherwise get_notes could read, and cache, the notes from before their save.
+"""
+import random
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+READ_REPLICAS = tuple(getattr(settings, "OVERNOTE_READ_REPLICAS", ()))
+REPLICA_PIN_SECONDS = getattr(settings, "OVERNOTE_REPLICA_PIN_SECONDS", 5)
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class _ReplicaReads:
+    """Per-request choice of database, made on the first read."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.alias = None
+
+    def db_for_read(self):
+        if self.alias is None:
+            pinned = cache.get(_pin_key(self.user_id)) is not None
+            self.alias = DEFAULT_DB_ALIAS if pinned else random.choice(READ_REPLICAS)
+        return self.alias
+
+
+_replica_reads = ContextVar("overnote_replica_reads", default=None)
+
+
+def _pin_key(user_id):
+    return f"replica-pin:{user_id}"
+
+
+def pin_primary(user_id):
+    """Sends `user_id`'s reads to the primary until the replicas have caught up with their write."""
+    if not READ_REPLICAS:
+        return
+    cache.set(_pin_key(user_id), 1, REPLICA_PIN_SECONDS)
+    state = _replica_reads.get()
+    if state is not None and state.user_id == user_id:
+        state.alias = DEFAULT_DB_ALIAS
+
+
+def replica_reads(view):
+    """Lets the reads of `view` go to a replica. Put it below api_login_required."""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            token = _replica_reads.set(_ReplicaReads(request.user.pk) if READ_REPLICAS else None)
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                _replica_reads.reset(token)
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            token = _replica_reads.set(_ReplicaReads(request.user.pk) if READ_REPLICAS else None)
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                _replica_reads.reset(token)
+    return wrapper
+
+
+class ReplicaRouter:
+    """Database router for settings.DATABASE_ROUTERS; see the module docstring."""
+
+    def db_for_read(self, model, **hints):
+        state = _replica_reads.get()
+        return state.db_for_read() if state is not None else None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return False if db in READ_REPLICAS else None
+
+
+class ReplicaPinMiddleware:
+    """Pins users to the primary after a successful write request. Goes after the authentication middleware."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.get_response(request)
+        if self._is_write(request, response):
+            self._pin(request)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if self._is_write(request, response):
+            # May have to load a session user, which needs sync code
+            await sync_to_async(self._pin)(request)
+        return response
+
+    @staticmethod
+    def _is_write(request, response):
+        return request.method not in SAFE_METHODS and response.status_code < 400
+
+    @staticmethod
+    def _pin(request):
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            pin_primary(user.pk)
@@ -0,0 +1,285 @@
+"""
+Normalization of note HTML on write.
+
+Notes arrive as whatever markup the client's editor produced. `normalize_html`
+parses a note once and returns, from that single pass:
+
+- the HTML that gets stored: only ALLOWED_TAGS and ALLOWED_ATTRIBUTES
+  survive, plus the editor's classes and the inline styles of
+  ALLOWED_STYLE_PROPERTIES; images only with an https: or data:image source.
+  Script-like elements are dropped with their content, other tags are
+  unwrapped, and no-op markup is stripped (formatting around nothing, the
+  same formatting nested twice, attribute-less spans, blank paragraphs
+  before and after the content);
+- its plain text, which the search index is built from (the same text
+  annotations.search.html_to_text extracts);
+- a SHA-256 of the stored HTML, kept in Annotation.content_hash so sync can
+  tell unchanged notes apart without loading their content.
+
+A note without any text or image normalizes to "", which is how writers
+tell that a note is empty. Normalizing never fails: markup HTMLParser gives up
+on (a malformed "<![" declaration) is read the way browsers read it. Parse cost per KB is tracked by
+annotations.benchmarks.test_sanitize.
+"""
+import hashlib
+import re
+from html import escape
+from html.parser import HTMLParser
+from typing import NamedTuple
+from urllib.parse import urlsplit
+
+ALLOWED_TAGS = {
+    "p", "div", "br", "hr", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "code",
+    "ul", "ol", "li", "a", "span", "strong", "em", "u", "s", "sub", "sup", "img",
+}
+ALLOWED_ATTRIBUTES = {
+    "a": {"href", "title", "target"},
+    "li": {"data-list"},
+    "img": {"src", "alt", "width", "height"},
+}
+# Formatting classes of the editor (e.g. ql-align-center, ql-indent-1) are kept on any allowed tag
+ALLOWED_CLASS_RE = re.compile(r"^ql-[\w-]+$")
+ALLOWED_URL_SCHEMES = {"", "http", "https", "mailto"}
+# Inline styles the editor writes (colors, fonts, alignment) are kept on any allowed tag
+ALLOWED_STYLE_PROPERTIES = {"color", "background-color", "text-align", "font-family", "font-size", "direction"}
+# Keywords, colors, lengths and font names; the only functions are color functions, so no url() or expression()
+ALLOWED_STYLE_VALUE_RE = re.compile(r"""^[\w\s#%.,'"()+-]+$""")
+ALLOWED_STYLE_FUNCTIONS = {"rgb", "rgba", "hsl", "hsla"}
+STYLE_FUNCTION_RE = re.compile(r"([\w-]*)\s*\(")
+# Image sources: https URLs and inline raster images, as pasted into the editor
+IMAGE_DATA_URL_RE = re.compile(r"^data:image/(png|gif|jpeg|webp);base64,[A-Za-z0-9+/=\s]+$")
+
+# Stored under their usual name
+TAG_ALIASES = {"b": "strong", "i": "em", "strike": "s", "del": "s", "ins": "u"}
+# Dropped together with everything inside them
+DROP_CONTENT_TAGS = {
+    "script", "style", "template", "iframe", "object", "embed", "noscript", "textarea",
+    "select", "svg", "math", "head", "title",
+}
+VOID_TAGS = {"br", "hr", "img", "input", "meta", "link", "area", "base", "col", "embed", "source", "track", "wbr"}
+INLINE_TAGS = {"a", "span", "strong", "em", "u", "s", "sub", "sup", "code"}
+# No-ops when nested in themselves
+NESTED_NOOP_TAGS = {"strong", "em", "u", "s", "code"}
+# No-ops without attributes
+ATTRIBUTE_BOUND_TAGS = {"a", "span"}
+# Opening one of these closes an open paragraph, as in a browser
+PARAGRAPH_CLOSERS = {"p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "ul", "ol", "hr"}
+# Separate words in the plain text; matches annotations.search
+TEXT_BLOCK_TAGS = {
+    "p", "div", "br", "li", "ul", "ol", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "tr",
+}
+
+
+class NormalizedHtml(NamedTuple):
+    html: str
+    text: str
+    hash: str
+
+
+def content_hash(html):
+    return hashlib.sha256((html or "").encode("utf-8")).hexdigest()
+
+
+class _Element:
+    __slots__ = ("tag", "attrs", "children")
+
+    def __init__(self, tag, attrs):
+        self.tag = tag
+        self.attrs = attrs
+        self.children = []
+
+
+def _safe_url(url):
+    try:
+        return urlsplit(url.strip()).scheme.lower() in ALLOWED_URL_SCHEMES
+    except ValueError:
+        return False
+
+
+def _safe_image_src(src):
+    src = src.strip()
+    if IMAGE_DATA_URL_RE.match(src):
+        return True
+    try:
+        parts = urlsplit(src)
+    except ValueError:
+        return False
+    return parts.scheme.lower() == "https" and bool(parts.netloc)
+
+
+def _allowed_style(value):
+    """The declarations of a style attribute that are kept, as "property: value; ..." or ""."""
+    declarations = []
+    for declaration in value.split(";"):
+        name, _, style_value = declaration.partition(":")
+        name, style_value = name.strip().lower(), style_value.strip()
+        if (
+            name in ALLOWED_STYLE_PROPERTIES
+            and style_value
+            and ALLOWED_STYLE_VALUE_RE.match(style_value)
+            and all(function.lower() in ALLOWED_STYLE_FUNCTIONS for function in STYLE_FUNCTION_RE.findall(style_value))
+        ):
+            declarations.append(f"{name}: {style_value}")
+    return "; ".join(declarations)
+
+
+def _allowed_attrs(tag, attrs):
+    allowed = ALLOWED_ATTRIBUTES.get(tag, ())
+    kept = []
+    for name, value in attrs:
+        if value is None:
+            continue
+        if name == "class":
+            classes = " ".join(c for c in value.split() if ALLOWED_CLASS_RE.match(c))
+            if classes:
+                kept.append((name, classes))
+        elif name == "style":
+            style = _allowed_style(value)
+            if style:
+                kept.append((name, style))
+        elif name == "href":
+            if name in allowed and _safe_url(value):
+                kept.append((name, value))
+        elif name == "src":
+            if name in allowed and _safe_image_src(value):
+                kept.append((name, value.strip()))
+        elif name in allowed:
+            kept.append((name, value))
+    if tag == "a" and any(name == "target" for name, _ in kept):
+        kept.append(("rel", "noopener noreferrer"))
+    return kept
+
+
+class _TreeBuilder(HTMLParser):
+    """Builds a tree of the allowed elements; everything else is unwrapped or dropped."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root = _Element(None, [])
+        self.stack = [self.root]
+        # Depth inside a dropped element, whose content is ignored
+        self.dropping = 0
+
+    def parse_html_declaration(self, i):
+        try:
+            return super().parse_html_declaration(i)
+        except AssertionError:
+            # A malformed "<!" or "<![" declaration, which HTMLParser gives up
+            # on; browsers read it as a bogus comment up to the next ">"
+            end = self.rawdata.find(">", i + 2)
+            return end + 1 if end >= 0 else -1
+
+    def handle_starttag(self, tag, attrs):
+        tag = TAG_ALIASES.get(tag, tag)
+        if tag in DROP_CONTENT_TAGS:
+            if tag not in VOID_TAGS:
+                self.dropping += 1
+            return
+        if self.dropping or tag not in ALLOWED_TAGS:
+            return
+        if tag in PARAGRAPH_CLOSERS:
+            self._close("p", stop_at={"li", "blockquote", "div"})
+        elif tag == "li":
+            self._close("li", stop_at={"ul", "ol"})
+        element = _Element(tag, _allowed_attrs(tag, attrs))
+        if tag == "img" and not any(name == "src" for name, _ in element.attrs):
+            return
+        self.stack[-1].children.append(element)
+        if tag not in VOID_TAGS:
+            self.stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        tag = TAG_ALIASES.get(tag, tag)
+        if tag not in VOID_TAGS and not self.dropping and tag in ALLOWED_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        tag = TAG_ALIASES.get(tag, tag)
+        if tag in DROP_CONTENT_TAGS:
+            if tag not in VOID_TAGS and self.dropping:
+                self.dropping -= 1
+            return
+        if self.dropping or tag not in ALLOWED_TAGS or tag in VOID_TAGS:
+            return
+        self._close(tag)
+
+    def _close(self, tag, stop_at=()):
+        """Closes the innermost open `tag` and what was opened inside it; stray end tags are ignored."""
+        for depth in range(len(self.stack) - 1, 0, -1):
+            open_tag = self.stack[depth].tag
+            if open_tag == tag:
+                del self.stack[depth:]
+                return
+            if open_tag in stop_at:
+                return
+
+    def handle_data(self, data):
+        if not self.dropping:
+            self.stack[-1].children.append(data)
+
+
+def _render(node, html, text, formatting):
+    """
+    Appends the markup and plain text of `node`'s children to `html` and
+    `text`. `formatting` holds the formatting tags already in effect around
+    them. Returns whether the children hold any text or image.
+    """
+    has_text = False
+    for child in node.children:
+        if isinstance(child, str):
+            html.append(escape(child, quote=False))
+            text.append(child)
+            has_text = has_text or not child.isspace()
+            continue
+
+        tag = child.tag
+        attrs = "".join(f' {name}="{escape(value)}"' for name, value in child.attrs)
+        if tag in VOID_TAGS:
+            html.append(f"<{tag}{attrs}>")
+            if tag in TEXT_BLOCK_TAGS:
+                text.append(" ")
+            has_text = has_text or tag == "img"
+            continue
+        if tag in formatting or (tag in ATTRIBUTE_BOUND_TAGS and not child.attrs):
+            # Formatting that is already in effect, or a span or link that does nothing
+            has_text = _render(child, html, text, formatting) or has_text
+            continue
+
+        start = len(html)
+        html.append(f"<{tag}{attrs}>")
+        if tag in TEXT_BLOCK_TAGS:
+            text.append(" ")
+        child_has_text = _render(child, html, text, formatting | {tag} if tag in NESTED_NOOP_TAGS else formatting)
+        if tag in INLINE_TAGS and not child_has_text:
+            # Formatting around nothing but whitespace or line breaks
+            del html[start]
+            continue
+        html.append(f"</{tag}>")
+        if tag in TEXT_BLOCK_TAGS:
+            text.append(" ")
+        has_text = has_text or child_has_text
+    return has_text
+
+
+def normalize_html(raw):
+    """Parses `raw` note HTML once and returns its NormalizedHtml; see the module docstring."""
+    builder = _TreeBuilder()
+    builder.feed(raw or "")
+    builder.close()
+
+    # (html, text, has text) of each top-level node
+    blocks = []
+    for child in builder.root.children:
+        block, html, text = _Element(None, []), [], []
+        block.children.append(child)
+        blocks.append((html, text, _render(block, html, text, frozenset())))
+    with_text = [i for i, block in enumerate(blocks) if block[2]]
+    if not with_text:
+        return NormalizedHtml("", "", content_hash(""))
+
+    # Blank lines before the first and after the last text are no-ops
+    blocks = blocks[with_text[0]:with_text[-1] + 1]
+    html = "".join(part for block in blocks for part in block[0]).strip()
+    text = " ".join("".join(part for block in blocks for part in block[1]).split())
+    return NormalizedHtml(html, text, content_hash(html))
@@ -0,0 +1,169 @@
+"""
+Full-text search over note content.
+
+On PostgreSQL every note carries a `search_vector` (backed by a GIN index)
+built from its HTML-stripped text. Other backends, e.g. SQLite in tests, use
+the SearchToken inverted index instead. Both are maintained incrementally:
+writers call `index_annotations` with the notes whose content they changed.
+Deleted notes are filtered out at query time until their rows, and with them
+the token rows, are purged.
+"""
+import re
+from collections import Counter
+from html.parser import HTMLParser
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connections
+from django.db.models import Count, F, Q, Sum, Value
+
+from .models import Annotation, SearchToken
+
+SEARCH_CONFIG = getattr(settings, "OVERNOTE_SEARCH_CONFIG", "simple")
+TOKEN_MAX_LENGTH = 64
+WORD_RE = re.compile(r"[^\W_]+")
+
+
+class _TextExtractor(HTMLParser):
+    BLOCK_TAGS = {"p", "div", "br", "li", "ul", "ol", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "tr"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.parts.append(" ")
+
+    def handle_endtag(self, tag):
+        if tag in self.BLOCK_TAGS:
+            self.parts.append(" ")
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+
+def html_to_text(html):
+    extractor = _TextExtractor()
+    extractor.feed(html or "")
+    extractor.close()
+    return " ".join("".join(extractor.parts).split())
+
+
+def tokenize(text):
+    return [word[:TOKEN_MAX_LENGTH] for word in WORD_RE.findall(text.lower())]
+
+
+def full_text_supported(using="default"):
+    return connections[using].vendor == "postgresql"
+
+
+def search_vector(content):
+    """
+    Expression computing the search vector of `content`. Can be assigned to
+    `Annotation.search_vector` before a save, bulk_create or bulk_update so the
+    vector is written in the same statement as the content.
+    """
+    return text_search_vector(html_to_text(content))
+
+
+def text_search_vector(text):
+    """search_vector() for a note whose plain text is known, e.g. from annotations.sanitize."""
+    return SearchVector(Value(text), config=SEARCH_CONFIG)
+
+
+def index_annotations(
+    annotations, annotation_model=Annotation, token_model=SearchToken, using="default", texts=None, created=()
+):
+    """
+    (Re)indexes `annotations`, which must already be saved. The model arguments
+    let migrations pass historical models. `texts`, the notes' plain text in
+    the same order, saves parsing their content again. `created` holds the ids
+    of notes that were just inserted and have no index entries to clear.
+    """
+    if texts is None:
+        texts = [None] * len(annotations)
+    indexed = [
+        (annotation, html_to_text(annotation.content) if text is None else text)
+        for annotation, text in zip(annotations, texts)
+        if annotation.pk is not None
+    ]
+    if not indexed:
+        return
+
+    if full_text_supported(using):
+        for annotation, text in indexed:
+            annotation.search_vector = text_search_vector(text)
+        annotation_model.objects.using(using).bulk_update([annotation for annotation, _ in indexed], ["search_vector"])
+        return
+
+    stale_ids = [annotation.pk for annotation, _ in indexed if annotation.pk not in created]
+    if stale_ids:
+        token_model.objects.using(using).filter(annotation_id__in=stale_ids).delete()
+    token_model.objects.using(using).bulk_create(
+        token_model(annotation_id=annotation.pk, token=token, weight=weight)
+        for annotation, text in indexed
+        for token, weight in Counter(tokenize(text)).items()
+    )
+
+
+def rebuild_index(annotation_model=Annotation, token_model=SearchToken, using="default", batch_size=1000):
+    """Indexes every note from scratch, in batches of `batch_size`."""
+    queryset = annotation_model.objects.using(using).only("id", "content").order_by("id")
+    last_id = 0
+    while True:
+        batch = list(queryset.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        index_annotations(batch, annotation_model, token_model, using)
+        last_id = batch[-1].id
+
+
+def search_notes(user, query, offset=0, limit=20, using="default"):
+    """
+    Returns up to `limit` (id, content, context identifier, rank) tuples for
+    `user`'s notes containing every word of `query`, where each word also matches as a
+    prefix. Ordered by rank, best first.
+    """
+    terms = tokenize(query)
+    if not terms:
+        return []
+
+    if full_text_supported(using):
+        search_query = SearchQuery(
+            " & ".join(f"{term}:*" for term in terms), config=SEARCH_CONFIG, search_type="raw"
+        )
+        return list(
+            Annotation.objects.using(using)
+            .filter(user=user, search_vector=search_query)
+            .annotate(rank=SearchRank(F("search_vector"), search_query))
+            .order_by("-rank", "id")
+            .values_list("id", "content", "context__identifier", "rank")[offset:offset + limit]
+        )
+
+    per_term = {f"matched_{i}": Count("id", filter=Q(token__startswith=term)) for i, term in enumerate(terms)}
+    matches = list(
+        SearchToken.objects.using(using)
+        .filter(Q.create([("token__startswith", term) for term in terms], connector=Q.OR))
+        .filter(
+            annotation__user=user,
+            annotation__deleted_at__isnull=True,
+            annotation__context__deleted_at__isnull=True,
+        )
+        .values("annotation_id")
+        .annotate(rank=Sum("weight"), **per_term)
+        .filter(**{f"{name}__gt": 0 for name in per_term})
+        .order_by("-rank", "annotation_id")
+        .values_list("annotation_id", "rank")[offset:offset + limit]
+    )
+    notes = {
+        annotation_id: (content, identifier)
+        for annotation_id, content, identifier in Annotation.objects.using(using)
+        .filter(id__in=[annotation_id for annotation_id, _ in matches])
+        .values_list("id", "content", "context__identifier")
+    }
+    return [
+        (annotation_id, *notes[annotation_id], float(rank))
+        for annotation_id, rank in matches
+        if annotation_id in notes
+    ]
@@ -0,0 +1,85 @@
+"""
+Response serialization for the annotations views.
+
+Bodies are encoded with orjson when it is installed (several times faster than
+the stdlib encoder on the HTML-heavy note payloads) and with `json` otherwise.
+Clients that send `Accept: application/msgpack` get MessagePack instead, if the
+`msgpack` package is installed. Compression is applied separately, by
+annotations.compression.CompressionMiddleware.
+"""
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+MSGPACK_ACCEPT_TYPES = (MSGPACK_CONTENT_TYPE, "application/x-msgpack")
+
+# Formats a response may be encoded in, used e.g. to key cached bodies
+CONTENT_TYPES = {"json": JSON_CONTENT_TYPE, "msgpack": MSGPACK_CONTENT_TYPE}
+FORMATS = tuple(CONTENT_TYPES)
+
+_django_default = DjangoJSONEncoder().default
+
+
+def dumps(data):
+    """Encodes `data` as JSON bytes. Handles the same types as DjangoJSONEncoder."""
+    if orjson is not None:
+        return orjson.dumps(data, default=_django_default)
+    return json.dumps(data, cls=DjangoJSONEncoder, separators=(",", ":")).encode("utf-8")
+
+
+def loads(body):
+    """Decodes a JSON request body. Raises json.JSONDecodeError (orjson's is a subclass)."""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def packb(data):
+    return msgpack.packb(data, default=_django_default, use_bin_type=True)
+
+
+def response_format(request):
+    """'msgpack' when the client asks for it and it is available, else 'json'."""
+    if msgpack is not None and request is not None:
+        accept = request.headers.get("Accept", "")
+        if any(content_type in accept for content_type in MSGPACK_ACCEPT_TYPES):
+            return "msgpack"
+    return "json"
+
+
+def encode(data, fmt="json"):
+    """Returns (body, content type) of `data` in format `fmt`."""
+    return (packb(data) if fmt == "msgpack" else dumps(data)), CONTENT_TYPES[fmt]
+
+
+def vary_on_format(response):
+    if msgpack is not None:
+        patch_vary_headers(response, ("Accept",))
+    return response
+
+
+class ApiResponse(HttpResponse):
+    """
+    Drop-in for JsonResponse(data, safe=False) that uses the fast encoder and,
+    given the request, honours a MessagePack Accept header.
+    """
+
+    def __init__(self, data, request=None, **kwargs):
+        body, content_type = encode(data, response_format(request))
+        kwargs.setdefault("content_type", content_type)
+        super().__init__(body, **kwargs)
+        vary_on_format(self)
@@ -0,0 +1,238 @@
+"""
+Incremental sync of a context's notes.
+
+The client always sends its full, ordered note list. Instead of deleting every
+stored row and recreating it, the list is diffed against what is stored and only
+the notes that were added, edited, moved or removed are written.
+
+Concurrent saves of one context (e.g. two open tabs) are serialized on the
+context row alone, and a client that says which version it last saw is told
+about a newer one instead of overwriting it; see `sync_context_notes`.
+"""
+from collections import defaultdict, deque
+from typing import NamedTuple
+
+from django.db import OperationalError, transaction
+from django.utils import timezone
+
+from .models import Annotation, AnnotationContext, ChangeCounter
+from .sanitize import normalize_html
+from .search import full_text_supported, index_annotations, text_search_vector
+
+
+class VersionConflict(Exception):
+    """The context changed since the client's version, or another save of it is in progress."""
+
+
+class InvalidNotes(Exception):
+    """The notes of a payload are not a list of HTML strings or {"id", "content"} objects."""
+
+
+class IncomingNote(NamedTuple):
+    order: int
+    id: int
+    content: str  # Normalized HTML, see annotations.sanitize
+    content_hash: str
+    text: str
+
+
+def _as_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize_notes(notes):
+    """
+    Turns the client payload into IncomingNotes, parsing each note's HTML once.
+
+    Notes may be plain HTML strings (what the extension sends today) or objects
+    of the form {"id": 12, "content": "<p>...</p>"}. Notes without any text are
+    dropped but still consume their position, so `order` is the index in the
+    client's list. Raises InvalidNotes for anything else.
+    """
+    if not isinstance(notes, list):
+        raise InvalidNotes("notes must be a list")
+    normalized = []
+    for idx, note in enumerate(notes):
+        if isinstance(note, dict):
+            note_id = _as_id(note.get("id"))
+            content = note.get("content") or ""
+        elif isinstance(note, str):
+            note_id, content = None, note
+        else:
+            raise InvalidNotes(f"Note {idx} must be a string or an object with id and content")
+        if not isinstance(content, str):
+            raise InvalidNotes(f"The content of note {idx} must be a string")
+        html, text, content_hash = normalize_html(content)
+        if html:
+            normalized.append(IncomingNote(idx, note_id, html, content_hash, text))
+    return normalized
+
+
+def sync_notes(annotation_context, incoming, change_seq=None):
+    """
+    Makes the stored notes of `annotation_context` match `incoming`, a
+    normalize_notes() result.
+
+    Incoming notes are matched to stored rows by id first and then by content
+    hash, so unchanged notes keep their row and id, and an identical note
+    moved elsewhere in the list is not rewritten. The stored hashes are
+    compared instead of the contents, which are never loaded. Everything runs
+    in a single transaction with at most one tombstoning UPDATE, two bulk
+    UPDATEs (edited and moved notes) and one bulk INSERT. Changed rows are
+    stamped with `change_seq`, or with a newly allocated number if none is
+    given.
+
+    Returns a summary of what changed together with the ids of the resulting
+    notes in client order.
+    """
+    # On PostgreSQL the search vector is written by the same INSERT/UPDATE as the
+    # content; elsewhere the token index is rebuilt after the writes.
+    inline_search = full_text_supported()
+
+    # Joins the caller's transaction if there is one: a savepoint would only add
+    # two round trips, as any error aborts the caller's write as well
+    with transaction.atomic(savepoint=False):
+        existing = list(
+            # Image and drawing notes are not part of the text list clients send.
+            Annotation.objects.filter(context=annotation_context)
+            .exclude(annotation_type__in=Annotation.MEDIA_TYPES)
+            .only("id", "order", "content_hash")
+            .order_by("order", "id")
+        )
+        by_id = {annotation.id: annotation for annotation in existing}
+        by_hash = defaultdict(deque)
+        for annotation in existing:
+            by_hash[annotation.content_hash].append(annotation)
+
+        claimed = set()
+        matches = [None] * len(incoming)
+
+        # Stable ids win over content so an edited note keeps its row.
+        for i, note in enumerate(incoming):
+            annotation = by_id.get(note.id)
+            if annotation is not None and annotation.id not in claimed:
+                matches[i] = annotation
+                claimed.add(annotation.id)
+
+        for i, note in enumerate(incoming):
+            if matches[i] is not None:
+                continue
+            candidates = by_hash.get(note.content_hash)
+            while candidates:
+                annotation = candidates.popleft()
+                if annotation.id not in claimed:
+                    matches[i] = annotation
+                    claimed.add(annotation.id)
+                    break
+
+        now = timezone.now()
+        to_create, to_edit, to_move, to_index, index_texts = [], [], [], [], []
+        summary = {"created": 0, "updated": 0, "reordered": 0, "deleted": 0, "unchanged": 0}
+
+        for i, note in enumerate(incoming):
+            annotation = matches[i]
+            if annotation is None:
+                annotation = Annotation(
+                    annotation_type="TEXT",
+                    content=note.content,
+                    content_hash=note.content_hash,
+                    context=annotation_context,
+                    user_id=annotation_context.user_id,
+                    order=note.order,
+                )
+                if inline_search:
+                    annotation.search_vector = text_search_vector(note.text)
+                matches[i] = annotation
+                to_create.append(annotation)
+                to_index.append(annotation)
+                index_texts.append(note.text)
+                summary["created"] += 1
+            elif annotation.content_hash != note.content_hash:
+                annotation.content = note.content
+                annotation.content_hash = note.content_hash
+                annotation.order = note.order
+                annotation.updated_at = now
+                if inline_search:
+                    annotation.search_vector = text_search_vector(note.text)
+                to_edit.append(annotation)
+                to_index.append(annotation)
+                index_texts.append(note.text)
+                summary["updated"] += 1
+            elif annotation.order != note.order:
+                annotation.order = note.order
+                annotation.updated_at = now
+                to_move.append(annotation)
+                summary["reordered"] += 1
+            else:
+                summary["unchanged"] += 1
+
+        stale_ids = [annotation.id for annotation in existing if annotation.id not in claimed]
+        if not (stale_ids or to_edit or to_move or to_create):
+            summary["ids"] = [annotation.id for annotation in matches]
+            return summary
+
+        # Only writes that change something take the change counter lock
+        change_seq = change_seq or ChangeCounter.next_seq(annotation_context.user_id)
+        for annotation in to_create + to_edit + to_move:
+            annotation.change_seq = change_seq
+        if stale_ids:
+            Annotation.objects.filter(id__in=stale_ids).update(deleted_at=now, change_seq=change_seq)
+            summary["deleted"] = len(stale_ids)
+        if to_edit:
+            fields = ["content", "content_hash", "order", "updated_at", "change_seq"]
+            if inline_search:
+                fields.append("search_vector")
+            Annotation.objects.bulk_update(to_edit, fields)
+        if to_move:
+            Annotation.objects.bulk_update(to_move, ["order", "updated_at", "change_seq"])
+        if to_create:
+            Annotation.objects.bulk_create(to_create)
+        if not inline_search:
+            index_annotations(to_index, texts=index_texts, created={annotation.id for annotation in to_create})
+
+    summary["ids"] = [annotation.id for annotation in matches]
+    return summary
+
+
+def lock_context(user, identifier):
+    """
+    Returns `user`'s live context `identifier` locked for update, or None if
+    there is none. Only that row is locked, and without waiting: a context
+    another request is saving raises VersionConflict straight away. Call
+    inside a transaction.
+    """
+    try:
+        return AnnotationContext.objects.select_for_update(nowait=True).get(user=user, identifier=identifier)
+    except AnnotationContext.DoesNotExist:
+        return None
+    except OperationalError as e:
+        raise VersionConflict("The context is being saved by another request.") from e
+
+
+def sync_context_notes(user, identifier, notes, expected_version=None):
+    """
+    Creates `user`'s context if needed and syncs its notes (a normalize_notes()
+    result), all in one transaction. With `expected_version`, raises VersionConflict unless that
+    is still the context's version. Returns (summary, version after the sync).
+    """
+    with transaction.atomic():
+        annotation_context, created = lock_context(user, identifier), False
+        if annotation_context is None:
+            annotation_context, created = AnnotationContext.objects.get_or_create_live(user, identifier)
+            if not created:
+                # Revived, or created by a concurrent request
+                annotation_context = lock_context(user, identifier)
+
+        version = annotation_context.version
+        if expected_version is not None and expected_version != version:
+            raise VersionConflict(f"The context is at version {version}, not {expected_version}.")
+
+        # A new context was just stamped; its notes share the number
+        summary = sync_notes(annotation_context, notes, annotation_context.change_seq if created else None)
+        if summary["created"] or summary["updated"] or summary["reordered"] or summary["deleted"]:
+            version += 1
+            AnnotationContext.objects.filter(id=annotation_context.id).update(version=version)
+        return summary, version
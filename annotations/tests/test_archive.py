@@ -0,0 +1,172 @@
+import base64
+import gzip
+import json
+import shutil
+import tempfile
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import AsyncClient, Client, TestCase, override_settings
+
+from annotations.archive import ArchiveError, aexport_archive, export_archive, import_archive
+from annotations.drawing import decode, encode
+from annotations.models import Annotation, ApiToken, annotation_image_storage
+from annotations.sanitize import normalize_html
+from annotations.search import search_notes
+
+CONTEXT = "https://example.com/page"
+STROKES = [[[0, 0], [10.5, 4], [20, 8]], [[5, 5], [6, 7]]]
+
+
+def archive_line(*notes, context=CONTEXT):
+    return json.dumps({"context": context, "notes": list(notes)})
+
+
+class ArchiveImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("restorer")
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        storages = override_settings(
+            STORAGES={
+                "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+                "annotation_images": {
+                    "BACKEND": "django.core.files.storage.FileSystemStorage",
+                    "OPTIONS": {"location": media},
+                },
+            }
+        )
+        storages.enable()
+        self.addCleanup(storages.disable)
+
+    def test_round_trip(self):
+        storage = annotation_image_storage()
+        image = storage.save("annotations/cat.png", ContentFile(b"png"))
+        thumbnail = storage.save("annotations/cat-320.webp", ContentFile(b"webp"))
+        strokes = base64.b64encode(encode(STROKES)).decode("ascii")
+        line = archive_line(
+            {"type": "TEXT", "content": "<p>hello</p>", "order": 0},
+            {"type": "DRAW", "strokes": strokes, "order": 1},
+            {"type": "IMG", "image": image, "image_hash": "ab", "image_variants": {"320": thumbnail}, "order": 2},
+        )
+        self.assertEqual(import_archive(self.user, [line]), (1, 3))
+        text, drawing, picture = Annotation.objects.filter(user=self.user).order_by("order")
+        self.assertEqual(text.content, "<p>hello</p>")
+        self.assertEqual(decode(bytes(drawing.strokes)), decode(encode(STROKES)))
+        self.assertEqual((picture.image.name, picture.image_variants), (image, {"320": thumbnail}))
+        # An export imports back as it is
+        exported = b"".join(export_archive(self.user)).splitlines()
+        self.assertEqual(import_archive(self.user, exported), (1, 3))
+
+    def test_bad_strokes_fail_the_line(self):
+        for strokes in (base64.b64encode(b"\x01\x02\xff").decode(), base64.b64encode(b"\x09").decode(), "not base64"):
+            with self.subTest(strokes=strokes), self.assertRaises(ArchiveError) as error:
+                import_archive(self.user, [archive_line({"type": "DRAW", "strokes": strokes})])
+            self.assertEqual(error.exception.line_number, 1)
+        self.assertFalse(Annotation.all_objects.filter(user=self.user).exists())
+
+    def test_images_must_be_stored(self):
+        for image in ("annotations/missing.png", "../../settings.py", "/etc/passwd", 5):
+            with self.subTest(image=image), self.assertRaises(ArchiveError):
+                import_archive(self.user, [archive_line({"type": "IMG", "image": image})])
+        with self.assertRaises(ArchiveError):
+            import_archive(self.user, [archive_line({"type": "IMG"})])
+        self.assertFalse(Annotation.all_objects.filter(user=self.user).exists())
+
+    def test_missing_variants_are_dropped(self):
+        image = annotation_image_storage().save("annotations/cat.png", ContentFile(b"png"))
+        variants = {"320": "annotations/gone.webp", "640": "../outside.webp"}
+        import_archive(self.user, [archive_line({"type": "IMG", "image": image, "image_variants": variants})])
+        self.assertEqual(Annotation.objects.get(user=self.user).image_variants, {})
+
+    def import_request(self, *lines):
+        _, token = ApiToken.issue(self.user, "test")
+        return Client(HTTP_AUTHORIZATION=f"Bearer {token}").post(
+            "/api/notes/import", "\n".join(lines), content_type="application/x-ndjson"
+        )
+
+    def test_malformed_markup_is_imported(self):
+        response = self.import_request(archive_line({"type": "TEXT", "content": "<p>x</p><![ a"}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Annotation.objects.get(user=self.user).content, "<p>x</p>&lt;![ a")
+
+    def test_parser_errors_fail_the_line(self):
+        def normalize(content):
+            if "two" in content:
+                raise AssertionError("expected name token")
+            return normalize_html(content)
+
+        with mock.patch("annotations.archive.normalize_html", side_effect=normalize):
+            response = self.import_request(
+                archive_line({"content": "<p>one</p>"}), archive_line({"content": "<p>two</p>"}, context="app:x")
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["line"], 2)
+
+
+class ArchiveExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("exporter")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+        import_archive(cls.user, [archive_line({"content": f"<p>{idx}</p>"}, context=f"app:{idx}") for idx in range(5)])
+        cls.expected = b"".join(export_archive(cls.user))
+
+    async def body(self, response):
+        return b"".join([chunk async for chunk in response.streaming_content])
+
+    async def test_async_export_reads_keyset_pages(self):
+        self.assertEqual(b"".join([line async for line in aexport_archive(self.user, chunk_size=2)]), self.expected)
+
+    async def test_streams_an_async_iterator_under_asgi(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        response = await AsyncClient().get("/api/notes/export", headers=headers)
+        self.assertTrue(response.is_async)
+        self.assertEqual(await self.body(response), self.expected)
+
+        response = await AsyncClient().get("/api/notes/export", {"gzip": "1"}, headers=headers)
+        self.assertTrue(response.is_async)
+        self.assertEqual(gzip.decompress(await self.body(response)), self.expected)
+
+
+@skipUnless(connection.vendor == "postgresql", "COPY import only runs on PostgreSQL")
+class PostgresCopyImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("copier")
+
+    def test_copy_writes_every_column_and_the_search_vector(self):
+        strokes = encode(STROKES)
+        lines = [
+            archive_line(
+                {
+                    "type": "TEXT",
+                    "content": "<p>Quarterly <b>revenue</b> report</p>",
+                    "order": 0,
+                    "position": {"x": 1},
+                    "metadata": {"color": "red"},
+                },
+                {"type": "DRAW", "strokes": base64.b64encode(strokes).decode("ascii"), "order": 1},
+            ),
+            archive_line({"type": "TEXT", "content": "<p>tab\tand\nnewline \\ backslash</p>"}, context="app:editor"),
+        ]
+        self.assertEqual(import_archive(self.user, lines), (2, 3))
+
+        text, drawing = Annotation.objects.filter(user=self.user, context__identifier=CONTEXT).order_by("order")
+        self.assertEqual((text.position, text.metadata), ({"x": 1}, {"color": "red"}))
+        self.assertEqual(bytes(drawing.strokes), strokes)
+        self.assertTrue(text.content_hash)
+        self.assertEqual(
+            Annotation.objects.get(user=self.user, context__identifier="app:editor").content,
+            "<p>tab\tand\nnewline \\ backslash</p>",
+        )
+        self.assertEqual([row[0] for row in search_notes(self.user, "revenue")], [text.id])
+        # The staging table is dropped with the batch
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('overnote_import_notes')")
+            self.assertIsNone(cursor.fetchone()[0])
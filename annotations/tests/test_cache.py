@@ -0,0 +1,137 @@
+import json
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import Client, TestCase
+
+from annotations import views
+from annotations.cache import ainvalidate_notes, get_cached_notes, invalidate_notes, set_cached_notes
+from annotations.models import Annotation, ApiToken
+from annotations.writebehind import WriteBehindBuffer
+
+CONTEXT = "https://example.com/page"
+
+
+class NotesCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("cached")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        self.update(["<p>one</p>", "<p>two</p>"])
+
+    def update(self, notes):
+        return self.client.put(
+            "/api/notes/update", json.dumps({"context": CONTEXT, "notes": notes}), content_type="application/json"
+        )
+
+    def notes(self):
+        return [note["content"] for note in self.client.get("/api/notes", {"context": CONTEXT}).json()]
+
+    def note(self, content):
+        return Annotation.objects.get(user=self.user, content=content)
+
+    def test_reads_are_served_from_the_cache(self):
+        self.notes()
+        # Changed behind the cache's back, so only a read from the database sees it
+        Annotation.objects.filter(user=self.user).update(content="<p>stale</p>")
+        self.assertEqual(self.notes(), ["<p>one</p>", "<p>two</p>"])
+
+    def test_not_modified(self):
+        etag = self.client.get("/api/notes", {"context": CONTEXT})["ETag"]
+        response = self.client.get("/api/notes", {"context": CONTEXT}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response["ETag"]), (304, etag))
+
+        self.update(["<p>one</p>"])
+        response = self.client.get("/api/notes", {"context": CONTEXT}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def assertInvalidatedBy(self, write, expected):
+        self.notes()
+        write()
+        self.assertEqual(self.notes(), expected)
+
+    def test_update_invalidates(self):
+        self.assertInvalidatedBy(lambda: self.update(["<p>three</p>"]), ["<p>three</p>"])
+
+    def test_save_invalidates(self):
+        self.assertInvalidatedBy(
+            lambda: self.client.post(
+                "/api/notes/save",
+                json.dumps({"context": CONTEXT, "notes": ["<p>three</p>"]}),
+                content_type="application/json",
+            ),
+            ["<p>three</p>"],
+        )
+
+    def test_delete_note_invalidates(self):
+        note = self.note("<p>one</p>")
+        self.assertInvalidatedBy(
+            lambda: self.client.delete(
+                "/api/notes/delete", json.dumps({"noteId": note.id}), content_type="application/json"
+            ),
+            ["<p>two</p>"],
+        )
+
+    def test_delete_context_invalidates(self):
+        self.assertInvalidatedBy(
+            lambda: self.client.delete(
+                "/api/notes/delete-context/", json.dumps({"context": CONTEXT}), content_type="application/json"
+            ),
+            [],
+        )
+
+    def test_import_invalidates(self):
+        # Restoring over a context replaces its notes
+        line = json.dumps({"context": CONTEXT, "notes": [{"content": "<p>imported</p>"}]})
+        self.assertInvalidatedBy(
+            lambda: self.client.post("/api/notes/import", line, content_type="application/x-ndjson"),
+            ["<p>imported</p>"],
+        )
+
+    def test_drawing_invalidates(self):
+        self.notes()
+        self.client.post(
+            "/api/notes/drawing",
+            json.dumps({"context": CONTEXT, "strokes": [[[0, 0], [5, 5]]]}),
+            content_type="application/json",
+        )
+        self.assertEqual(len(self.notes()), 3)
+
+    def test_write_behind_flush_invalidates(self):
+        buffer = WriteBehindBuffer(window=3600)
+        self.notes()
+        with mock.patch("annotations.views.get_write_behind", return_value=buffer):
+            self.assertEqual(self.update(["<p>buffered</p>"]).json()["status"], "accepted")
+        buffer.close()
+        self.assertEqual(self.notes(), ["<p>buffered</p>"])
+
+    def test_read_racing_a_write_is_not_cached(self):
+        read = views.context_notes
+
+        async def read_then_write(user, identifier):
+            result = await read(user, identifier)
+            # A writer commits and invalidates after the read, before its body is cached
+            await Annotation.objects.filter(user=user, content="<p>two</p>").aupdate(content="<p>new</p>")
+            await ainvalidate_notes(user.pk, identifier)
+            return result
+
+        with mock.patch.object(views, "context_notes", side_effect=read_then_write):
+            self.assertEqual(self.notes(), ["<p>one</p>", "<p>two</p>"])
+        self.assertEqual(self.notes(), ["<p>one</p>", "<p>new</p>"])
+
+    def test_set_after_invalidation_is_never_served(self):
+        cached, generation = get_cached_notes(self.user.pk, CONTEXT)
+        self.assertIsNone(cached)
+        invalidate_notes(self.user.pk, CONTEXT)
+        set_cached_notes(self.user.pk, CONTEXT, generation, b"[]")
+        self.assertIsNone(get_cached_notes(self.user.pk, CONTEXT)[0])
+
+        _, generation = get_cached_notes(self.user.pk, CONTEXT)
+        set_cached_notes(self.user.pk, CONTEXT, generation, b"[]")
+        self.assertEqual(get_cached_notes(self.user.pk, CONTEXT)[0][0], b"[]")
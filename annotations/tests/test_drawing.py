@@ -0,0 +1,63 @@
+import json
+
+from django.contrib.auth.models import User
+from django.test import Client, SimpleTestCase, TestCase
+
+from annotations.drawing import InvalidDrawing, decode, encode
+from annotations.models import ApiToken
+
+STROKES = [[[0, 0], [1.5, 2.25], [3, 4.5]], [[10, 10], [11, 12]]]
+
+
+class EncodeTests(SimpleTestCase):
+    def test_round_trip(self):
+        strokes = [[[0, 0], [1.5, 2.2], [3.1, 9.9]]]
+        self.assertEqual(decode(encode(strokes, tolerance=0)), strokes)
+
+    def test_rejects_bad_input(self):
+        cases = [
+            ([[[1e308, 0]]], {}),
+            ([[[float("inf"), 0]]], {}),
+            ([[[float("nan"), 0]]], {}),
+            ([[[True, 0]]], {}),
+            ([[["1", 0]]], {}),
+            ([[[0, 0], [1, 1], [2, 0]]], {"tolerance": "x"}),
+            ([[[0, 0], [1, 1], [2, 0]]], {"tolerance": float("nan")}),
+            ([[[0, 0]]], {"tolerance": -1}),
+            ([[[0, 0]]], {"scale": 0}),
+            ([[[0, 0]]], {"scale": 2.5}),
+        ]
+        for strokes, options in cases:
+            with self.subTest(strokes=strokes, options=options), self.assertRaises(InvalidDrawing):
+                encode(strokes, **options)
+
+
+class DrawingViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("drawer")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    def setUp(self):
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+
+    def post(self, body):
+        return self.client.post("/api/notes/drawing", json.dumps(body), content_type="application/json")
+
+    def test_bad_drawings_are_client_errors(self):
+        for body in (
+            {"context": "https://example.com/", "strokes": [[[1e308, 0]]]},
+            {"context": "https://example.com/", "strokes": [[[0, 0], [1, 1], [2, 0]]], "tolerance": "x"},
+            {"context": "https://example.com/", "strokes": STROKES, "order": "first"},
+            {"context": "https://example.com/", "strokes": STROKES, "order": [1]},
+        ):
+            with self.subTest(body=body):
+                self.assertEqual(self.post(body).status_code, 400)
+
+    def test_update_rejects_bad_drawings(self):
+        response = self.post({"context": "https://example.com/", "strokes": STROKES, "order": 3})
+        self.assertEqual(response.status_code, 201)
+        url = response.json()["drawing"]
+        response = self.client.put(url, json.dumps({"strokes": [[[1e308, 0]]]}), content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(url).json()["strokes"], decode(encode(STROKES)))
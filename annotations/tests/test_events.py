@@ -0,0 +1,48 @@
+import asyncio
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from annotations.events import BaseBroker, InProcessBroker, aemit, event_key
+
+
+class BlockingBroker(BaseBroker):
+    """Publishes synchronously, like RedisBroker, and records where it ran."""
+
+    def __init__(self):
+        self.events = []
+
+    def publish(self, key, event):
+        try:
+            asyncio.get_running_loop()
+            on_loop = True
+        except RuntimeError:
+            on_loop = False
+        self.events.append((key, event, on_loop))
+
+
+class AemitTests(SimpleTestCase):
+    async def test_sync_publish_runs_off_the_event_loop(self):
+        broker = BlockingBroker()
+        with mock.patch("annotations.events.get_broker", return_value=broker):
+            await aemit(1, "https://example.com/", "note.deleted", id=5)
+        event = {"type": "note.deleted", "context": "https://example.com/", "id": 5}
+        self.assertEqual(broker.events, [(event_key(1, "https://example.com/"), event, False)])
+
+    async def test_in_process_broker_delivers(self):
+        broker = InProcessBroker()
+        key = event_key(1, "https://example.com/")
+        events = broker.subscribe([key], timeout=1)
+        # The generator only subscribes once it is first awaited
+        next_event = asyncio.ensure_future(events.__anext__())
+        await asyncio.sleep(0)
+        with mock.patch("annotations.events.get_broker", return_value=broker):
+            await aemit(1, "https://example.com/", "notes.updated")
+        self.assertEqual(await next_event, {"type": "notes.updated", "context": "https://example.com/"})
+        await events.aclose()
+
+    async def test_publish_errors_are_logged(self):
+        broker = mock.Mock(apublish=mock.AsyncMock(side_effect=ConnectionError))
+        with mock.patch("annotations.events.get_broker", return_value=broker):
+            with self.assertLogs("annotations.events", "ERROR"):
+                await aemit(1, "https://example.com/", "notes.updated")
@@ -0,0 +1,89 @@
+import asyncio
+import json
+
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.test import AsyncClient, Client, TestCase
+
+from annotations.events import aemit
+from annotations.models import AnnotationContext, ApiToken
+
+PAGE = "https://example.com/page"
+VARIANTS = ["https://Example.com/page/?utm_source=feed", "https://example.com/page#section"]
+
+
+class CanonicalResponseTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("reader")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    def setUp(self):
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        self.client.put(
+            "/api/notes/update",
+            json.dumps({"context": VARIANTS[0], "notes": ["<p>one</p>"]}),
+            content_type="application/json",
+        )
+
+    def test_batch_is_keyed_by_canonical_identifiers(self):
+        response = self.client.post(
+            "/api/notes/batch",
+            json.dumps({"contexts": [*VARIANTS, "app:other"]}),
+            content_type="application/json",
+        ).json()
+        self.assertEqual(list(response["contexts"]), [PAGE, "app:other"])
+        self.assertEqual([note["context"] for note in response["contexts"][PAGE]], [PAGE])
+        self.assertEqual(response["contexts"]["app:other"], [])
+        self.assertEqual(response["requested"], {VARIANTS[0]: PAGE, VARIANTS[1]: PAGE, "app:other": "app:other"})
+
+    def test_notes_carry_the_canonical_identifier(self):
+        notes = self.client.get("/api/notes", {"context": VARIANTS[1]}).json()
+        self.assertEqual([note["context"] for note in notes], [PAGE])
+
+
+class LongIdentifierTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("oauth")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    def test_urls_longer_than_an_index_entry(self):
+        # Larger than a btree entry may be on PostgreSQL, and not compressible below it
+        url = f"{PAGE}?state=" + "".join(f"{idx:x}" for idx in range(3000))
+        client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        response = client.put(
+            "/api/notes/update", json.dumps({"context": url, "notes": ["<p>one</p>"]}), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        notes = client.get("/api/notes", {"context": url}).json()
+        self.assertEqual([note["content"] for note in notes], ["<p>one</p>"])
+
+    def test_identifiers_stay_unique_per_user(self):
+        url = f"{PAGE}?state=" + "x" * 10000
+        AnnotationContext.objects.create(user=self.user, identifier=url)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            AnnotationContext.objects.create(user=self.user, identifier=url)
+        AnnotationContext.objects.create(user=User.objects.create_user("other"), identifier=url)
+
+
+class CanonicalEventTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("listener")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    async def test_events_name_the_canonical_context(self):
+        response = await AsyncClient().get(
+            "/api/events", {"context": [*VARIANTS, "app:other"]}, headers={"Authorization": f"Bearer {self.token}"}
+        )
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b": connected\n\n")
+        next_chunk = asyncio.ensure_future(anext(chunks))
+        # Let the stream subscribe before publishing
+        await asyncio.sleep(0.05)
+        await aemit(self.user.pk, PAGE, "notes.updated")
+        chunk = await asyncio.wait_for(next_chunk, 5)
+        event = json.loads(chunk.decode().split("data: ", 1)[1])
+        self.assertEqual(event, {"type": "notes.updated", "context": PAGE, "requested": VARIANTS})
+        await chunks.aclose()
@@ -0,0 +1,151 @@
+import io
+import json
+import shutil
+import tempfile
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import Client, TestCase, override_settings
+from PIL import Image
+
+from annotations.images import IMAGE_VARIANTS, generate_variants
+from annotations.models import Annotation, ApiToken, annotation_image_storage
+
+CONTEXT = "https://example.com/page"
+
+
+def image_file(size=(800, 600), image_format="PNG", color="red", name="picture.png"):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, image_format)
+    buffer.seek(0)
+    buffer.name = name
+    return buffer
+
+
+class ImageUploadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("photographer")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        storages = override_settings(
+            STORAGES={
+                "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+                "annotation_images": {
+                    "BACKEND": "django.core.files.storage.FileSystemStorage",
+                    "OPTIONS": {"location": self.media, "base_url": "/media/annotations/"},
+                },
+            }
+        )
+        storages.enable()
+        self.addCleanup(storages.disable)
+
+    def upload(self, image, **fields):
+        # Variants are generated after commit by a worker thread, which the tests run by hand
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post("/api/notes/image", {"context": CONTEXT, "image": image, **fields})
+        self.assertEqual(len(callbacks), 1 if response.status_code == 201 else 0)
+        return response
+
+    def stored_files(self, prefix):
+        storage = annotation_image_storage()
+        directories, files = storage.listdir(prefix)
+        return files + [name for directory in directories for name in self.stored_files(f"{prefix}/{directory}")]
+
+    def test_upload(self):
+        response = self.upload(image_file(), order="3")
+        self.assertEqual(response.status_code, 201, response.content)
+        body = response.json()
+        annotation = Annotation.objects.get(id=body["id"])
+        self.assertEqual((annotation.annotation_type, annotation.order), ("IMG", 3))
+        self.assertEqual(len(annotation.image_hash), 64)
+        self.assertTrue(annotation.image.name.endswith(f"/{annotation.image_hash}.png"))
+        self.assertEqual(body["image"], {"original": f"/media/annotations/{annotation.image.name}"})
+
+        served = self.client.get(body["image"]["original"])
+        with annotation_image_storage().open(annotation.image.name) as original:
+            self.assertEqual(b"".join(served.streaming_content), original.read())
+        self.assertIn("immutable", served["Cache-Control"])
+
+    def test_identical_images_are_stored_once(self):
+        first = self.upload(image_file(name="a.png")).json()
+        second = self.upload(image_file(name="b.png")).json()
+        self.assertNotEqual(first["id"], second["id"])
+        self.assertEqual(first["image"], second["image"])
+        self.assertEqual(len(self.stored_files("originals")), 1)
+
+        self.upload(image_file(color="blue"))
+        self.assertEqual(len(self.stored_files("originals")), 2)
+
+    def test_variants(self):
+        annotation = Annotation.objects.get(id=self.upload(image_file(size=(2000, 1000))).json()["id"])
+        variants = generate_variants(annotation)
+        self.assertEqual(set(variants), set(IMAGE_VARIANTS))
+        storage = annotation_image_storage()
+        for variant_name, (max_side, image_format, _) in IMAGE_VARIANTS.items():
+            with self.subTest(variant=variant_name), Image.open(storage.open(variants[variant_name])) as image:
+                self.assertEqual((image.format, max(image.size)), (image_format, max_side))
+                self.assertEqual(image.size[0], 2 * image.size[1])
+
+        annotation.refresh_from_db()
+        self.assertEqual(annotation.image_variants, variants)
+        # Variants are content-addressed too, so generating them again reuses the stored files
+        self.assertEqual(generate_variants(annotation), variants)
+        self.assertEqual(len(self.stored_files("variants")), len(IMAGE_VARIANTS))
+
+    def test_process_images_command(self):
+        annotation_id = self.upload(image_file()).json()["id"]
+        call_command("process_images", stdout=io.StringIO())
+        self.assertEqual(set(Annotation.objects.get(id=annotation_id).image_variants), set(IMAGE_VARIANTS))
+
+    def test_variant_urls_in_get_notes(self):
+        self.client.put(
+            "/api/notes/update", json.dumps({"context": CONTEXT, "notes": ["<p>text</p>"]}),
+            content_type="application/json",
+        )
+        annotation_id = self.upload(image_file()).json()["id"]
+        notes = self.client.get("/api/notes", {"context": CONTEXT}).json()
+        self.assertEqual(list(notes[1]["image"]), ["original"])
+
+        variants = generate_variants(Annotation.objects.select_related("context").get(id=annotation_id))
+        image = self.client.get("/api/notes", {"context": CONTEXT}).json()[1]["image"]
+        self.assertEqual(image, {
+            "original": image["original"],
+            **{variant_name: f"/media/annotations/{name}" for variant_name, name in variants.items()},
+        })
+        # Text updates leave image notes alone
+        self.client.put(
+            "/api/notes/update", json.dumps({"context": CONTEXT, "notes": ["<p>edited</p>"]}),
+            content_type="application/json",
+        )
+        self.assertEqual(self.client.get("/api/notes", {"context": CONTEXT}).json()[1]["image"], image)
+
+    def test_rejected_uploads(self):
+        text = io.BytesIO(b"not an image at all")
+        text.name = "notes.txt"
+        bitmap = image_file(image_format="BMP", name="picture.bmp")
+        for image, error in ((text, "Not a valid image"), (bitmap, "Unsupported image format: BMP")):
+            with self.subTest(error=error):
+                response = self.upload(image)
+                self.assertEqual((response.status_code, response.json()["error"]), (400, error))
+
+        noise = io.BytesIO()
+        Image.effect_noise((200, 200), 100).save(noise, "PNG")
+        noise.seek(0)
+        noise.name = "noise.png"
+        with mock.patch("annotations.images.IMAGE_MAX_BYTES", 1024):
+            response = self.upload(noise)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("at most 1024 bytes", response.json()["error"])
+
+        self.assertEqual(self.client.post("/api/notes/image", {"context": CONTEXT}).status_code, 400)
+        self.assertEqual(self.upload(image_file(), order="first").status_code, 400)
+        self.assertFalse(Annotation.objects.filter(user=self.user).exists())
+        self.assertEqual(self.stored_files(""), [])
@@ -0,0 +1,65 @@
+import json
+
+from django.contrib.auth.models import User
+from django.test import AsyncClient, Client, TestCase, override_settings
+
+from annotations.instrumentation import registry
+from annotations.models import ApiToken
+
+CONTEXT = "https://example.com/page"
+
+
+def metric(name, view):
+    """The value of series `name` for `view` in the Prometheus export."""
+    prefix = f'{name}{{view="{view}"}} '
+    for line in registry.render_prometheus().splitlines():
+        if line.startswith(prefix):
+            return float(line[len(prefix):])
+    return None
+
+
+class MetricsAccessTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _, cls.token = ApiToken.issue(User.objects.create_user("reader"), "test")
+        _, cls.staff_token = ApiToken.issue(User.objects.create_user("operator", is_staff=True), "scraper")
+
+    def get(self, token=None):
+        headers = {"HTTP_AUTHORIZATION": f"Bearer {token}"} if token else {}
+        return Client(**headers).get("/api/metrics")
+
+    def test_disabled_by_default(self):
+        self.assertEqual(self.get(self.staff_token).status_code, 404)
+
+    @override_settings(OVERNOTE_METRICS_ENABLED=True)
+    def test_staff_only(self):
+        self.assertEqual(self.get().status_code, 401)
+        self.assertEqual(self.get(self.token).status_code, 403)
+        response = self.get(self.staff_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+
+
+class QueryInstrumentationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        _, cls.token = ApiToken.issue(User.objects.create_user("counted"), "test")
+
+    def setUp(self):
+        registry.reset()
+        self.addCleanup(registry.reset)
+
+    async def test_async_views_count_their_queries(self):
+        client, headers = AsyncClient(), {"Authorization": f"Bearer {self.token}"}
+        body = json.dumps({"context": CONTEXT, "notes": ["<p>one</p>"]})
+        await client.put("/api/notes/update", body, content_type="application/json", headers=headers)
+        await client.get("/api/notes", {"context": CONTEXT}, headers=headers)
+        await client.get("/api/all-notes", headers=headers)
+        for view in ("update_all_notes", "get_notes", "get_all_notes"):
+            with self.subTest(view=view):
+                self.assertGreater(metric("overnote_view_db_queries_sum", view), 0)
+                self.assertGreater(metric("overnote_view_db_time_ms_sum", view), 0)
+
+    def test_sync_requests_count_their_queries(self):
+        Client(HTTP_AUTHORIZATION=f"Bearer {self.token}").get("/api/all-notes")
+        self.assertGreater(metric("overnote_view_db_queries_sum", "get_all_notes"), 0)
@@ -0,0 +1,131 @@
+import json
+
+from django.contrib.auth.models import User
+from django.test import Client, SimpleTestCase, TestCase
+
+from annotations.models import ApiToken
+from annotations.sanitize import normalize_html
+
+PNG = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+
+# (what the editor produced, what is stored)
+EDITOR_OUTPUT = [
+    (
+        "<p>Plain <strong>bold</strong> <em>italic</em> <u>under</u> <s>struck</s> <sub>2</sub><sup>3</sup></p>",
+        "<p>Plain <strong>bold</strong> <em>italic</em> <u>under</u> <s>struck</s> <sub>2</sub><sup>3</sup></p>",
+    ),
+    (
+        '<p><span style="color: rgb(230, 0, 0);">red</span> and '
+        '<span style="background-color: rgb(255, 255, 0);">highlighted</span></p>',
+        '<p><span style="color: rgb(230, 0, 0)">red</span> and '
+        '<span style="background-color: rgb(255, 255, 0)">highlighted</span></p>',
+    ),
+    (
+        '<h1 class="ql-align-center">Title</h1><p class="ql-indent-1">Indented</p><p><br></p><p>After a blank line</p>',
+        '<h1 class="ql-align-center">Title</h1><p class="ql-indent-1">Indented</p><p><br></p><p>After a blank line</p>',
+    ),
+    (
+        '<ol><li data-list="bullet"><span class="ql-ui" contenteditable="false"></span>One</li>'
+        '<li data-list="ordered"><span class="ql-ui" contenteditable="false"></span>Two</li></ol>',
+        '<ol><li data-list="bullet">One</li><li data-list="ordered">Two</li></ol>',
+    ),
+    (
+        '<p><a href="https://example.com/a?b=1" rel="noopener noreferrer" target="_blank">link</a></p>',
+        '<p><a href="https://example.com/a?b=1" target="_blank" rel="noopener noreferrer">link</a></p>',
+    ),
+    (
+        f'<p>Pasted <img src="{PNG}"></p><p><img src="https://example.com/cat.png" alt="cat"></p>',
+        f'<p>Pasted <img src="{PNG}"></p><p><img src="https://example.com/cat.png" alt="cat"></p>',
+    ),
+    (
+        '<pre class="ql-syntax" spellcheck="false">if (a &lt; b) {}\n</pre>',
+        '<pre class="ql-syntax">if (a &lt; b) {}\n</pre>',
+    ),
+    (
+        '<p class="ql-align-right"><span style="font-size: 18px; font-family: Georgia, serif;">Styled</span></p>',
+        '<p class="ql-align-right"><span style="font-size: 18px; font-family: Georgia, serif">Styled</span></p>',
+    ),
+]
+
+
+class NormalizeHtmlTests(SimpleTestCase):
+    def test_editor_output_round_trips(self):
+        for raw, stored in EDITOR_OUTPUT:
+            with self.subTest(raw=raw):
+                self.assertEqual(normalize_html(raw).html, stored)
+                # Stored HTML is already normal, so saving it again changes nothing
+                self.assertEqual(normalize_html(stored), normalize_html(raw))
+
+    def test_plain_text(self):
+        self.assertEqual(normalize_html(EDITOR_OUTPUT[3][0]).text, "One Two")
+
+    def test_image_only_note_is_not_empty(self):
+        self.assertEqual(normalize_html(f'<p><img src="{PNG}"></p>').html, f'<p><img src="{PNG}"></p>')
+        self.assertEqual(normalize_html("<p><br></p><p> </p>").html, "")
+
+    def test_unsafe_markup_is_dropped(self):
+        cases = {
+            '<p>a<script>alert(1)</script>b</p>': "<p>ab</p>",
+            '<p><a href="javascript:alert(1)">x</a></p>': "<p>x</p>",
+            '<p><img src="x" onerror="alert(1)">y</p>': "<p>y</p>",
+            '<p><img src="javascript:alert(1)">y</p>': "<p>y</p>",
+            '<p><img src="data:image/svg+xml;base64,PHN2Zz4=">y</p>': "<p>y</p>",
+            '<p onclick="x()" style="position: fixed; color: red">y</p>': '<p style="color: red">y</p>',
+            '<span style="background: url(https://evil.example/x)">y</span>': "y",
+            '<span style="color: expression(alert(1))">y</span>': "y",
+            "<p>&lt;img src=x onerror=alert(1)&gt;</p>": "<p>&lt;img src=x onerror=alert(1)&gt;</p>",
+        }
+        for raw, stored in cases.items():
+            with self.subTest(raw=raw):
+                self.assertEqual(normalize_html(raw).html, stored)
+
+    def test_malformed_declarations(self):
+        cases = {
+            # Unterminated: kept as text
+            "<p>x</p><![ a": "<p>x</p>&lt;![ a",
+            "<p>x</p><!DOCTYPE html [ <!x": "<p>x</p>&lt;!DOCTYPE html [ &lt;!x",
+            # Terminated: a bogus comment up to the next ">", as in browsers
+            "<p>x</p><![ a]]> more <b>y</b>": "<p>x</p> more <strong>y</strong>",
+            "<![ <script>alert(1)</script>": "alert(1)",
+        }
+        for raw, stored in cases.items():
+            with self.subTest(raw=raw):
+                self.assertEqual(normalize_html(raw).html, stored)
+
+
+class SavedNoteTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("editor")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    def test_formatting_survives_save_and_load(self):
+        client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        notes = [raw for raw, _ in EDITOR_OUTPUT]
+        response = client.put(
+            "/api/notes/update",
+            json.dumps({"context": "https://example.com/page", "notes": notes}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        stored = [note["content"] for note in client.get("/api/notes?context=https://example.com/page").json()]
+        self.assertEqual(stored, [html for _, html in EDITOR_OUTPUT])
+
+        # Loading and saving unchanged notes writes nothing
+        response = client.put(
+            "/api/notes/update",
+            json.dumps({"context": "https://example.com/page", "notes": stored}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["changes"]["unchanged"], len(stored))
+
+    def test_malformed_markup_is_saved(self):
+        client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        response = client.put(
+            "/api/notes/update",
+            json.dumps({"context": "https://example.com/page", "notes": ["<p>x</p><![ a"]}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        stored = [note["content"] for note in client.get("/api/notes?context=https://example.com/page").json()]
+        self.assertEqual(stored, ["<p>x</p>&lt;![ a"])
@@ -0,0 +1,174 @@
+import asyncio
+import io
+import json
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import AsyncClient, Client, TestCase, override_settings
+from PIL import Image
+
+from annotations.events import aemit
+from annotations.models import Annotation, AnnotationContext, ApiToken
+
+SHARED = "https://example.com/page"
+PRIVATE = "https://example.com/alice-only"
+
+
+class CrossUserTests(TestCase):
+    """Bob must not read, change or be told about anything of Alice's, even on the same page."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        _, alice_token = ApiToken.issue(cls.alice, "test")
+        _, cls.bob_token = ApiToken.issue(cls.bob, "test")
+        alice = Client(HTTP_AUTHORIZATION=f"Bearer {alice_token}")
+        for context in (SHARED, PRIVATE):
+            alice.put(
+                "/api/notes/update",
+                json.dumps({"context": context, "notes": ["<p>alice secret</p>", "<p>alice other</p>"]}),
+                content_type="application/json",
+            )
+        alice.post(
+            "/api/notes/drawing", json.dumps({"context": PRIVATE, "strokes": [[[0, 0], [1, 1]]]}),
+            content_type="application/json",
+        )
+        cls.alice_notes = {
+            note.id: note.content for note in Annotation.all_objects.filter(user=cls.alice)
+        }
+        cls.drawing = Annotation.objects.get(user=cls.alice, annotation_type="DRAW")
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.bob_token}")
+        self.put(SHARED, ["<p>bob note</p>"])
+
+    def tearDown(self):
+        # Nothing of Alice's changed
+        notes = Annotation.all_objects.filter(user=self.alice)
+        self.assertEqual({note.id: note.content for note in notes}, self.alice_notes)
+        self.assertFalse(notes.filter(deleted_at__isnull=False).exists())
+        self.assertFalse(AnnotationContext.all_objects.filter(user=self.alice, deleted_at__isnull=False).exists())
+
+    def put(self, context, notes):
+        return self.client.put(
+            "/api/notes/update", json.dumps({"context": context, "notes": notes}), content_type="application/json"
+        )
+
+    def contents(self, items):
+        return [note["content"] for item in items for note in item["notes"]]
+
+    def test_get_notes(self):
+        self.assertEqual(self.client.get("/api/notes", {"context": PRIVATE}).json(), [])
+        notes = self.client.get("/api/notes", {"context": SHARED}).json()
+        self.assertEqual([note["content"] for note in notes], ["<p>bob note</p>"])
+
+    def test_batch(self):
+        response = self.client.get("/api/notes/batch", {"context": [SHARED, PRIVATE]}).json()
+        self.assertEqual([note["content"] for note in response["contexts"][SHARED]], ["<p>bob note</p>"])
+        self.assertEqual(response["contexts"][PRIVATE], [])
+
+    def test_listings(self):
+        for url, params in (("/api/all-notes", {}), ("/api/notes/site", {"context": SHARED})):
+            with self.subTest(url=url):
+                items = self.client.get(url, params).json()
+                self.assertEqual([item["context"] for item in items], [SHARED])
+                self.assertEqual(self.contents(items), ["<p>bob note</p>"])
+        streamed = json.loads(b"".join(self.client.get("/api/all-notes", {"stream": "1"}).streaming_content))
+        self.assertEqual(self.contents(streamed), ["<p>bob note</p>"])
+
+    def test_search(self):
+        self.assertEqual(self.client.get("/api/search", {"q": "secret"}).json()["results"], [])
+        self.assertEqual(len(self.client.get("/api/search", {"q": "bob"}).json()["results"]), 1)
+
+    def test_changes_and_tombstones(self):
+        changes = self.client.get("/api/changes").json()
+        self.assertEqual([context["context"] for context in changes["contexts"]], [SHARED])
+        self.assertEqual([note["content"] for note in changes["notes"]], ["<p>bob note</p>"])
+        self.assertEqual(self.client.get("/api/tombstones").json()["notes"], [])
+
+    def test_export(self):
+        lines = [json.loads(line) for line in b"".join(self.client.get("/api/notes/export").streaming_content).splitlines()]
+        self.assertEqual([line["context"] for line in lines], [SHARED])
+        self.assertEqual(self.contents(lines), ["<p>bob note</p>"])
+
+    def test_update_with_alice_note_ids(self):
+        # Ids of someone else's notes are unknown ids; the notes are Bob's own new ones
+        notes = [{"id": note_id, "content": "<p>taken</p>"} for note_id in self.alice_notes]
+        self.assertEqual(self.put(PRIVATE, notes).status_code, 200)
+        created = Annotation.objects.filter(user=self.bob, context__identifier=PRIVATE)
+        self.assertEqual(created.count(), len(self.alice_notes))
+        self.assertTrue(set(self.alice_notes).isdisjoint(created.values_list("id", flat=True)))
+
+    def test_save_and_import(self):
+        # Saving needs a context of Bob's own
+        response = self.client.post(
+            "/api/notes/save", json.dumps({"context": PRIVATE, "notes": ["<p>mine</p>"]}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 404)
+        line = json.dumps({"context": PRIVATE, "notes": [{"content": "<p>imported</p>"}]})
+        response = self.client.post("/api/notes/import", line, content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 200)
+        notes = Annotation.objects.filter(user=self.bob, context__identifier=PRIVATE)
+        self.assertEqual([note.content for note in notes], ["<p>imported</p>"])
+
+    def test_clearing_a_shared_page(self):
+        self.put(SHARED, [])
+        self.assertFalse(AnnotationContext.objects.filter(user=self.bob, identifier=SHARED).exists())
+
+    def test_delete_note_is_not_found(self):
+        for note_id in self.alice_notes:
+            response = self.client.delete(
+                "/api/notes/delete", json.dumps({"noteId": note_id}), content_type="application/json"
+            )
+            self.assertEqual(response.status_code, 404)
+
+    def test_delete_context_is_a_noop(self):
+        response = self.client.delete(
+            "/api/notes/delete-context/", json.dumps({"context": PRIVATE}), content_type="application/json"
+        )
+        self.assertEqual(response.json()["status"], "noop")
+
+    def test_drawing_is_not_found(self):
+        url = f"/api/notes/drawing/{self.drawing.id}"
+        self.assertEqual(self.client.get(url).status_code, 404)
+        response = self.client.put(url, json.dumps({"strokes": [[[5, 5], [6, 6]]]}), content_type="application/json")
+        self.assertEqual(response.status_code, 404)
+
+    def test_upload_image(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        image = io.BytesIO()
+        Image.new("RGB", (4, 4), "red").save(image, "PNG")
+        image.seek(0)
+        image.name = "red.png"
+        storages = {
+            "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+            "annotation_images": {
+                "BACKEND": "django.core.files.storage.FileSystemStorage",
+                "OPTIONS": {"location": media},
+            },
+        }
+        with override_settings(STORAGES=storages), self.captureOnCommitCallbacks():
+            response = self.client.post("/api/notes/image", {"context": PRIVATE, "image": image})
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertTrue(Annotation.objects.filter(user=self.bob, context__identifier=PRIVATE).exists())
+
+    async def test_events(self):
+        response = await AsyncClient().get(
+            "/api/events", {"context": [SHARED, PRIVATE]}, headers={"Authorization": f"Bearer {self.bob_token}"}
+        )
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b": connected\n\n")
+        next_chunk = asyncio.ensure_future(anext(chunks))
+        await asyncio.sleep(0.05)
+        await aemit(self.alice.pk, SHARED, "notes.updated")
+        await aemit(self.alice.pk, PRIVATE, "context.deleted")
+        await aemit(self.bob.pk, SHARED, "note.deleted")
+        event = json.loads((await asyncio.wait_for(next_chunk, 5)).decode().split("data: ", 1)[1])
+        self.assertEqual(event["type"], "note.deleted")
+        await chunks.aclose()
@@ -0,0 +1,78 @@
+import json
+from unittest import skipIf
+
+from django.contrib.auth.models import User
+from django.test import Client, TestCase
+
+from annotations.models import ApiToken
+from annotations.search import full_text_supported
+from annotations.serialization import msgpack
+
+CONTEXT = "https://example.com/page"
+OTHER = "https://example.com/other"
+
+
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("searcher")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+        client = Client(HTTP_AUTHORIZATION=f"Bearer {cls.token}")
+        for context, notes in (
+            (CONTEXT, ["<p>Annotation tools</p>", "<p>annotation, annotation and more annotation</p>"]),
+            (OTHER, ["<p>Annotated margin notes</p>", "<p>Nothing relevant</p>"]),
+        ):
+            client.put(
+                "/api/notes/update", json.dumps({"context": context, "notes": notes}), content_type="application/json"
+            )
+
+    def setUp(self):
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+
+    def search(self, q, **params):
+        return self.client.get("/api/search", {"q": q, **params}).json()
+
+    def contents(self, response):
+        return [result["content"] for result in response["results"]]
+
+    def test_ranked_results(self):
+        results = self.search("annotation")["results"]
+        self.assertEqual(
+            [result["content"] for result in results],
+            ["<p>annotation, annotation and more annotation</p>", "<p>Annotation tools</p>"],
+        )
+        self.assertGreater(results[0]["rank"], results[1]["rank"])
+        self.assertEqual({result["context"] for result in results}, {CONTEXT})
+
+    def test_every_word_must_match(self):
+        self.assertEqual(self.contents(self.search("annotation tools")), ["<p>Annotation tools</p>"])
+        self.assertEqual(self.search("annotation margin")["results"], [])
+
+    def test_prefix_match(self):
+        self.assertEqual(len(self.search("annot")["results"]), 3)
+        self.assertEqual(self.contents(self.search("Marg")), ["<p>Annotated margin notes</p>"])
+        self.assertEqual(self.search("margins")["results"], [])
+
+    def test_pagination(self):
+        first = self.search("annot", page_size=2)
+        self.assertEqual((len(first["results"]), first["page"], first["next_page"]), (2, 1, 2))
+        second = self.search("annot", page_size=2, page=2)
+        self.assertEqual((len(second["results"]), second["next_page"]), (1, None))
+        self.assertTrue(set(self.contents(first)).isdisjoint(self.contents(second)))
+        self.assertEqual(self.search("annot", page=3, page_size=2)["results"], [])
+
+    def test_invalid_queries(self):
+        for params in ({"q": ""}, {"q": "annot", "page": "x"}, {"q": "annot", "page_size": "many"}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get("/api/search", params).status_code, 400)
+
+    @skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        response = self.client.get("/api/search", {"q": "tools"}, HTTP_ACCEPT="application/msgpack")
+        self.assertEqual(response["Content-Type"], "application/msgpack")
+        self.assertEqual(msgpack.unpackb(response.content)["results"][0]["content"], "<p>Annotation tools</p>")
+
+    @skipIf(full_text_supported(), "The token index is only used without PostgreSQL full-text search")
+    def test_token_index_ranks_by_occurrences(self):
+        ranks = [result["rank"] for result in self.search("annotation")["results"]]
+        self.assertEqual(ranks, [3.0, 1.0])
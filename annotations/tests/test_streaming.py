@@ -0,0 +1,68 @@
+import gzip
+import json
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import AsyncClient, Client, TestCase
+
+from annotations import views
+from annotations.models import Annotation, AnnotationContext, ApiToken
+
+
+class StreamAllNotesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("streamer")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+        cls.context_ids = []
+        for idx in range(5):
+            context = AnnotationContext.objects.create(user=cls.user, identifier=f"app:context-{idx}")
+            Annotation.objects.create(user=cls.user, context=context, content=f"<p>note {idx}</p>", order=0)
+            cls.context_ids.append(context.id)
+
+    def setUp(self):
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+        self.expected = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}").get("/api/all-notes").json()
+        # Pages of two contexts, so five contexts take three of them
+        patcher = mock.patch.object(views, "ALL_NOTES_CHUNK_SIZE", 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def body(self, response):
+        return b"".join([chunk async for chunk in response.streaming_content])
+
+    async def test_streams_an_async_iterator_under_asgi(self):
+        response = await AsyncClient().get("/api/all-notes", {"stream": "1"}, headers=self.headers)
+        self.assertTrue(response.is_async)
+        self.assertEqual(json.loads(await self.body(response)), self.expected)
+
+    async def test_pages_are_read_as_the_body_is_sent(self):
+        with mock.patch.object(views, "iter_all_notes", wraps=views.iter_all_notes) as iter_page:
+            response = await AsyncClient().get("/api/all-notes", {"stream": "1"}, headers=self.headers)
+            chunks = aiter(response.streaming_content)
+            self.assertEqual(await anext(chunks), b"[")
+            await anext(chunks)
+            self.assertEqual(iter_page.call_count, 1)
+            async for _ in chunks:
+                pass
+        ids = self.context_ids
+        self.assertEqual(
+            [call.args[1:3] for call in iter_page.call_args_list], [(None, 2), (ids[1], 2), (ids[3], 2)]
+        )
+
+    async def test_limit_is_kept(self):
+        response = await AsyncClient().get("/api/all-notes", {"stream": "1", "limit": "3"}, headers=self.headers)
+        self.assertEqual(json.loads(await self.body(response)), self.expected[:3])
+
+    async def test_compressed_stream_stays_async(self):
+        response = await AsyncClient().get(
+            "/api/all-notes", {"stream": "1"}, headers={**self.headers, "Accept-Encoding": "gzip"}
+        )
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertTrue(response.is_async)
+        self.assertEqual(json.loads(gzip.decompress(await self.body(response))), self.expected)
+
+    def test_sync_stream(self):
+        response = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}").get("/api/all-notes", {"stream": "1"})
+        self.assertFalse(response.is_async)
+        self.assertEqual(json.loads(b"".join(response.streaming_content)), self.expected)
@@ -0,0 +1,149 @@
+import json
+
+from django.contrib.auth.models import User
+from django.test import Client, SimpleTestCase, TestCase
+
+from annotations.models import Annotation, AnnotationContext, ApiToken
+from annotations.sync import InvalidNotes, normalize_notes, sync_context_notes
+
+CONTEXT = "https://example.com/page"
+
+
+class NormalizeNotesTests(SimpleTestCase):
+    def test_strings_and_objects(self):
+        notes = normalize_notes(["<p>one</p>", {"id": 7, "content": "<p>two</p>"}, "", {"id": "8"}])
+        self.assertEqual([(note.order, note.id, note.content) for note in notes], [
+            (0, None, "<p>one</p>"),
+            (1, 7, "<p>two</p>"),
+        ])
+
+    def test_rejects_other_payloads(self):
+        for notes in ("abc", {"content": "<p>one</p>"}, None, [5], [None], [["<p>one</p>"]], [{"content": 5}]):
+            with self.subTest(notes=notes), self.assertRaises(InvalidNotes):
+                normalize_notes(notes)
+
+
+class SyncContextNotesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("writer")
+
+    def sync(self, notes):
+        summary, _ = sync_context_notes(self.user, CONTEXT, normalize_notes(notes))
+        return summary
+
+    def stored(self):
+        return list(
+            Annotation.objects.filter(user=self.user, context__identifier=CONTEXT)
+            .order_by("order")
+            .values_list("id", "content", "order")
+        )
+
+    def counts(self, summary):
+        return {key: value for key, value in summary.items() if key != "ids" and value}
+
+    def test_create(self):
+        summary = self.sync(["<p>one</p>", "<p>two</p>"])
+        self.assertEqual(self.counts(summary), {"created": 2})
+        self.assertEqual(summary["ids"], [note_id for note_id, _, _ in self.stored()])
+        self.assertEqual(AnnotationContext.objects.get(user=self.user, identifier=CONTEXT).version, 1)
+
+    def test_unchanged_list_writes_nothing(self):
+        self.sync(["<p>one</p>", "<p>two</p>"])
+        stored = self.stored()
+        # The transaction's savepoint pair, the context row and the stored hashes
+        with self.assertNumQueries(4):
+            summary = self.sync(["<p>one</p>", "<p>two</p>"])
+        self.assertEqual(self.counts(summary), {"unchanged": 2})
+        self.assertEqual(self.stored(), stored)
+
+    def test_edit_by_id_keeps_the_row(self):
+        one, two = self.sync(["<p>one</p>", "<p>two</p>"])["ids"]
+        summary = self.sync([{"id": one, "content": "<p>one, edited</p>"}, {"id": two, "content": "<p>two</p>"}])
+        self.assertEqual(self.counts(summary), {"updated": 1, "unchanged": 1})
+        self.assertEqual(self.stored(), [(one, "<p>one, edited</p>", 0), (two, "<p>two</p>", 1)])
+
+    def test_edit_without_id_replaces_the_row(self):
+        one, two = self.sync(["<p>one</p>", "<p>two</p>"])["ids"]
+        summary = self.sync(["<p>one, edited</p>", "<p>two</p>"])
+        self.assertEqual(self.counts(summary), {"created": 1, "deleted": 1, "unchanged": 1})
+        self.assertNotIn(one, [note_id for note_id, _, _ in self.stored()])
+        self.assertTrue(Annotation.all_objects.get(id=one).deleted_at)
+
+    def test_move_by_content_only_updates_the_order(self):
+        one, two, three = self.sync(["<p>one</p>", "<p>two</p>", "<p>three</p>"])["ids"]
+        summary = self.sync(["<p>three</p>", "<p>one</p>", "<p>two</p>"])
+        self.assertEqual(self.counts(summary), {"reordered": 3})
+        self.assertEqual(summary["ids"], [three, one, two])
+        self.assertEqual(self.stored(), [(three, "<p>three</p>", 0), (one, "<p>one</p>", 1), (two, "<p>two</p>", 2)])
+
+    def test_delete(self):
+        one, two = self.sync(["<p>one</p>", "<p>two</p>"])["ids"]
+        summary = self.sync(["<p>two</p>"])
+        self.assertEqual(self.counts(summary), {"deleted": 1, "reordered": 1})
+        self.assertEqual(self.stored(), [(two, "<p>two</p>", 0)])
+        self.assertIsNotNone(Annotation.all_objects.get(id=one).deleted_at)
+
+    def test_id_wins_over_content(self):
+        one, two = self.sync(["<p>one</p>", "<p>two</p>"])["ids"]
+        # Note `two` now holds the content `one` had, and `one` is new text
+        summary = self.sync([{"id": two, "content": "<p>one</p>"}, {"id": one, "content": "<p>three</p>"}])
+        self.assertEqual(summary["ids"], [two, one])
+        self.assertEqual(self.stored(), [(two, "<p>one</p>", 0), (one, "<p>three</p>", 1)])
+
+    def test_duplicate_contents_match_one_row_each(self):
+        first, second = self.sync(["<p>same</p>", "<p>same</p>"])["ids"]
+        summary = self.sync(["<p>same</p>", "<p>other</p>", "<p>same</p>"])
+        self.assertEqual(self.counts(summary), {"created": 1, "reordered": 1, "unchanged": 1})
+        self.assertEqual([summary["ids"][0], summary["ids"][2]], [first, second])
+
+    def test_unknown_ids_fall_back_to_content(self):
+        (one,) = self.sync(["<p>one</p>"])["ids"]
+        summary = self.sync([{"id": one + 1000, "content": "<p>one</p>"}])
+        self.assertEqual(summary["ids"], [one])
+
+
+class UpdatePayloadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("client")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    def setUp(self):
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+
+    def test_malformed_payloads_are_client_errors(self):
+        for body in (
+            {"context": CONTEXT, "notes": "abc"},
+            {"context": CONTEXT, "notes": [5]},
+            {"context": CONTEXT, "notes": [{"content": ["<p>one</p>"]}]},
+            {"context": ["https://example.com/"], "notes": ["<p>one</p>"]},
+            [CONTEXT, "<p>one</p>"],
+        ):
+            with self.subTest(body=body):
+                response = self.client.put("/api/notes/update", json.dumps(body), content_type="application/json")
+                self.assertEqual(response.status_code, 400)
+        response = self.client.put("/api/notes/update", b"{", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Annotation.all_objects.filter(user=self.user).exists())
+
+    def test_other_methods_are_not_allowed(self):
+        body = json.dumps({"context": CONTEXT, "notes": ["<p>one</p>"]})
+        for method in ("GET", "POST", "PATCH"):
+            with self.subTest(method=method):
+                response = self.client.generic(method, "/api/notes/update", body, content_type="application/json")
+                self.assertEqual(response.status_code, 405)
+                self.assertEqual(response["Allow"], "PUT")
+
+    def test_save_all_notes_keeps_notes_on_bad_payload(self):
+        self.client.put(
+            "/api/notes/update",
+            json.dumps({"context": CONTEXT, "notes": ["<p>one</p>"]}),
+            content_type="application/json",
+        )
+        response = self.client.post(
+            "/api/notes/save", json.dumps({"context": CONTEXT, "notes": "abc"}), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+        contents = Annotation.objects.filter(user=self.user).values_list("content", flat=True)
+        self.assertEqual(list(contents), ["<p>one</p>"])
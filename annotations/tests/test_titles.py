@@ -0,0 +1,138 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+
+from annotations.models import ApiToken
+from annotations.titles import TitleUnavailable, fetch_title, get_fetcher
+
+LOOPBACK = ["127.0.0.1/32"]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path == "/page":
+            body = b"<html><head><title> Stub  page </title></head><body>" + b"x" * 1000 + b"</body></html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/hop":
+            self.redirect(f"http://127.0.0.1:{self.server.server_port}/page")
+        elif self.path == "/to-private":
+            # Another loopback address, outside the allowed network
+            self.redirect(f"http://127.0.0.2:{self.server.server_port}/page")
+        elif self.path == "/loop":
+            self.redirect("/loop")
+        else:
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def redirect(self, location):
+        self.send_response(302)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServerMixin:
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        cls.server.paths = []
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.paths.clear()
+        cache.clear()
+
+
+class FetchTitleTests(StubServerMixin, SimpleTestCase):
+    def fetch(self, url):
+        return asyncio.run(fetch_title(url))
+
+    def test_loopback_is_refused(self):
+        with self.assertRaises(TitleUnavailable):
+            self.fetch(f"{self.base}/page")
+        self.assertEqual(self.server.paths, [])
+
+    def test_private_and_metadata_addresses_are_refused(self):
+        for url in ("http://10.0.0.1/", "http://169.254.169.254/latest/meta-data/", "http://[::1]/", "http://0.0.0.0/"):
+            with self.subTest(url=url), self.assertRaises(TitleUnavailable):
+                self.fetch(url)
+
+    @override_settings(OVERNOTE_TITLE_ALLOWED_NETWORKS=LOOPBACK)
+    def test_reads_title(self):
+        self.assertEqual(self.fetch(f"{self.base}/page"), "Stub page")
+
+    @override_settings(OVERNOTE_TITLE_ALLOWED_NETWORKS=LOOPBACK)
+    def test_client_is_shared_across_event_loops(self):
+        # Each asyncio.run() is a new loop, like each async view under WSGI
+        self.fetch(f"{self.base}/page")
+        client = get_fetcher().client
+        self.fetch(f"{self.base}/page")
+        self.assertIs(get_fetcher().client, client)
+        self.assertFalse(client.is_closed)
+
+    @override_settings(OVERNOTE_TITLE_ALLOWED_NETWORKS=LOOPBACK)
+    def test_follows_redirects_to_allowed_addresses(self):
+        self.assertEqual(self.fetch(f"{self.base}/hop"), "Stub page")
+        self.assertEqual(self.server.paths, ["/hop", "/page"])
+
+    @override_settings(OVERNOTE_TITLE_ALLOWED_NETWORKS=LOOPBACK)
+    def test_every_redirect_hop_is_checked(self):
+        with self.assertRaises(TitleUnavailable):
+            self.fetch(f"{self.base}/to-private")
+        self.assertEqual(self.server.paths, ["/to-private"])
+
+    @override_settings(OVERNOTE_TITLE_ALLOWED_NETWORKS=LOOPBACK)
+    def test_redirect_limit(self):
+        with self.assertRaises(TitleUnavailable):
+            self.fetch(f"{self.base}/loop")
+        self.assertEqual(len(self.server.paths), 6)
+
+
+class PageTitleViewTests(StubServerMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("titles")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    def get_title(self, url):
+        return Client(HTTP_AUTHORIZATION=f"Bearer {self.token}").get("/api/page-title", {"context": url})
+
+    def test_refuses_internal_urls(self):
+        response = self.get_title(f"{self.base}/page")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.server.paths, [])
+
+    @override_settings(OVERNOTE_TITLE_ALLOWED_NETWORKS=LOOPBACK)
+    def test_failures_are_cached_by_url(self):
+        # No context exists for the URL
+        url = f"{self.base}/error"
+        self.assertEqual(self.get_title(url).status_code, 400)
+        self.assertEqual(self.get_title(url).status_code, 400)
+        self.assertEqual(self.server.paths, ["/error"])
+
+    @override_settings(OVERNOTE_TITLE_ALLOWED_NETWORKS=LOOPBACK)
+    def test_returns_title(self):
+        response = self.get_title(f"{self.base}/page")
+        self.assertEqual(response.json(), {"title": "Stub page"})
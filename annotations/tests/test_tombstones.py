@@ -0,0 +1,132 @@
+import json
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.test import Client, TestCase
+from django.utils import timezone
+
+from annotations.models import Annotation, ApiToken, ChangeCounter
+from annotations.tombstones import purge_tombstones
+
+CONTEXT = "https://example.com/page"
+
+
+class TombstoneCursorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("syncer")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    def setUp(self):
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+
+    def update(self, notes, **fields):
+        return self.client.put(
+            "/api/notes/update", json.dumps({"context": CONTEXT, "notes": notes, **fields}),
+            content_type="application/json",
+        )
+
+    def delete(self, note):
+        return self.client.delete("/api/notes/delete", json.dumps({"noteId": note.id}), content_type="application/json")
+
+    def tombstones(self, since):
+        return self.client.get("/api/tombstones", {"since": since}).json()
+
+    def test_cursor_resumes_after_the_last_deletion(self):
+        self.update(["<p>one</p>", "<p>two</p>", "<p>three</p>"])
+        one, two, three = Annotation.objects.filter(user=self.user).order_by("order")
+        self.delete(one)
+
+        first = self.tombstones(0)
+        self.assertEqual([note["id"] for note in first["notes"]], [one.id])
+        self.assertEqual(self.tombstones(first["cursor"])["notes"], [])
+
+        self.delete(two)
+        second = self.tombstones(first["cursor"])
+        self.assertEqual([note["id"] for note in second["notes"]], [two.id])
+        self.assertGreater(second["cursor"], first["cursor"])
+
+    def test_changes_cursor_is_accepted(self):
+        self.update(["<p>one</p>", "<p>two</p>"])
+        cursor = self.client.get("/api/changes").json()["cursor"]
+        note = Annotation.objects.filter(user=self.user).first()
+        self.delete(note)
+        self.assertEqual([tombstone["id"] for tombstone in self.tombstones(cursor)["notes"]], [note.id])
+
+    def test_update_returns_tombstones_and_cursor(self):
+        response = self.update(["<p>one</p>", "<p>two</p>"], since=0).json()
+        self.assertEqual(response["tombstones"], [])
+        note = Annotation.objects.filter(user=self.user, content="<p>one</p>").get()
+        self.delete(note)
+
+        response = self.update(["<p>two</p>", "<p>three</p>"], since=response["cursor"]).json()
+        self.assertEqual([tombstone["id"] for tombstone in response["tombstones"]], [note.id])
+        self.assertEqual(self.update(["<p>two</p>", "<p>three</p>"], since=response["cursor"]).json()["tombstones"], [])
+
+    def test_update_without_since_has_no_cursor(self):
+        response = self.update(["<p>one</p>"]).json()
+        self.assertNotIn("cursor", response)
+        self.assertNotIn("tombstones", response)
+
+    def test_timestamp_cursors_are_rejected(self):
+        self.assertEqual(self.update(["<p>one</p>"], since="2026-10-18T00:00:00Z").status_code, 400)
+        response = self.client.get("/api/tombstones", {"since": "2026-10-18T00:00:00Z"})
+        self.assertEqual(response.status_code, 400)
+
+
+class PurgeHorizonTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("offline")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    def setUp(self):
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        self.client.put(
+            "/api/notes/update",
+            json.dumps({"context": CONTEXT, "notes": ["<p>one</p>", "<p>two</p>"]}),
+            content_type="application/json",
+        )
+        self.cursor = self.client.get("/api/changes").json()["cursor"]
+        self.note = Annotation.objects.filter(user=self.user, content="<p>one</p>").get()
+        self.client.delete("/api/notes/delete", json.dumps({"noteId": self.note.id}), content_type="application/json")
+
+    def purge(self):
+        purge_tombstones(older_than=timezone.now() + timedelta(seconds=1))
+
+    def test_purge_records_the_horizon(self):
+        self.purge()
+        counter = ChangeCounter.objects.get(scope=ChangeCounter.scope_for(self.user.pk))
+        self.assertEqual(counter.purged_seq, counter.value)
+
+    def test_cursors_before_the_horizon_must_resync(self):
+        self.purge()
+        for url in ("/api/tombstones", "/api/changes"):
+            response = self.client.get(url, {"since": self.cursor})
+            self.assertEqual(response.status_code, 410)
+            self.assertIs(response.json()["resync"], True)
+
+        response = self.client.put(
+            "/api/notes/update",
+            json.dumps({"context": CONTEXT, "notes": ["<p>two</p>"], "since": self.cursor}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIs(response.json()["resync"], True)
+
+    def test_cursors_after_the_horizon_still_work(self):
+        self.purge()
+        cursor = self.client.get("/api/changes").json()["cursor"]
+        self.assertEqual(self.client.get("/api/tombstones", {"since": cursor}).status_code, 200)
+        self.assertEqual(self.client.get("/api/changes", {"since": cursor}).status_code, 200)
+
+    def test_unpurged_tombstones_are_listed(self):
+        response = self.client.get("/api/tombstones", {"since": self.cursor})
+        self.assertEqual([note["id"] for note in response.json()["notes"]], [self.note.id])
+
+    def test_missing_since_lists_everything(self):
+        response = self.client.get("/api/tombstones")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([note["id"] for note in response.json()["notes"]], [self.note.id])
+        self.purge()
+        self.assertEqual(self.client.get("/api/tombstones").json()["notes"], [])
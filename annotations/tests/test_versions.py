@@ -0,0 +1,130 @@
+import json
+import threading
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection, connections, transaction
+from django.test import Client, TestCase, TransactionTestCase
+
+from annotations.models import AnnotationContext, ApiToken
+
+CONTEXT = "https://example.com/page"
+
+
+class VersionedUpdateMixin:
+    def setUp(self):
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+
+    def update(self, notes, headers=None, **fields):
+        return self.client.put(
+            "/api/notes/update",
+            json.dumps({"context": CONTEXT, "notes": notes, **fields}),
+            content_type="application/json",
+            headers=headers,
+        )
+
+    def stored(self):
+        return [note["content"] for note in self.client.get("/api/notes", {"context": CONTEXT}).json()]
+
+    def version(self):
+        return AnnotationContext.objects.get(user=self.user, identifier=CONTEXT).version
+
+
+class OptimisticConcurrencyTests(VersionedUpdateMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("concurrent")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    def setUp(self):
+        super().setUp()
+        self.update(["<p>one</p>", "<p>two</p>"])
+        self.etag = self.client.get("/api/notes", {"context": CONTEXT})["ETag"]
+
+    def assertConflict(self, response):
+        self.assertEqual(response.status_code, 409)
+        body = response.json()
+        self.assertEqual(body["version"], self.version())
+        self.assertEqual([note["content"] for note in body["notes"]], self.stored())
+
+    def test_current_etag_saves(self):
+        version = self.version()
+        response = self.update(["<p>one</p>"], headers={"If-Match": self.etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["version"], version + 1)
+
+    def test_stale_etag_returns_the_current_state(self):
+        self.update(["<p>one</p>", "<p>two</p>", "<p>from another device</p>"])
+        response = self.update(["<p>one</p>"], headers={"If-Match": self.etag})
+        self.assertConflict(response)
+        self.assertEqual(self.stored(), ["<p>one</p>", "<p>two</p>", "<p>from another device</p>"])
+
+    def test_if_match_forms(self):
+        # Weak tags (after compression) and bare versions name the same version
+        response = self.update(["<p>one</p>", "<p>two</p>"], headers={"If-Match": f"W/{self.etag}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.update(["<p>one</p>"], headers={"If-Match": f'"{self.version()}"'}).status_code, 200)
+        self.assertConflict(self.update(["<p>two</p>"], headers={"If-Match": '"not-a-version"'}))
+        self.assertEqual(self.update(["<p>two</p>"], headers={"If-Match": "*"}).status_code, 200)
+
+    def test_version_field(self):
+        version = self.version()
+        self.assertConflict(self.update(["<p>one</p>"], version=version - 1))
+        response = self.update(["<p>one</p>"], version=version)
+        self.assertEqual(response.json()["version"], version + 1)
+        for invalid in ("1", -1, True, 1.5):
+            with self.subTest(version=invalid):
+                self.assertEqual(self.update(["<p>one</p>"], version=invalid).status_code, 400)
+
+    def test_if_match_wins_over_the_version_field(self):
+        response = self.update(["<p>one</p>"], headers={"If-Match": self.etag}, version=self.version() - 1)
+        self.assertEqual(response.status_code, 200)
+
+    def test_locked_context_returns_the_current_state(self):
+        # What select_for_update(nowait=True) raises while another save holds the row
+        with mock.patch.object(
+            AnnotationContext.objects, "select_for_update", side_effect=OperationalError("could not obtain lock")
+        ):
+            response = self.update(["<p>one</p>"])
+        self.assertConflict(response)
+        self.assertIn("another request", response.json()["error"])
+
+    def test_empty_notes_with_a_stale_version_keep_the_context(self):
+        version = self.version()
+        self.update(["<p>one</p>", "<p>two</p>", "<p>three</p>"])
+        self.assertConflict(self.update([], version=version))
+        self.assertEqual(self.stored(), ["<p>one</p>", "<p>two</p>", "<p>three</p>"])
+
+        self.assertEqual(self.update([], version=self.version()).status_code, 200)
+        self.assertFalse(AnnotationContext.objects.filter(user=self.user, identifier=CONTEXT).exists())
+
+
+@skipUnless(connection.vendor == "postgresql", "Row locks need PostgreSQL")
+class RowLockTests(VersionedUpdateMixin, TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("locked")
+        _, self.token = ApiToken.issue(self.user, "test")
+        super().setUp()
+        self.update(["<p>one</p>"])
+
+    def test_save_in_progress_returns_409(self):
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_lock():
+            try:
+                with transaction.atomic():
+                    AnnotationContext.objects.select_for_update().get(user=self.user, identifier=CONTEXT)
+                    locked.set()
+                    release.wait(10)
+            finally:
+                connections.close_all()
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        self.addCleanup(holder.join)
+        self.addCleanup(release.set)
+        self.assertTrue(locked.wait(10))
+
+        response = self.update(["<p>two</p>"])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual([note["content"] for note in response.json()["notes"]], ["<p>one</p>"])
@@ -0,0 +1,187 @@
+import json
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import Client, TestCase
+
+from annotations import writebehind
+from annotations.instrumentation import registry
+from annotations.models import Annotation, AnnotationContext, ApiToken
+from annotations.sync import VersionConflict, normalize_notes
+from annotations.writebehind import MAX_ATTEMPTS, WriteBehindBuffer
+
+CONTEXT = "https://example.com/page"
+OTHER = "https://example.com/other"
+
+
+class WriteBehindBufferTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("typist")
+        _, cls.token = ApiToken.issue(cls.user, "test")
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        # Never due on its own, so the tests decide when payloads are written
+        self.buffer = WriteBehindBuffer(window=3600)
+        self.addCleanup(self.buffer.close)
+        patcher = mock.patch("annotations.views.get_write_behind", return_value=self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def update(self, notes, context=CONTEXT, **fields):
+        return self.client.put(
+            "/api/notes/update", json.dumps({"context": context, "notes": notes, **fields}),
+            content_type="application/json",
+        )
+
+    def stored(self, context=CONTEXT):
+        return list(
+            Annotation.objects.filter(user=self.user, context__identifier=context)
+            .order_by("order")
+            .values_list("content", flat=True)
+        )
+
+    def notes(self, context=CONTEXT):
+        return [note["content"] for note in self.client.get("/api/notes", {"context": context}).json()]
+
+    def sync_calls(self):
+        return mock.patch.object(writebehind, "sync_context_notes", wraps=writebehind.sync_context_notes)
+
+    def test_repeated_writes_are_coalesced(self):
+        coalesced = registry.counter("overnote_write_behind_coalesced_total")
+        for text in ("one", "one two", "one two three"):
+            response = self.update([f"<p>{text}</p>"])
+            self.assertEqual((response.status_code, response.json()["status"]), (202, "accepted"))
+        self.assertEqual(self.stored(), [])
+        self.assertEqual(registry.counter("overnote_write_behind_coalesced_total"), coalesced + 2)
+
+        with self.sync_calls() as sync:
+            self.assertEqual(self.buffer.flush(force=True), 1)
+        self.assertEqual(sync.call_count, 1)
+        self.assertEqual(self.stored(), ["<p>one two three</p>"])
+        self.assertEqual(self.buffer.flush(force=True), 0)
+
+    def test_only_due_payloads_are_written(self):
+        self.assertTrue(self.buffer.put(self.user.pk, CONTEXT, normalize_notes(["<p>one</p>"])))
+        self.assertEqual(self.buffer.flush(), 0)
+        with mock.patch.object(writebehind.time, "monotonic", return_value=writebehind.time.monotonic() + 3600):
+            self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.stored(), ["<p>one</p>"])
+
+    def test_reads_see_buffered_writes(self):
+        self.update(["<p>one</p>"])
+        self.update(["<p>one</p>", "<p>two</p>"])
+        response = self.client.get("/api/notes", {"context": CONTEXT})
+        self.assertEqual([note["content"] for note in response.json()], ["<p>one</p>", "<p>two</p>"])
+        self.assertFalse(response.has_header("ETag"))
+        self.assertEqual(self.stored(), [])
+
+        # Bulk reads come from the database, after writing the user's payloads
+        all_notes = self.client.get("/api/all-notes").json()
+        self.assertEqual([note["content"] for note in all_notes[0]["notes"]], ["<p>one</p>", "<p>two</p>"])
+        self.assertIsNone(self.buffer.pending_notes(self.user.pk, CONTEXT))
+        self.assertEqual(self.stored(), ["<p>one</p>", "<p>two</p>"])
+
+    def test_versioned_updates_are_written_through(self):
+        self.update(["<p>one</p>"])
+        self.buffer.flush(force=True)
+        self.update(["<p>buffered</p>"])
+        version = AnnotationContext.objects.get(user=self.user, identifier=CONTEXT).version
+        response = self.update(["<p>direct</p>"], version=version)
+        self.assertEqual(response.status_code, 200)
+        # The older buffered payload is dropped rather than written over it later
+        self.assertIsNone(self.buffer.pending_notes(self.user.pk, CONTEXT))
+        self.buffer.close()
+        self.assertEqual(self.stored(), ["<p>direct</p>"])
+
+    def test_delete_note_is_not_undone_by_a_buffered_write(self):
+        self.update(["<p>one</p>", "<p>two</p>"])
+        self.buffer.flush(force=True)
+        note = Annotation.objects.get(user=self.user, content="<p>one</p>")
+        # Still names the note, so writing it after the delete would bring the note back
+        self.update([{"id": note.id, "content": "<p>one</p>"}, "<p>two</p>", "<p>three</p>"])
+
+        response = self.client.delete(
+            "/api/notes/delete", json.dumps({"noteId": note.id}), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(self.buffer.pending_notes(self.user.pk, CONTEXT))
+        self.buffer.close()
+        self.assertEqual(self.notes(), ["<p>two</p>", "<p>three</p>"])
+        self.assertFalse(Annotation.objects.filter(id=note.id).exists())
+
+    def test_delete_context_drops_buffered_writes(self):
+        self.update(["<p>one</p>"])
+        self.buffer.flush(force=True)
+        self.update(["<p>one</p>", "<p>two</p>"])
+        self.update(["<p>elsewhere</p>"], context=OTHER)
+
+        response = self.client.delete(
+            "/api/notes/delete-context/", json.dumps({"context": CONTEXT}), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(self.buffer.pending_notes(self.user.pk, CONTEXT))
+        self.buffer.close()
+        self.assertFalse(AnnotationContext.objects.filter(user=self.user, identifier=CONTEXT).exists())
+        self.assertEqual(self.notes(), [])
+        self.assertEqual(self.stored(OTHER), ["<p>elsewhere</p>"])
+
+    def test_empty_update_drops_buffered_writes(self):
+        self.update(["<p>one</p>"])
+        self.assertEqual(self.update([]).status_code, 200)
+        self.buffer.close()
+        self.assertFalse(AnnotationContext.objects.filter(user=self.user, identifier=CONTEXT).exists())
+
+    def test_version_conflicts_are_retried(self):
+        self.buffer.put(self.user.pk, CONTEXT, normalize_notes(["<p>one</p>"]))
+        real = writebehind.sync_context_notes
+        outcomes = [VersionConflict("locked")]
+
+        def locked_once(*args, **kwargs):
+            if outcomes:
+                raise outcomes.pop()
+            return real(*args, **kwargs)
+
+        with mock.patch.object(writebehind, "sync_context_notes", side_effect=locked_once):
+            self.assertEqual(self.buffer.flush(force=True), 0)
+            self.assertIsNotNone(self.buffer.pending_notes(self.user.pk, CONTEXT))
+            self.assertEqual(self.buffer.flush(force=True), 1)
+        self.assertIsNone(self.buffer.pending_notes(self.user.pk, CONTEXT))
+        self.assertEqual(self.stored(), ["<p>one</p>"])
+
+    def test_writes_locked_out_too_often_are_dropped(self):
+        self.buffer.put(self.user.pk, CONTEXT, normalize_notes(["<p>one</p>"]))
+        with mock.patch.object(writebehind, "sync_context_notes", side_effect=VersionConflict("locked")) as sync:
+            with self.assertLogs("annotations.writebehind", "ERROR"):
+                for _ in range(MAX_ATTEMPTS):
+                    self.assertEqual(self.buffer.flush(force=True), 0)
+        self.assertEqual(sync.call_count, MAX_ATTEMPTS)
+        self.assertIsNone(self.buffer.pending_notes(self.user.pk, CONTEXT))
+        self.assertEqual(self.stored(), [])
+
+    def test_close_flushes_everything(self):
+        other = User.objects.create_user("other typist")
+        self.update(["<p>one</p>"])
+        self.update(["<p>two</p>"], context=OTHER)
+        self.buffer.put(other.pk, CONTEXT, normalize_notes(["<p>theirs</p>"]))
+
+        self.buffer.close()
+        self.assertEqual(self.stored(), ["<p>one</p>"])
+        self.assertEqual(self.stored(OTHER), ["<p>two</p>"])
+        self.assertEqual(
+            list(Annotation.objects.filter(user=other).values_list("content", flat=True)), ["<p>theirs</p>"]
+        )
+        # A closed buffer refuses payloads, so updates are written through
+        response = self.update(["<p>after</p>"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stored(), ["<p>after</p>"])
+
+    def test_full_buffer_writes_through(self):
+        buffer = WriteBehindBuffer(window=3600, max_pending=1)
+        self.addCleanup(buffer.close)
+        self.assertTrue(buffer.put(self.user.pk, CONTEXT, normalize_notes(["<p>one</p>"])))
+        self.assertTrue(buffer.put(self.user.pk, CONTEXT, normalize_notes(["<p>two</p>"])))
+        self.assertFalse(buffer.put(self.user.pk, OTHER, normalize_notes(["<p>three</p>"])))
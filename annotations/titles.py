@@ -0,0 +1,261 @@
+"""
+Page title resolution for get_page_title.
+
+Titles are fetched with a pooled async HTTP client, at most
+OVERNOTE_TITLE_PER_HOST_LIMIT requests at a time per host, and parsed from the
+response stream so the download stops as soon as `</title>` is seen (or after
+OVERNOTE_TITLE_MAX_BYTES). Results are stored on the matching AnnotationContext
+and reused for OVERNOTE_TITLE_TTL; failures are remembered per URL in the
+cache for OVERNOTE_TITLE_FAILURE_TTL, whether or not a context exists, so a
+dead site is not retried on every request.
+
+Users choose the URL, so the server only connects to public addresses: every
+hop, the first request and each of at most OVERNOTE_TITLE_MAX_REDIRECTS
+redirects, is resolved, refused unless all of the host's addresses are
+public (or in OVERNOTE_TITLE_ALLOWED_NETWORKS), and then sent to the address
+that was checked, so the name cannot resolve elsewhere in between.
+"""
+import asyncio
+import atexit
+import codecs
+import hashlib
+import ipaddress
+import socket
+import threading
+from datetime import timedelta
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+
+import httpx
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import AnnotationContext
+
+TITLE_TIMEOUT = getattr(settings, "OVERNOTE_TITLE_TIMEOUT", 5.0)
+TITLE_MAX_BYTES = getattr(settings, "OVERNOTE_TITLE_MAX_BYTES", 256 * 1024)
+TITLE_MAX_CONNECTIONS = getattr(settings, "OVERNOTE_TITLE_MAX_CONNECTIONS", 100)
+TITLE_PER_HOST_LIMIT = getattr(settings, "OVERNOTE_TITLE_PER_HOST_LIMIT", 4)
+TITLE_TTL = timedelta(seconds=getattr(settings, "OVERNOTE_TITLE_TTL", 7 * 24 * 3600))
+TITLE_FAILURE_TTL = timedelta(seconds=getattr(settings, "OVERNOTE_TITLE_FAILURE_TTL", 15 * 60))
+TITLE_MAX_REDIRECTS = getattr(settings, "OVERNOTE_TITLE_MAX_REDIRECTS", 5)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+class TitleUnavailable(Exception):
+    pass
+
+
+class TitleParser(HTMLParser):
+    """Incremental parser that only collects the text of the first <title>."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.in_title = False
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == "title":
+            self.in_title = True
+        elif tag == "body":
+            # A <title> can only appear in <head>; no need to read any further.
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self.in_title:
+            self.in_title = False
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.parts.append(data)
+
+    @property
+    def title(self):
+        return " ".join("".join(self.parts).split())
+
+
+class _Fetcher:
+    """
+    The HTTP client and per-host semaphores of the process. They live on an
+    event loop of their own, in a background thread, so connections are
+    pooled across requests whichever loop a request runs on (under WSGI every
+    async view gets a new one), and the client is closed when the process
+    exits.
+    """
+
+    def __init__(self):
+        self.client = httpx.AsyncClient(
+            timeout=TITLE_TIMEOUT,
+            # Redirects are followed by fetch_title, which checks every hop
+            follow_redirects=False,
+            trust_env=False,
+            limits=httpx.Limits(
+                max_connections=TITLE_MAX_CONNECTIONS,
+                max_keepalive_connections=TITLE_MAX_CONNECTIONS,
+            ),
+            headers={"Accept": "text/html,application/xhtml+xml"},
+        )
+        self.host_limits = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="overnote-titles", daemon=True)
+        self.thread.start()
+
+    def host_limit(self, host):
+        # Only used on self.loop
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(TITLE_PER_HOST_LIMIT)
+        return self.host_limits[host]
+
+    async def run(self, coroutine):
+        """Runs `coroutine` on the fetcher's loop and waits for it from the caller's."""
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.client.aclose(), self.loop).result(TITLE_TIMEOUT)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(TITLE_TIMEOUT)
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_fetcher():
+    global _fetcher
+    if _fetcher is None:
+        with _fetcher_lock:
+            if _fetcher is None:
+                _fetcher = _Fetcher()
+                atexit.register(_fetcher.close)
+    return _fetcher
+
+
+def _incremental_decoder(encoding):
+    try:
+        return codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+    except LookupError:
+        return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+
+def _allowed_networks():
+    # Read on every call so tests can override it
+    return [ipaddress.ip_network(network) for network in getattr(settings, "OVERNOTE_TITLE_ALLOWED_NETWORKS", ())]
+
+
+def _is_public(address):
+    if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    if any(address in network for network in _allowed_networks()):
+        return True
+    return address.is_global and not address.is_multicast
+
+
+async def public_address(host, port):
+    """
+    Resolves `host` and returns one of its addresses. Raises TitleUnavailable
+    unless every address is public, so loopback, private, link-local and
+    cloud metadata addresses are never fetched.
+    """
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError) as e:
+        raise TitleUnavailable(f"Cannot resolve {host}") from e
+    # Drop the scope of link-local IPv6 addresses ("fe80::1%eth0")
+    addresses = [ipaddress.ip_address(info[4][0].split("%")[0]) for info in infos]
+    if not addresses or not all(_is_public(address) for address in addresses):
+        raise TitleUnavailable(f"{host} is not a public address")
+    return addresses[0]
+
+
+async def fetch_title(url):
+    """Downloads just enough of `url` to read its title. Returns "" if it has none."""
+    fetcher = get_fetcher()
+    return await fetcher.run(_fetch_title(fetcher, url))
+
+
+async def _fetch_title(state, url):
+    for _ in range(TITLE_MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        if parts.scheme not in DEFAULT_PORTS or not parts.hostname:
+            raise TitleUnavailable(f"Unsupported URL: {url}")
+        try:
+            port = parts.port or DEFAULT_PORTS[parts.scheme]
+        except ValueError:
+            raise TitleUnavailable(f"Unsupported URL: {url}")
+        address = await public_address(parts.hostname, port)
+
+        # Sent to the checked address; Host and SNI still name the site, and
+        # the certificate is verified against its name.
+        try:
+            request = state.client.build_request(
+                "GET",
+                httpx.URL(url).copy_with(host=str(address)),
+                headers={"Host": parts.hostname if port == DEFAULT_PORTS[parts.scheme] else f"{parts.hostname}:{port}"},
+                extensions={"sni_hostname": parts.hostname},
+            )
+        except httpx.InvalidURL as e:
+            raise TitleUnavailable(f"Unsupported URL: {url}") from e
+        async with state.host_limit(parts.hostname):
+            response = await state.client.send(request, stream=True)
+            try:
+                if response.is_redirect:
+                    url = urljoin(url, response.headers["Location"])
+                    continue
+                response.raise_for_status()
+                decoder = _incremental_decoder(response.charset_encoding)
+                parser = TitleParser()
+                received = 0
+                async for chunk in response.aiter_bytes():
+                    received += len(chunk)
+                    parser.feed(decoder.decode(chunk))
+                    if parser.done or received >= TITLE_MAX_BYTES:
+                        break
+                return parser.title
+            finally:
+                await response.aclose()
+    raise TitleUnavailable("Too many redirects")
+
+
+async def resolve_title(user, url):
+    """
+    Returns the title of `url`, served from `user`'s AnnotationContext for that
+    URL while it is fresh. Raises TitleUnavailable when the page cannot be fetched,
+    including while a previous failure is still cached.
+    """
+    context = await (
+        AnnotationContext.objects.filter(user=user, identifier=url)
+        .only("id", "title", "title_fetched_at", "title_fetch_failed")
+        .afirst()
+    )
+    now = timezone.now()
+    if context is not None and context.title_fetched_at is not None:
+        age = now - context.title_fetched_at
+        if context.title_fetch_failed and age < TITLE_FAILURE_TTL:
+            raise TitleUnavailable("Title fetch failed recently")
+        if not context.title_fetch_failed and age < TITLE_TTL:
+            return context.title
+    failure_key = f"overnote:title-failed:{hashlib.sha256(url.encode('utf-8')).hexdigest()}"
+    if await cache.aget(failure_key):
+        raise TitleUnavailable("Title fetch failed recently")
+
+    try:
+        title = await fetch_title(url)
+    except (httpx.HTTPError, TitleUnavailable) as e:
+        await cache.aset(failure_key, True, TITLE_FAILURE_TTL.total_seconds())
+        if context is not None:
+            await AnnotationContext.objects.filter(id=context.id).aupdate(
+                title_fetch_failed=True, title_fetched_at=now
+            )
+        raise TitleUnavailable(str(e) or e.__class__.__name__) from e
+
+    if context is not None:
+        await AnnotationContext.objects.filter(id=context.id).aupdate(
+            title=title, title_fetch_failed=False, title_fetched_at=now
+        )
+    return title
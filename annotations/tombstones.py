@@ -0,0 +1,143 @@
+"""
+Soft deletion of notes and contexts.
+
+Request handlers only stamp `deleted_at`, which is a single UPDATE however
+many notes a context holds. The default managers hide tombstoned rows, and
+`tombstones_since` lets clients that were offline find out what was deleted.
+Deletions are stamped with a change number like every other write, and
+tombstone cursors are numbers from the same sequence as the cursors of
+/api/changes (see changes.py), so a cursor from either can be passed to the
+other.
+The rows, with their cascades and search index entries, are removed later in
+bounded batches by `purge_tombstones` (see the management command of the same
+name), once they are older than OVERNOTE_TOMBSTONE_RETENTION_DAYS. Each batch
+advances its users' purge horizon (ChangeCounter.purged_seq) in the same
+transaction, and clients whose cursor is older are told to do a full resync.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .changes import current_seq
+from .models import Annotation, AnnotationContext, ChangeCounter
+
+TOMBSTONE_RETENTION_DAYS = getattr(settings, "OVERNOTE_TOMBSTONE_RETENTION_DAYS", 30)
+PURGE_BATCH_SIZE = getattr(settings, "OVERNOTE_PURGE_BATCH_SIZE", 500)
+
+
+def soft_delete_note(user, note_id):
+    """
+    Tombstones one of `user`'s notes and returns its context identifier.
+    Raises Annotation.DoesNotExist, also for other users' notes.
+    """
+    with transaction.atomic():
+        note = (
+            Annotation.objects.select_related("context")
+            .only("id", "context__identifier")
+            .get(id=note_id, user=user)
+        )
+        Annotation.objects.filter(id=note.id).update(
+            deleted_at=timezone.now(), change_seq=ChangeCounter.next_seq(user.pk)
+        )
+        AnnotationContext.objects.filter(id=note.context_id).update(version=F("version") + 1)
+    return note.context.identifier
+
+
+def soft_delete_context(user, identifier, expected_version=None):
+    """
+    Tombstones one of `user`'s contexts, hiding its notes with it. With
+    `expected_version`, only while the context is still at that version.
+    Returns whether a context was deleted.
+    """
+    contexts = AnnotationContext.objects.filter(user=user, identifier=identifier)
+    if expected_version is not None:
+        contexts = contexts.filter(version=expected_version)
+    with transaction.atomic():
+        return bool(
+            contexts.update(
+                deleted_at=timezone.now(),
+                change_seq=ChangeCounter.next_seq(user.pk),
+                version=F("version") + 1,
+            )
+        )
+
+
+def tombstones_since(user, since, identifier=None):
+    """
+    `user`'s notes and contexts deleted after change number `since`, optionally
+    limited to one context, as {"notes": [...], "contexts": [...], "cursor": n}.
+    Every deletion up to `cursor` is included, so it can be passed back as
+    `since` without missing one that was still being committed.
+    """
+    cursor = current_seq(user.pk)
+    notes = Annotation.all_objects.filter(
+        user=user, deleted_at__isnull=False, change_seq__gt=since, change_seq__lte=cursor
+    )
+    contexts = AnnotationContext.all_objects.filter(
+        user=user, deleted_at__isnull=False, change_seq__gt=since, change_seq__lte=cursor
+    )
+    if identifier is not None:
+        notes = notes.filter(context__identifier=identifier)
+        contexts = contexts.filter(identifier=identifier)
+    return {
+        "notes": [
+            {"id": note_id, "context": context, "deleted_at": deleted_at}
+            for note_id, context, deleted_at in notes.order_by("change_seq", "id").values_list(
+                "id", "context__identifier", "deleted_at"
+            )
+        ],
+        "contexts": [
+            {"context": context, "deleted_at": deleted_at}
+            for context, deleted_at in contexts.order_by("change_seq", "id").values_list("identifier", "deleted_at")
+        ],
+        "cursor": cursor,
+    }
+
+
+def purge_tombstones(older_than=None, batch_size=PURGE_BATCH_SIZE, pause=0):
+    """
+    Hard-deletes notes and contexts tombstoned before `older_than` (default:
+    the retention period ago), `batch_size` rows per transaction, sleeping
+    `pause` seconds between batches. Returns (notes, contexts) purged.
+    """
+    if older_than is None:
+        older_than = timezone.now() - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+
+    purged_notes = _purge_in_batches(
+        Annotation.all_objects.filter(
+            Q(deleted_at__lt=older_than) | Q(context__deleted_at__lt=older_than)
+        ),
+        batch_size,
+        pause,
+    )
+    # Notes were removed above, so each context delete only cascades to
+    # whatever was written after the context itself was deleted.
+    purged_contexts = _purge_in_batches(
+        AnnotationContext.all_objects.filter(deleted_at__lt=older_than), batch_size, pause
+    )
+    return purged_notes, purged_contexts
+
+
+def _purge_in_batches(queryset, batch_size, pause):
+    purged = 0
+    while True:
+        with transaction.atomic():
+            rows = list(queryset.order_by("id").values_list("id", "user_id", "change_seq")[:batch_size])
+            if not rows:
+                return purged
+            horizons = {}
+            for _, user_id, change_seq in rows:
+                horizons[user_id] = max(horizons.get(user_id, 0), change_seq)
+            for user_id, horizon in horizons.items():
+                ChangeCounter.objects.filter(scope=ChangeCounter.scope_for(user_id)).update(
+                    purged_seq=Greatest("purged_seq", horizon)
+                )
+            queryset.model.all_objects.filter(id__in=[row[0] for row in rows]).delete()
+        purged += len(rows)
+        if pause:
+            time.sleep(pause)
@@ -2,10 +2,25 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
+    path('api/tokens', views.obtain_token, name='obtain_token'),
     path('api/notes', views.get_notes, name='get_notes'),
+    path('api/notes/batch', views.get_notes_batch, name='get_notes_batch'),
     path('api/notes/save', views.save_all_notes, name='save_all_notes'),
     path('api/notes/update', views.update_all_notes, name='update_all_notes'),
     path('api/all-notes', views.get_all_notes, name='get_all_notes'),
+    path('api/notes/site', views.get_site_notes, name='get_site_notes'),
+    path('api/notes/export', views.export_notes, name='export_notes'),
+    path('api/notes/import', views.import_notes, name='import_notes'),
     path('api/notes/delete', views.delete_note, name='delete_note'),
     path('api/notes/delete-context/', views.delete_context, name='delete_context'),
+    path('api/notes/image', views.upload_image, name='upload_image'),
+    path('media/annotations/<path:path>', views.serve_image, name='serve_image'),
+    path('api/notes/drawing', views.save_drawing, name='save_drawing'),
+    path('api/notes/drawing/<int:note_id>', views.drawing, name='drawing'),
+    path('api/changes', views.get_changes, name='get_changes'),
+    path('api/tombstones', views.get_tombstones, name='get_tombstones'),
+    path('api/search', views.search, name='search'),
+    path('api/events', views.note_events, name='note_events'),
+    path('api/page-title', views.get_page_title, name='get_page_title'),
+    path('api/metrics', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -1,154 +1,631 @@
+from asgiref.sync import sync_to_async
+from django.contrib.auth import authenticate
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
 from django.views.decorators.csrf import csrf_exempt
-from .models import Annotation, AnnotationContext
-from html import unescape
+from django.views.decorators.http import require_http_methods
+from .models import Annotation, AnnotationContext, ApiToken, ChangeCounter, annotation_image_storage
+from .auth import api_login_required
+from .identifiers import SITE_SCOPES, canonical_identifier, site_query
+from .replicas import replica_reads
+from .archive import ArchiveError, aexport_archive, agzip_lines, export_archive, gzip_lines, import_archive
+from .changes import CursorExpired, changes_since, check_cursor, current_seq
+from .cache import aget_cached_notes, ainvalidate_notes, aset_cached_notes, etag_version, invalidate_notes
+from .sync import InvalidNotes, VersionConflict, normalize_notes, sync_context_notes
+from .events import aemit, emit, event_key, get_broker
+from .drawing import InvalidDrawing, decode as decode_drawing, encode as encode_drawing
+from .images import InvalidImage, enqueue_variants, image_urls, store_upload
+from .instrumentation import registry
+from .serialization import CONTENT_TYPES, ApiResponse, dumps, encode, loads, response_format, vary_on_format
+from .search import index_annotations, search_notes
+from .titles import TitleUnavailable, resolve_title
+from .tombstones import soft_delete_context, soft_delete_note, tombstones_since
+from .writebehind import get_write_behind
+import gzip
 import json
-import requests
-from django.http import JsonResponse
-from bs4 import BeautifulSoup
+import logging
+from django.db.models import F, Max, Prefetch
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import parse_etags
 
-def is_empty_html(html):
-    if not html:
-        return True
-    cleaned = html.strip().replace('\n', '').replace(' ', '')
-    return cleaned in ['', '<p><br></p>', '<p><br/></p>', '<p></p>']
+logger = logging.getLogger(__name__)
+
+# get_all_notes: contexts fetched per round trip, and the largest page a client may ask for
+ALL_NOTES_CHUNK_SIZE = 500
+ALL_NOTES_MAX_PAGE_SIZE = 1000
+
+# get_changes: default and largest number of notes per page
+CHANGES_DEFAULT_PAGE_SIZE = 500
+CHANGES_MAX_PAGE_SIZE = 5000
+
+# get_notes_batch: most contexts a single request may ask for
+NOTES_BATCH_MAX_CONTEXTS = 100
+
+# search: largest page a client may ask for
+SEARCH_MAX_PAGE_SIZE = 50
+
+# note_events: most contexts per subscription, and seconds between keepalive comments
+EVENTS_MAX_CONTEXTS = 100
+EVENTS_KEEPALIVE_SECONDS = 15
+
+def not_modified(request, etag):
+    # Weak comparison: compressed responses carry the weak form of the ETag
+    return etag in {tag.removeprefix('W/') for tag in parse_etags(request.headers.get('If-None-Match', ''))}
+
+def cached_response(request, body, etag, content_type='application/json'):
+    if not_modified(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type=content_type)
+    response['ETag'] = etag
+    return vary_on_format(response)
+
+NOTE_FIELDS = ('id', 'content', 'annotation_type', 'image', 'image_variants')
+
+def serialize_note(note_id, content, annotation_type, image, image_variants, context_identifier):
+    note = {
+        "id": note_id,
+        "content": (content or "").strip(),
+        "context": context_identifier,
+    }
+    if image:
+        note["image"] = image_urls(image, image_variants)
+    if annotation_type == 'DRAW':
+        # Strokes are fetched separately, packed, from the drawing endpoint
+        note["drawing"] = reverse('drawing', args=[note_id])
+    return note
+
+async def context_notes(user, identifier):
+    """Returns (serialized notes, version) of `user`'s context `identifier`."""
+    notes, version = [], None
+    async for *row, version in Annotation.objects.filter(
+        user=user, context__identifier=identifier
+    ).order_by('order').values_list(*NOTE_FIELDS, 'context__version'):
+        notes.append(serialize_note(*row, identifier))
+    if version is None:
+        # No notes, but the context may still exist
+        version = await AnnotationContext.objects.filter(
+            user=user, identifier=identifier
+        ).values_list('version', flat=True).afirst() or 0
+    return notes, version
+
+async def buffered_context_notes(user, identifier, notes):
+    """
+    get_notes body for a context with an autosave still in the write-behind
+    buffer: the buffered text notes (normalize_notes() output), with media
+    notes from the database.
+    """
+    media = [
+        (row[0], serialize_note(*row[1:], identifier))
+        async for row in Annotation.objects.filter(
+            user=user, context__identifier=identifier, annotation_type__in=Annotation.MEDIA_TYPES
+        ).values_list('order', *NOTE_FIELDS)
+    ]
+    text = [(note.order, {"id": note.id, "content": note.content, "context": identifier}) for note in notes]
+    return [note for _, note in sorted(media + text, key=lambda item: item[0])]
+
+def flush_buffered_notes(user):
+    """Writes the user's buffered autosaves, so reads from the database include them."""
+    buffer = get_write_behind()
+    if buffer is not None:
+        buffer.flush(user_id=user.pk)
+
+def expected_version(request, data):
+    """
+    The context version an update is based on: from If-Match, holding an ETag
+    from get_notes or a bare version, or else from a `version` field. None when
+    the client sends neither. Raises ValueError.
+    """
+    if_match = request.headers.get('If-Match')
+    if if_match:
+        etags = parse_etags(if_match)
+        if '*' in etags:
+            return None
+        version = etag_version(etags[0]) if etags else None
+        # An unrecognised tag matches no version, so the client gets a 409 with the current one
+        return -1 if version is None else version
+    version = data.get("version")
+    if version is not None and (not isinstance(version, int) or isinstance(version, bool) or version < 0):
+        raise ValueError("version must be a non-negative integer")
+    return version
+
+def next_order(annotation_context):
+    top = annotation_context.annotation.aggregate(top=Max('order'))['top']
+    return top + 1 if top is not None else 0
+
+@csrf_exempt
+def obtain_token(request):
+    """
+    Exchanges a username and password (JSON body) for a new API token, to be
+    sent as `Authorization: Bearer <token>`. The token is only shown once.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "Invalid HTTP method. Use POST."}, status=405)
+    try:
+        data = loads(request.body)
+    except json.JSONDecodeError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({"error": "Username and password are required."}, status=400)
+    user = authenticate(request, username=data.get('username'), password=data.get('password'))
+    if user is None:
+        return JsonResponse({"error": "Invalid credentials."}, status=401)
+    token, raw = ApiToken.issue(user, data.get('name') or '')
+    return JsonResponse({"token": raw, "name": token.name}, status=201)
 
 @csrf_exempt
-def get_notes(request):
-    context_identifier = request.GET.get('context', None)
-    # print(f"📥 Fetching notes for context: {context_identifier}")
+@api_login_required
+@replica_reads
+async def get_notes(request):
+    context_identifier = canonical_identifier(request.GET.get('context', None))
 
     try:
         if context_identifier:
-            annotations = Annotation.objects.filter(context__identifier=context_identifier).order_by('order')
-            print(f"👀 Found {len(annotations)} notes for context '{context_identifier}'")
+            buffer = get_write_behind()
+            buffered = buffer.pending_notes(request.user.pk, context_identifier) if buffer else None
+            if buffered is not None:
+                # Read your own writes before they are flushed. Not cached, and no
+                # ETag: the context's version only changes once the write happens.
+                return ApiResponse(
+                    await buffered_context_notes(request.user, context_identifier, buffered), request
+                )
 
-            annotations_data = [
-                {
-                    "id": annotation.id,
-                    "content": unescape(annotation.content.strip()),
-                    "context": annotation.context.identifier,
-                }
-                for annotation in annotations
-            ]
-            print(f"📨 Receiving notes for '{context_identifier}': {annotations_data}")
-            return JsonResponse(annotations_data, safe=False)
+            fmt = response_format(request)
+            cached, generation = await aget_cached_notes(request.user.pk, context_identifier, fmt)
+            if cached is not None:
+                return cached_response(request, *cached, content_type=CONTENT_TYPES[fmt])
+
+            annotations_data, version = await context_notes(request.user, context_identifier)
+            body, content_type = encode(annotations_data, fmt)
+            etag = await aset_cached_notes(request.user.pk, context_identifier, generation, body, fmt, version)
+            return cached_response(request, body, etag, content_type)
         else:
-            print("❌ Context is required")
             return JsonResponse({"error": "Context is required"}, status=400)
     except Exception as e:
-        print(f"❌ Error fetching notes: {str(e)}")
+        logger.warning("Error fetching notes: %s", e)
         return JsonResponse({"error": str(e)}, status=400)
     
 @csrf_exempt
-def update_all_notes(request):
-    if request.method == 'PUT':
-        try:
-            data = json.loads(request.body)
-            context_identifier = data.get("context", None)
-            notes = data.get("notes", [])
+@api_login_required
+@replica_reads
+def get_notes_batch(request):
+    """
+    Fetches the notes of several contexts at once, e.g. when the browser restores
+    many tabs. Contexts are passed as repeated ?context= params or as a JSON body
+    {"contexts": [...]} on POST. Returns {"contexts": {context: notes},
+    "requested": {identifier: context}}, keyed by canonical identifiers like
+    every other response; `requested` maps each identifier as it was sent to
+    the canonical one.
+    """
+    try:
+        if request.method == 'POST':
+            context_identifiers = loads(request.body).get("contexts", [])
+        else:
+            context_identifiers = request.GET.getlist('context')
 
-            print(f"📝 Received update request for context '{context_identifier}': {notes}")
+        if not isinstance(context_identifiers, list) or not context_identifiers:
+            return JsonResponse({"error": "At least one context is required"}, status=400)
+        context_identifiers = list(dict.fromkeys(context_identifiers))
+        if len(context_identifiers) > NOTES_BATCH_MAX_CONTEXTS:
+            return JsonResponse(
+                {"error": f"At most {NOTES_BATCH_MAX_CONTEXTS} contexts can be fetched at once"},
+                status=400,
+            )
 
-            if not context_identifier:
-                return JsonResponse({"error": "Context is required."}, status=400)
+        flush_buffered_notes(request.user)
+        requested = {identifier: canonical_identifier(identifier) for identifier in context_identifiers}
+        notes_by_context = {identifier: [] for identifier in requested.values()}
+        annotations = (
+            Annotation.objects.filter(user=request.user, context__identifier__in=list(notes_by_context))
+            .order_by('context', 'order')
+            .values_list(*NOTE_FIELDS, 'context__identifier')
+        )
+        for *row, identifier in annotations:
+            notes_by_context[identifier].append(serialize_note(*row, identifier))
+        return ApiResponse({"contexts": notes_by_context, "requested": requested}, request)
+    except Exception as e:
+        logger.warning("Error fetching notes: %s", e)
+        return JsonResponse({"error": str(e)}, status=400)
+    
+@csrf_exempt
+@api_login_required
+@require_http_methods(['PUT'])
+async def update_all_notes(request):
+    try:
+        try:
+            data = loads(request.body)
+        except json.JSONDecodeError:
+            data = None
+        if not isinstance(data, dict):
+            return JsonResponse({"error": "The request body must be a JSON object."}, status=400)
+        context_identifier = canonical_identifier(data.get("context", None))
+        # The change number of the last deletion the client has seen, as returned
+        # in `cursor`; /api/changes and /api/tombstones cursors work as well
+        since = data.get("since")
+        if since is not None and (not isinstance(since, int) or isinstance(since, bool)):
+            return JsonResponse({"error": "since must be an integer"}, status=400)
+        try:
+            version = expected_version(request, data)
+            # Parsed and sanitized once here; the buffer and sync reuse the result
+            incoming = normalize_notes(data.get("notes", []))
+        except (InvalidNotes, ValueError) as e:
+            return JsonResponse({"error": str(e)}, status=400)
 
-            # Get or create the AnnotationContext object
-            annotation_context, created = AnnotationContext.objects.get_or_create(
-                identifier=context_identifier
-            )
+        logger.debug("Received update request for context %r with %d notes", context_identifier, len(incoming))
 
-            if not notes or all(is_empty_html(note) for note in notes):
-                print(f"❌ Deleted context '{context_identifier}' due to empty notes from update.")
-                Annotation.objects.filter(context=annotation_context).delete()
-                annotation_context.delete()
-                return JsonResponse({"status": f"Context '{context_identifier}' deleted due to empty notes."})
+        if not context_identifier or not isinstance(context_identifier, str):
+            return JsonResponse({"error": "Context is required."}, status=400)
 
-            # ✅ Prevent duplication: Clear existing notes before saving
-            print(f"🔄 Clearing old notes for context '{context_identifier}'...")
-            Annotation.objects.filter(context=annotation_context).delete()
+        buffer = get_write_behind()
+        # A context whose text notes were all cleared is dropped, unless it
+        # still holds image or drawing notes.
+        if not incoming and not await (
+            Annotation.objects.filter(
+                user=request.user,
+                context__identifier=context_identifier,
+                annotation_type__in=Annotation.MEDIA_TYPES,
+            ).aexists()
+        ):
+            if buffer is not None:
+                await sync_to_async(buffer.discard)(request.user.pk, context_identifier)
+            deleted = await sync_to_async(soft_delete_context)(request.user, context_identifier, version)
+            if not deleted and version is not None and await AnnotationContext.objects.filter(
+                user=request.user, identifier=context_identifier
+            ).aexists():
+                raise VersionConflict(f"The context is no longer at version {version}.")
+            logger.info("Deleted context %r due to empty notes from update", context_identifier)
+            await ainvalidate_notes(request.user.pk, context_identifier)
+            await aemit(request.user.pk, context_identifier, "context.deleted")
+            response = {"status": f"Context '{context_identifier}' deleted due to empty notes."}
+            if since is not None:
+                response["cursor"] = await sync_to_async(current_seq)(request.user.pk)
+            return JsonResponse(response)
 
-            # Save new notes with correct order
-            for idx, content in enumerate(notes):
-                content = content.strip()
-                if content:
-                    Annotation.objects.create(
-                        content=unescape(content),  # Decode HTML entities before saving
-                        context=annotation_context,
-                        order=idx
-                    )
+        if buffer is not None and version is None and buffer.put(request.user.pk, context_identifier, incoming):
+            status = 202
+            response = {
+                "status": "accepted",
+                "message": f"Notes for context '{context_identifier}' will be saved shortly.",
+            }
+        else:
+            if buffer is not None and buffer.pending_notes(request.user.pk, context_identifier) is not None:
+                # An older buffered autosave must not overwrite this one later
+                await sync_to_async(buffer.discard)(request.user.pk, context_identifier)
 
-            print(f"✅ Notes updated successfully for context '{context_identifier}'")
-            return JsonResponse({"status": "success", "message": f"Notes updated for context '{context_identifier}'."})
-        except Exception as e:
-            print(f"⛔️ Error saving notes: {str(e)}")
-            return JsonResponse({"error": str(e)}, status=500)
-        
+            # Only write the notes that were added, edited, moved or removed. The
+            # diff needs a transaction, which the async ORM cannot open yet.
+            changes, version = await sync_to_async(sync_context_notes)(
+                request.user, context_identifier, incoming, version
+            )
+            await ainvalidate_notes(request.user.pk, context_identifier)
+            await aemit(request.user.pk, context_identifier, "notes.updated", changes=changes)
+
+            logger.debug("Notes updated for context %r: %s", context_identifier, changes)
+            status = 200
+            response = {
+                "status": "success",
+                "message": f"Notes updated for context '{context_identifier}'.",
+                "changes": changes,
+                "version": version,
+            }
+        if since is not None:
+            # Deletions in this context the client has not seen yet, e.g. made on another device
+            tombstones = await sync_to_async(tombstones_since)(request.user, since, context_identifier)
+            response["tombstones"] = tombstones["notes"]
+            response["cursor"] = tombstones["cursor"]
+            try:
+                await sync_to_async(check_cursor)(request.user.pk, since)
+            except CursorExpired:
+                # The save went through, but the client must reload to drop purged notes
+                response["resync"] = True
+        return ApiResponse(response, request, status=status)
+    except VersionConflict as e:
+        # Fail fast with the current state rather than waiting on the other save
+        current_notes, current_version = await context_notes(request.user, context_identifier)
+        return ApiResponse(
+            {"error": str(e), "version": current_version, "notes": current_notes}, request, status=409
+        )
+    except Exception as e:
+        logger.exception("Error saving notes")
+        return JsonResponse({"error": str(e)}, status=500)
+    
 @csrf_exempt
+@api_login_required
 def save_all_notes(request):
     if request.method == 'POST':
         try:
-            data = json.loads(request.body)
-            notes = data.get("notes", [])
-            context_identifier = data.get("context", None)
+            data = loads(request.body)
+            if not isinstance(data, dict):
+                return JsonResponse({"error": "The request body must be a JSON object."}, status=400)
+            context_identifier = canonical_identifier(data.get("context", None))
 
-            if not context_identifier:
+            if not context_identifier or not isinstance(context_identifier, str):
                 return JsonResponse({"error": "Context is required"}, status=400)
+            # Validated before the old notes are cleared
+            incoming = normalize_notes(data.get("notes", []))
 
             # Get the related AnnotationContext object
-            annotation_context = AnnotationContext.objects.filter(identifier=context_identifier).first()
+            annotation_context = AnnotationContext.objects.filter(
+                user=request.user, identifier=context_identifier
+            ).first()
             if not annotation_context:
                 return JsonResponse({"error": f"Context '{context_identifier}' not found"}, status=404)
 
-            # Clear existing notes for the context
-            Annotation.objects.filter(context=annotation_context).delete()
+            buffer = get_write_behind()
+            if buffer is not None:
+                buffer.discard(request.user.pk, context_identifier)
+            with transaction.atomic():
+                change_seq = ChangeCounter.next_seq(request.user.pk)
+                # Clear existing notes for the context
+                Annotation.objects.filter(context=annotation_context).update(
+                    deleted_at=timezone.now(), change_seq=change_seq
+                )
+                AnnotationContext.objects.filter(id=annotation_context.id).update(version=F('version') + 1)
 
-            # Create new notes
-            for content in notes:
-                if content.strip():  # Avoid saving empty notes
-                    Annotation.objects.create(content=content, context=annotation_context)
+                # Create new notes, leaving out empty ones
+                created = [
+                    Annotation.objects.create(
+                        content=note.content,
+                        content_hash=note.content_hash,
+                        context=annotation_context,
+                        user=request.user,
+                        order=note.order,
+                        change_seq=change_seq,
+                    )
+                    for note in incoming
+                ]
+                index_annotations(created, texts=[note.text for note in incoming])
+            invalidate_notes(request.user.pk, context_identifier)
+            emit(request.user.pk, context_identifier, "notes.updated")
 
             return JsonResponse({"status": "success"})
         except Exception as e:
             return JsonResponse({"error": str(e)}, status=400)
         
-@csrf_exempt
-def get_all_notes(request):
-    try:
-        contexts = AnnotationContext.objects.all()
-        all_notes = []
-        for context in contexts:
-            annotations = Annotation.objects.filter(context=context).order_by('order')
-            notes = [
+def iter_all_notes(user, after=None, limit=None, where=None):
+    """
+    Yields every context of `user` (or those matching the Q `where`) with its
+    ordered notes, keyset-paginated on context id (the user's (user, id) index
+    serves the scan).
+
+    Notes are loaded with one prefetch query per chunk of contexts instead of
+    one query per context, and contexts are read with a server-side iterator so
+    memory stays bounded by the chunk size.
+    """
+    contexts = AnnotationContext.objects.filter(user=user).order_by('id').prefetch_related(
+        Prefetch(
+            'annotation',
+            queryset=Annotation.objects.order_by('order').only('id', 'content', 'order', 'context_id'),
+        )
+    )
+    if where is not None:
+        contexts = contexts.filter(where)
+    if after is not None:
+        contexts = contexts.filter(id__gt=after)
+    if limit is not None:
+        contexts = contexts[:limit]
+
+    for context in contexts.iterator(chunk_size=ALL_NOTES_CHUNK_SIZE):
+        yield context.id, {
+            "context": context.identifier,
+            "notes": [
                 {
                     "id": annotation.id,
-                    "content": annotation.content.strip(),
+                    "content": (annotation.content or "").strip(),
                     "order": annotation.order,
                 }
-                for annotation in annotations
-            ]
-            all_notes.append({
-                "context": context.identifier,
-                "notes": notes,
-            })
-        return JsonResponse(all_notes, safe=False)
+                for annotation in context.annotation.all()
+            ],
+        }
+
+async def aiter_all_notes(user, after=None, limit=None, where=None):
+    """
+    iter_all_notes for streaming under ASGI. Each keyset page of
+    ALL_NOTES_CHUNK_SIZE contexts is read in one sync_to_async call, so the
+    listing is never held in memory and no cursor stays open between pages.
+    """
+    while limit is None or limit > 0:
+        size = ALL_NOTES_CHUNK_SIZE if limit is None else min(limit, ALL_NOTES_CHUNK_SIZE)
+        page = await sync_to_async(list)(iter_all_notes(user, after, size, where))
+        for item in page:
+            yield item
+        if len(page) < size:
+            return
+        after = page[-1][0]
+        if limit is not None:
+            limit -= size
+
+def served_async(request):
+    """
+    Whether `request` came through the ASGI handler. It only streams async
+    iterators: a sync one is read to the end before the first byte is sent.
+    """
+    return isinstance(request, ASGIRequest)
+
+def page_params(request):
+    """The `after` cursor and `limit` of a listing paginated like get_all_notes. Raises ValueError."""
+    try:
+        after = request.GET.get('after')
+        after = int(after) if after else None
+        limit = request.GET.get('limit')
+        limit = min(int(limit), ALL_NOTES_MAX_PAGE_SIZE) if limit else None
+    except ValueError:
+        raise ValueError("after and limit must be integers")
+    if limit is not None and limit <= 0:
+        raise ValueError("limit must be positive")
+    return after, limit
+
+def stream_json_array(items):
+    yield b'['
+    for idx, item in enumerate(items):
+        yield (b',' if idx else b'') + dumps(item)
+    yield b']'
+
+async def astream_json_array(items):
+    yield b'['
+    first = True
+    async for item in items:
+        yield (b'' if first else b',') + dumps(item)
+        first = False
+    yield b']'
+
+@csrf_exempt
+@api_login_required
+@replica_reads
+def get_all_notes(request):
+    """
+    Optional query params:
+    - after: only return contexts with an id greater than this cursor
+    - limit: page size (capped at ALL_NOTES_MAX_PAGE_SIZE); when the page is
+      full the next cursor is returned in the X-Next-Cursor header
+    - stream=1: write the JSON array incrementally instead of building it in
+      memory; under ASGI from an async iterator, see served_async
+    """
+    try:
+        after, limit = page_params(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    try:
+        flush_buffered_notes(request.user)
+        if request.GET.get('stream') in ('1', 'true'):
+            if served_async(request):
+                items = (item async for _, item in aiter_all_notes(request.user, after, limit))
+                chunks = astream_json_array(items)
+            else:
+                chunks = stream_json_array(item for _, item in iter_all_notes(request.user, after, limit))
+            return StreamingHttpResponse(chunks, content_type='application/json')
+
+        all_notes = []
+        last_id = None
+        for last_id, item in iter_all_notes(request.user, after, limit):
+            all_notes.append(item)
+        response = ApiResponse(all_notes, request)
+        if limit is not None and len(all_notes) == limit:
+            response['X-Next-Cursor'] = str(last_id)
+        return response
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=400)
-    
+
 @csrf_exempt
-def delete_note(request):
+@api_login_required
+@replica_reads
+def get_site_notes(request):
+    """
+    Notes on the site of the page `context`, e.g. for a "notes on this site"
+    panel. Same items, pagination (`after`, `limit`, X-Next-Cursor) and
+    ordering as get_all_notes.
+
+    Optional query param `scope`:
+    - site (default): every page of the page's registrable domain, subdomains included
+    - host: every page of the page's host
+    - path: the page and the pages below its path on the same host
+    Served by the (user, site, host, path) index, see annotations.identifiers.
+    """
+    try:
+        after, limit = page_params(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    context_identifier = request.GET.get('context')
+    if not context_identifier:
+        return JsonResponse({"error": "Context is required"}, status=400)
+    try:
+        where = site_query(context_identifier, request.GET.get('scope') or SITE_SCOPES[0])
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    try:
+        flush_buffered_notes(request.user)
+        site_notes = []
+        last_id = None
+        for last_id, item in iter_all_notes(request.user, after, limit, where):
+            site_notes.append(item)
+        response = ApiResponse(site_notes, request)
+        if limit is not None and len(site_notes) == limit:
+            response['X-Next-Cursor'] = str(last_id)
+        return response
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+@api_login_required
+def export_notes(request):
+    """
+    Streams all of the user's contexts and notes as an NDJSON archive, one
+    context per line (see annotations.archive). With gzip=1 the archive itself
+    is gzipped, ready to be saved as a .ndjson.gz file; otherwise the response
+    is only compressed in transit. Under ASGI the lines come from an async
+    iterator, see served_async.
+    """
+    if request.method != 'GET':
+        return JsonResponse({"error": "Invalid HTTP method. Use GET."}, status=405)
+    flush_buffered_notes(request.user)
+    if served_async(request):
+        lines, gzipped = aexport_archive(request.user), agzip_lines
+    else:
+        lines, gzipped = export_archive(request.user), gzip_lines
+    if request.GET.get('gzip') in ('1', 'true'):
+        response = StreamingHttpResponse(gzipped(lines), content_type='application/gzip')
+        response['Content-Disposition'] = 'attachment; filename="notes.ndjson.gz"'
+    else:
+        response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+    return response
+
+@csrf_exempt
+@api_login_required
+def import_notes(request):
+    """
+    Imports an NDJSON archive from the request body, read as a stream so its
+    size is not limited by DATA_UPLOAD_MAX_MEMORY_SIZE. Send gzipped archives
+    with `Content-Encoding: gzip` or `Content-Type: application/gzip`.
+    Contexts the user already has get the archive's notes, unless
+    skip_existing=1. The archive is written in batches: on a 400 for a bad
+    line the batches before it stay imported, and the fixed archive can
+    simply be sent again.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "Invalid HTTP method. Use POST."}, status=405)
+    gzipped = (
+        request.headers.get('Content-Encoding', '').lower() == 'gzip'
+        or request.content_type == 'application/gzip'
+    )
+    try:
+        flush_buffered_notes(request.user)
+        contexts, notes = import_archive(
+            request.user,
+            gzip.GzipFile(fileobj=request, mode='rb') if gzipped else request,
+            skip_existing=request.GET.get('skip_existing') in ('1', 'true'),
+        )
+    except ArchiveError as e:
+        return JsonResponse({"error": str(e), "line": e.line_number}, status=400)
+    except (OSError, EOFError) as e:
+        # A truncated or corrupt gzip stream
+        return JsonResponse({"error": f"Could not read the archive: {e}"}, status=400)
+    return JsonResponse({"status": "success", "contexts": contexts, "notes": notes})
+
+@csrf_exempt
+@api_login_required
+async def delete_note(request):
     if request.method == 'DELETE':
         try:
-            data = json.loads(request.body)
-            print(f"Received DELETE request with noteId: {data.get('noteId')}")
-            
+            data = loads(request.body)
             note_id = data.get('noteId')
 
             if not note_id:
                 return JsonResponse({"error": "Note ID is required."}, status=400)
 
-            # Fetch and delete the note
-            note = Annotation.objects.get(id=note_id)
-            note.delete()
+            if get_write_behind() is not None:
+                # A buffered autosave would bring the note back
+                await sync_to_async(flush_buffered_notes)(request.user)
+            # Tombstone the note; it is purged later
+            context_identifier = await sync_to_async(soft_delete_note)(request.user, note_id)
+            await ainvalidate_notes(request.user.pk, context_identifier)
+            await aemit(request.user.pk, context_identifier, "note.deleted", id=note_id)
             return JsonResponse({"message": "Note deleted successfully."})
         except Annotation.DoesNotExist:
             return JsonResponse({"error": "Note not found."}, status=404)
@@ -158,20 +635,23 @@ def delete_note(request):
         return JsonResponse({"error": "Invalid HTTP method."}, status=405)
     
 @csrf_exempt
-def delete_context(request):
+@api_login_required
+async def delete_context(request):
     if request.method == 'DELETE':
         try:
-            data = json.loads(request.body.decode("utf-8"))
-            context_identifier = data.get("context", None)
-            existing = AnnotationContext.objects.values_list('identifier', flat=True)
+            data = loads(request.body.decode("utf-8"))
+            context_identifier = canonical_identifier(data.get("context", None))
             if not context_identifier:
                 return JsonResponse({"error": "Context is required."}, status=400)
 
-            # Find and delete the context
-            annotation_context = AnnotationContext.objects.filter(identifier=context_identifier).first()
-            if annotation_context:
-                annotation_context.delete()
-                print(f"🗑 Context '{context_identifier}' has been deleted.")
+            buffer = get_write_behind()
+            if buffer is not None:
+                await sync_to_async(buffer.discard)(request.user.pk, context_identifier)
+            # Tombstone the context; its notes are hidden with it and purged later
+            if await sync_to_async(soft_delete_context)(request.user, context_identifier):
+                await ainvalidate_notes(request.user.pk, context_identifier)
+                await aemit(request.user.pk, context_identifier, "context.deleted")
+                logger.info("Context %r has been deleted", context_identifier)
                 return JsonResponse({"message": f"Context '{context_identifier}' deleted successfully."})
             else:
                 return JsonResponse({"status": "noop", "message": f"Context '{context_identifier}' did not exist."})
@@ -181,17 +661,338 @@ def delete_context(request):
         return JsonResponse({"error": "Invalid HTTP method. Use DELETE."}, status=405)
     
 @csrf_exempt
-def get_page_title(request):
+@api_login_required
+def upload_image(request):
+    """
+    Adds an image note to a context. Multipart POST with `context`, an optional
+    `order` and the file in `image`. The upload is spooled to a temporary file
+    rather than memory, and thumbnails are generated in the background; until
+    then get_notes only returns the original's URL.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "Invalid HTTP method. Use POST."}, status=405)
+
+    request.upload_handlers = [TemporaryFileUploadHandler(request)]
+    try:
+        context_identifier = canonical_identifier(request.POST.get('context'))
+        uploaded = request.FILES.get('image')
+        if not context_identifier or uploaded is None:
+            return JsonResponse({"error": "Context and image are required."}, status=400)
+
+        order = request.POST.get('order')
+        try:
+            order = None if order is None else int(order)
+        except ValueError:
+            return JsonResponse({"error": "order must be an integer"}, status=400)
+
+        name, content_hash = store_upload(uploaded)
+        with transaction.atomic():
+            annotation_context, _ = AnnotationContext.objects.get_or_create_live(request.user, context_identifier)
+            if order is None:
+                order = next_order(annotation_context)
+            annotation = Annotation(
+                annotation_type='IMG',
+                context=annotation_context,
+                user=request.user,
+                order=order,
+                image_hash=content_hash,
+                change_seq=ChangeCounter.next_seq(request.user.pk),
+            )
+            annotation.image.name = name
+            annotation.save()
+            enqueue_variants(annotation.id)
+        invalidate_notes(request.user.pk, context_identifier)
+        emit(request.user.pk, context_identifier, "notes.updated")
+        return JsonResponse(serialize_note(annotation.id, "", 'IMG', name, {}, context_identifier), status=201)
+    except InvalidImage as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except Exception as e:
+        logger.exception("Error uploading image")
+        return JsonResponse({"error": str(e)}, status=500)
+
+def serve_image(request, path):
+    """
+    Serves files of the local image storage. Names are content hashes, so a
+    name never changes content and responses can be cached indefinitely.
+    """
+    storage = annotation_image_storage()
+    try:
+        response = FileResponse(storage.open(path, 'rb'))
+    except (OSError, SuspiciousFileOperation):
+        raise Http404
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+PACKED_DRAWING_TYPE = 'application/octet-stream'
+
+def read_drawing(request):
+    """
+    Returns (packed strokes, JSON fields) from a drawing request. The body is
+    either the packed form, with `context` and `order` in the query string, or
+    JSON with `strokes` as point lists and optional `scale` and `tolerance`.
+    """
+    if request.content_type == PACKED_DRAWING_TYPE:
+        packed = request.body
+        decode_drawing(packed)  # Validates
+        return packed, {key: request.GET[key] for key in ('context', 'order') if key in request.GET}
+
+    data = loads(request.body)
+    if not isinstance(data, dict) or 'strokes' not in data:
+        raise InvalidDrawing("strokes is required")
+    options = {key: data[key] for key in ('scale', 'tolerance') if data.get(key) is not None}
+    return encode_drawing(data['strokes'], **options), data
+
+def drawing_response(request, annotation):
+    if PACKED_DRAWING_TYPE in request.headers.get('Accept', ''):
+        return HttpResponse(bytes(annotation.strokes or b''), content_type=PACKED_DRAWING_TYPE)
+    return JsonResponse({
+        "id": annotation.id,
+        "context": annotation.context.identifier,
+        "strokes": decode_drawing(annotation.strokes) if annotation.strokes else [],
+        "position": annotation.position,
+        "metadata": annotation.metadata,
+    })
+
+@csrf_exempt
+@api_login_required
+def save_drawing(request):
+    """
+    Adds a drawing note to a context; see read_drawing for the accepted
+    bodies. `context` is required, `order`, `position` and `metadata` (e.g.
+    stroke colors and widths) are optional.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "Invalid HTTP method. Use POST."}, status=405)
+    try:
+        packed, data = read_drawing(request)
+        context_identifier = canonical_identifier(data.get('context'))
+        if not context_identifier:
+            return JsonResponse({"error": "Context is required."}, status=400)
+        order = data.get('order')
+        try:
+            order = None if order is None else int(order)
+        except (TypeError, ValueError):
+            return JsonResponse({"error": "order must be an integer"}, status=400)
+
+        with transaction.atomic():
+            annotation_context, _ = AnnotationContext.objects.get_or_create_live(request.user, context_identifier)
+            annotation = Annotation.objects.create(
+                annotation_type='DRAW',
+                context=annotation_context,
+                user=request.user,
+                order=next_order(annotation_context) if order is None else order,
+                strokes=packed,
+                position=data.get('position'),
+                metadata=data.get('metadata'),
+                change_seq=ChangeCounter.next_seq(request.user.pk),
+            )
+        invalidate_notes(request.user.pk, context_identifier)
+        emit(request.user.pk, context_identifier, "notes.updated")
+        return JsonResponse({
+            "id": annotation.id,
+            "context": context_identifier,
+            "drawing": reverse('drawing', args=[annotation.id]),
+            "bytes": len(packed),
+        }, status=201)
+    except (InvalidDrawing, json.JSONDecodeError) as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except Exception as e:
+        logger.exception("Error saving drawing")
+        return JsonResponse({"error": str(e)}, status=500)
+
+@csrf_exempt
+@api_login_required
+def drawing(request, note_id):
+    """
+    GET returns a drawing as JSON, or packed when the Accept header asks for
+    application/octet-stream. PUT replaces its strokes, same bodies as save_drawing.
+    """
+    try:
+        annotation = Annotation.objects.select_related('context').get(
+            id=note_id, user=request.user, annotation_type='DRAW'
+        )
+    except Annotation.DoesNotExist:
+        return JsonResponse({"error": "Drawing not found."}, status=404)
+
+    if request.method == 'GET':
+        return drawing_response(request, annotation)
+    if request.method != 'PUT':
+        return JsonResponse({"error": "Invalid HTTP method. Use GET or PUT."}, status=405)
+
+    try:
+        annotation.strokes, data = read_drawing(request)
+        fields = ['strokes', 'updated_at', 'change_seq']
+        for field in ('position', 'metadata'):
+            if field in data:
+                setattr(annotation, field, data[field])
+                fields.append(field)
+        with transaction.atomic():
+            annotation.change_seq = ChangeCounter.next_seq(request.user.pk)
+            annotation.save(update_fields=fields)
+    except (InvalidDrawing, json.JSONDecodeError) as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    identifier = annotation.context.identifier
+    invalidate_notes(request.user.pk, identifier)
+    emit(request.user.pk, identifier, "notes.updated")
+    return JsonResponse({"id": annotation.id, "context": identifier, "bytes": len(annotation.strokes)})
+
+@csrf_exempt
+@api_login_required
+def search(request):
+    """
+    Ranked full-text search over note content. Every word of ?q= must match,
+    as a whole word or a prefix. Paginated with ?page= and ?page_size=.
+    """
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({"error": "Query is required"}, status=400)
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        page_size = min(max(int(request.GET.get('page_size', 20)), 1), SEARCH_MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({"error": "page and page_size must be integers"}, status=400)
+
+    try:
+        flush_buffered_notes(request.user)
+        # Fetch one extra row to know whether there is a next page
+        rows = search_notes(request.user, query, offset=(page - 1) * page_size, limit=page_size + 1)
+        results = [
+            {
+                "id": note_id,
+                "content": (content or "").strip(),
+                "context": identifier,
+                "rank": rank,
+            }
+            for note_id, content, identifier, rank in rows[:page_size]
+        ]
+        return ApiResponse({
+            "results": results,
+            "page": page,
+            "next_page": page + 1 if len(rows) > page_size else None,
+        }, request)
+    except Exception as e:
+        logger.warning("Error searching notes: %s", e)
+        return JsonResponse({"error": str(e)}, status=400)
+
+@api_login_required
+def get_changes(request):
+    """
+    Notes and contexts changed after the `since` cursor (omit it for a full
+    sync), deletions included as `"deleted": true`. Pass the returned `cursor`
+    as `since` next time; while `more` is true there are further pages.
+    Optional `limit` caps the notes per page (CHANGES_MAX_PAGE_SIZE at most).
+    A cursor older than the purge horizon gets a 410 with `"resync": true`.
+    """
+    try:
+        since = int(request.GET.get('since', -1))
+        limit = min(int(request.GET.get('limit', CHANGES_DEFAULT_PAGE_SIZE)), CHANGES_MAX_PAGE_SIZE)
+        if limit <= 0:
+            return JsonResponse({"error": "limit must be positive"}, status=400)
+    except ValueError:
+        return JsonResponse({"error": "since and limit must be integers"}, status=400)
+
+    flush_buffered_notes(request.user)
+    notes, contexts, cursor, more = changes_since(request.user, since, limit)
+    if since >= 0:
+        try:
+            check_cursor(request.user.pk, since)
+        except CursorExpired as e:
+            return JsonResponse({"error": str(e), "resync": True}, status=410)
+    return ApiResponse({
+        "contexts": [
+            {"context": identifier, "deleted": True} if deleted_at else {"context": identifier, "title": title}
+            for identifier, title, deleted_at in contexts
+        ],
+        "notes": [
+            {"id": note_id, "context": identifier, "deleted": True} if deleted_at else {
+                **serialize_note(note_id, content, annotation_type, image, image_variants, identifier),
+                "order": order,
+            }
+            for note_id, content, annotation_type, image, image_variants, identifier, order, deleted_at, _ in notes
+        ],
+        "cursor": cursor,
+        "more": more,
+    }, request)
+
+@api_login_required
+def get_tombstones(request):
+    """
+    Notes and contexts deleted after the `since` cursor, optionally for one
+    `context`, so offline clients can drop them. Pass the returned `cursor` as
+    `since` next time; cursors of /api/changes are accepted as well. Without
+    `since` all retained tombstones are listed; a cursor older than the purge
+    horizon gets a 410 with `"resync": true`.
+    """
+    try:
+        since = int(request.GET.get('since', -1))
+    except ValueError:
+        return JsonResponse({"error": "since must be an integer"}, status=400)
+    flush_buffered_notes(request.user)
+    tombstones = tombstones_since(request.user, since, canonical_identifier(request.GET.get('context')))
+    if since >= 0:
+        try:
+            check_cursor(request.user.pk, since)
+        except CursorExpired as e:
+            return JsonResponse({"error": str(e), "resync": True}, status=410)
+    return ApiResponse(tombstones, request)
+
+@api_login_required
+async def note_events(request):
+    """
+    Server-Sent Events stream of changes to the contexts given as repeated
+    ?context= params. Events are `notes.updated`, `note.deleted` and
+    `context.deleted`. Their `context` is the canonical identifier, and
+    `requested` lists the identifiers subscribed to that map to it. Must be
+    served through the ASGI application; under WSGI every open stream would
+    hold a worker.
+    """
+    context_identifiers = list(dict.fromkeys(request.GET.getlist('context')))
+    if not context_identifiers:
+        return JsonResponse({"error": "At least one context is required"}, status=400)
+    if len(context_identifiers) > EVENTS_MAX_CONTEXTS:
+        return JsonResponse(
+            {"error": f"At most {EVENTS_MAX_CONTEXTS} contexts can be subscribed to at once"},
+            status=400,
+        )
+
+    subscribed = {}
+    for identifier in context_identifiers:
+        subscribed.setdefault(canonical_identifier(identifier), []).append(identifier)
+
+    async def stream():
+        yield ': connected\n\n'
+        keys = [event_key(request.user.pk, identifier) for identifier in subscribed]
+        async for event in get_broker().subscribe(keys, timeout=EVENTS_KEEPALIVE_SECONDS):
+            if event is None:
+                yield ': keepalive\n\n'
+            else:
+                event = {**event, "requested": subscribed.get(event["context"], [])}
+                yield f"event: {event['type']}\ndata: {dumps(event).decode()}\n\n"
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@csrf_exempt
+@api_login_required
+async def get_page_title(request):
     url = request.GET.get('context', None)
 
     if not url:
         return JsonResponse({"error": "No URL provided"}, status=400)
 
     try:
-        response = requests.get(url, timeout=5)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        title = soup.title.string.strip() if soup.title else "Untitled Page"
-
-        return JsonResponse({"title": title})
-    except Exception as e:
+        title = await resolve_title(request.user, canonical_identifier(url))
+        return JsonResponse({"title": title or "Untitled Page"})
+    except TitleUnavailable as e:
         return JsonResponse({"error": f"Could not fetch title: {str(e)}"}, status=400)
+
+@api_login_required
+def metrics(request):
+    """Per-view latency, query and payload-size histograms in Prometheus text format, for staff users only."""
+    if not getattr(settings, 'OVERNOTE_METRICS_ENABLED', False):
+        raise Http404
+    if not request.user.is_staff:
+        return JsonResponse({"error": "Staff access required."}, status=403)
+    return HttpResponse(registry.render_prometheus(), content_type='text/plain; version=0.0.4')
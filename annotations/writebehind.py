@@ -0,0 +1,218 @@
+"""
+Write-behind buffer for update_all_notes autosaves.
+
+Clients autosave on nearly every pause in typing, so most updates are replaced
+by the next one within seconds. With OVERNOTE_WRITE_BEHIND enabled,
+update_all_notes hands its payload to the buffer instead of writing it. Only
+the latest payload per context is kept, and a background thread writes each
+one OVERNOTE_WRITE_BEHIND_WINDOW seconds after the first payload of its
+window arrived, up to OVERNOTE_WRITE_BEHIND_BATCH_SIZE contexts per
+transaction. get_notes answers from the buffer and views that read notes in
+bulk flush the user's payloads first, so users always read their own writes.
+Everything pending is flushed when the process exits.
+
+The buffer lives in the worker process: payloads are lost if it is killed
+without a chance to exit cleanly, and other workers only see them once they
+are flushed. Updates that carry a version precondition are always written
+through, since only their sender can be told about a conflict.
+"""
+import atexit
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections, transaction
+
+from .cache import invalidate_notes
+from .events import emit
+from .instrumentation import registry
+from .replicas import pin_primary
+from .sync import VersionConflict, sync_context_notes
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_WINDOW = getattr(settings, "OVERNOTE_WRITE_BEHIND_WINDOW", 2.0)
+WRITE_BEHIND_BATCH_SIZE = getattr(settings, "OVERNOTE_WRITE_BEHIND_BATCH_SIZE", 100)
+WRITE_BEHIND_MAX_PENDING = getattr(settings, "OVERNOTE_WRITE_BEHIND_MAX_PENDING", 10000)
+
+# Writes that find the context locked by a write-through save are retried this often
+MAX_ATTEMPTS = 3
+
+
+@dataclass(eq=False)
+class PendingWrite:
+    user_id: int
+    identifier: str
+    notes: list
+    due: float  # time.monotonic() at which it gets written
+    attempts: int = 0
+    # The payload a flush is currently writing, if any
+    writing: list = field(default=None, repr=False)
+
+
+class WriteBehindBuffer:
+    def __init__(
+        self, window=WRITE_BEHIND_WINDOW, batch_size=WRITE_BEHIND_BATCH_SIZE, max_pending=WRITE_BEHIND_MAX_PENDING
+    ):
+        self.window = window
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        # Held while payloads are written, so discard() can wait for a write in flight
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def put(self, user_id, identifier, notes):
+        """
+        Buffers `notes`, normalize_notes() output, as the latest payload for
+        the context. Returns False when the buffer is full or closed; the
+        caller must then write through.
+        """
+        key = (user_id, identifier)
+        with self._lock:
+            if self._stop.is_set():
+                return False
+            entry = self._pending.get(key)
+            if entry is None:
+                if len(self._pending) >= self.max_pending:
+                    return False
+                # The window starts with the first payload, so a context that is
+                # edited non-stop is still written every `window` seconds.
+                self._pending[key] = PendingWrite(user_id, identifier, notes, time.monotonic() + self.window)
+            else:
+                if entry.notes is not entry.writing:
+                    registry.increment("overnote_write_behind_coalesced_total")
+                entry.notes = notes
+                entry.attempts = 0
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="overnote-write-behind", daemon=True)
+                self._thread.start()
+        registry.increment("overnote_write_behind_buffered_total")
+        return True
+
+    def pending_notes(self, user_id, identifier):
+        """The latest buffered payload for the context, or None."""
+        with self._lock:
+            entry = self._pending.get((user_id, identifier))
+            return None if entry is None else entry.notes
+
+    def discard(self, user_id, identifier):
+        """
+        Drops the buffered payload for the context, e.g. before it is deleted
+        or overwritten directly. Waits for a write of it already in flight.
+        """
+        key = (user_id, identifier)
+        with self._lock:
+            if key not in self._pending:
+                return
+        with self._flush_lock, self._lock:
+            entry = self._pending.pop(key, None)
+        if entry is not None:
+            registry.increment("overnote_write_behind_coalesced_total")
+
+    def flush(self, force=False, user_id=None):
+        """
+        Writes the payloads that are due, all of them with `force`, or all of
+        `user_id`'s. Returns how many were written.
+        """
+        with self._lock:
+            if not self._pending or (
+                user_id is not None and not any(entry.user_id == user_id for entry in self._pending.values())
+            ):
+                return 0
+        with self._flush_lock:
+            now = time.monotonic()
+            with self._lock:
+                batch = [
+                    entry
+                    for entry in self._pending.values()
+                    if force or entry.due <= now or entry.user_id == user_id
+                ]
+                for entry in batch:
+                    entry.writing = entry.notes
+            written = 0
+            for start in range(0, len(batch), self.batch_size):
+                written += self._write_batch(batch[start:start + self.batch_size])
+            return written
+
+    def _write_batch(self, entries):
+        users = get_user_model().objects.in_bulk({entry.user_id for entry in entries})
+        written, retry = [], []
+        with transaction.atomic():
+            for entry in entries:
+                user = users.get(entry.user_id)
+                if user is None:
+                    continue
+                try:
+                    # Each context syncs in a savepoint, so one failure leaves the rest of the batch
+                    changes, _ = sync_context_notes(user, entry.identifier, entry.writing)
+                    written.append((entry, changes))
+                except VersionConflict:
+                    # A write-through save holds the context right now
+                    retry.append(entry)
+                except Exception:
+                    logger.exception("Could not write buffered notes for context %r", entry.identifier)
+
+        with self._lock:
+            for entry in entries:
+                key = (entry.user_id, entry.identifier)
+                if self._pending.get(key) is not entry or entry.notes is not entry.writing:
+                    # Discarded meanwhile, or a newer payload arrived and is due next
+                    pass
+                elif entry in retry and entry.attempts + 1 < MAX_ATTEMPTS:
+                    entry.attempts += 1
+                else:
+                    if entry in retry:
+                        logger.error(
+                            "Dropped buffered notes for context %r after %d attempts", entry.identifier, MAX_ATTEMPTS
+                        )
+                    del self._pending[key]
+                entry.writing = None
+
+        for entry, changes in written:
+            pin_primary(entry.user_id)
+            invalidate_notes(entry.user_id, entry.identifier)
+            emit(entry.user_id, entry.identifier, "notes.updated", changes=changes)
+        registry.increment("overnote_write_behind_written_total", len(written))
+        return len(written)
+
+    def _run(self):
+        tick = max(self.window / 4, 0.05)
+        while not self._stop.wait(tick):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Write-behind flush failed")
+            finally:
+                close_old_connections()
+
+    def close(self):
+        """Stops the background thread and writes everything still pending."""
+        with self._lock:
+            self._stop.set()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush(force=True)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_write_behind():
+    """The process's write-behind buffer, or None when OVERNOTE_WRITE_BEHIND is off."""
+    global _buffer
+    if not getattr(settings, "OVERNOTE_WRITE_BEHIND", False):
+        return None
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = WriteBehindBuffer()
+                atexit.register(_buffer.close)
+    return _buffer
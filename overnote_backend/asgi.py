@@ -2,6 +2,9 @@
 ASGI config for overnote_backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve the project through this entry point (e.g. with uvicorn) to use the
+realtime /api/events stream; each open stream is a suspended coroutine rather
+than a blocked worker.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
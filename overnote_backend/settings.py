@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,12 +45,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "annotations.instrumentation.InstrumentationMiddleware",
+    "annotations.compression.CompressionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "annotations.auth.TokenAuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -80,17 +84,159 @@ WSGI_APPLICATION = "overnote_backend.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# Connection details come from the environment (OVERNOTE_DB_NAME, _USER,
+# _PASSWORD, _HOST, _PORT). Connections are kept open for OVERNOTE_DB_CONN_MAX_AGE
+# seconds and checked before reuse, so a request does not pay for a new
+# connection. Alternatively OVERNOTE_DB_POOL=1 uses psycopg's connection pool
+# (OVERNOTE_DB_POOL_MIN_SIZE, _MAX_SIZE, and _TIMEOUT, the seconds a request
+# waits for a free connection); Django does not allow both at once. Pooled
+# connections are checked when handed out and replaced after
+# OVERNOTE_DB_POOL_MAX_LIFETIME seconds.
+#
+# OVERNOTE_DB_REPLICA_HOSTS, a comma-separated list of hosts with the same
+# credentials, adds read replicas that serve get_notes and get_all_notes
+# (see annotations.replicas).
+
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'overnote_db',  # Replace with your database name
-        'USER': 'ericlantz', # Replace with your PostgreSQL username
-        'PASSWORD': 'Matthew!2', # Replace with your PostgreSQL password
-        'HOST': 'localhost',   # Or the hostname of your PostgreSQL server
-        'PORT': '5432',        # Default PostgreSQL port
+    "default": {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": os.environ.get("OVERNOTE_DB_NAME", "overnote_db"),
+        "USER": os.environ.get("OVERNOTE_DB_USER", ""),
+        "PASSWORD": os.environ.get("OVERNOTE_DB_PASSWORD", ""),
+        "HOST": os.environ.get("OVERNOTE_DB_HOST", "localhost"),
+        "PORT": os.environ.get("OVERNOTE_DB_PORT", "5432"),
+        "CONN_MAX_AGE": int(os.environ.get("OVERNOTE_DB_CONN_MAX_AGE", 60)),
+        "CONN_HEALTH_CHECKS": True,
+        "OPTIONS": {},
     }
 }
 
+if os.environ.get("OVERNOTE_DB_POOL") == "1":
+    DATABASES["default"]["CONN_MAX_AGE"] = 0
+    DATABASES["default"]["OPTIONS"]["pool"] = {
+        "min_size": int(os.environ.get("OVERNOTE_DB_POOL_MIN_SIZE", 2)),
+        "max_size": int(os.environ.get("OVERNOTE_DB_POOL_MAX_SIZE", 10)),
+        "timeout": float(os.environ.get("OVERNOTE_DB_POOL_TIMEOUT", 10)),
+        "max_lifetime": float(os.environ.get("OVERNOTE_DB_POOL_MAX_LIFETIME", 1800)),
+    }
+
+OVERNOTE_READ_REPLICAS = []
+replica_hosts = os.environ.get("OVERNOTE_DB_REPLICA_HOSTS", "")
+for replica_host in filter(None, (host.strip() for host in replica_hosts.split(","))):
+    alias = f"replica{len(OVERNOTE_READ_REPLICAS) + 1}"
+    DATABASES[alias] = {
+        **DATABASES["default"],
+        "HOST": replica_host,
+        "OPTIONS": dict(DATABASES["default"]["OPTIONS"]),
+        "TEST": {"MIRROR": "default"},
+    }
+    OVERNOTE_READ_REPLICAS.append(alias)
+
+if OVERNOTE_READ_REPLICAS:
+    DATABASE_ROUTERS = ["annotations.replicas.ReplicaRouter"]
+    MIDDLEWARE.append("annotations.replicas.ReplicaPinMiddleware")
+
+# Seconds a user's reads stay on the primary after they write, to cover replica lag
+OVERNOTE_REPLICA_PIN_SECONDS = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# get_notes keeps serialized responses here. Set OVERNOTE_REDIS_URL in production
+# so every worker shares (and invalidates) the same entries.
+
+if os.environ.get("OVERNOTE_REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["OVERNOTE_REDIS_URL"],
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+OVERNOTE_NOTES_CACHE = "default"
+OVERNOTE_NOTES_CACHE_TIMEOUT = 300
+
+
+# Page titles (annotations.titles)
+
+OVERNOTE_TITLE_TIMEOUT = 5.0
+OVERNOTE_TITLE_MAX_BYTES = 256 * 1024
+OVERNOTE_TITLE_MAX_CONNECTIONS = 100
+OVERNOTE_TITLE_PER_HOST_LIMIT = 4
+OVERNOTE_TITLE_TTL = 7 * 24 * 3600
+OVERNOTE_TITLE_FAILURE_TTL = 15 * 60
+OVERNOTE_TITLE_MAX_REDIRECTS = 5
+# Non-public networks titles may still be fetched from, e.g. ["10.0.0.0/8"] for an intranet
+OVERNOTE_TITLE_ALLOWED_NETWORKS = []
+
+
+# Instrumentation (annotations.instrumentation)
+# Request payloads are only logged when OVERNOTE_LOG_PAYLOADS is on, and then
+# only for a sample of requests. /api/metrics is off unless
+# OVERNOTE_METRICS_ENABLED is set, and then only answers staff users (a
+# scraper authenticates with the API token of a staff account).
+
+OVERNOTE_METRICS_ENABLED = os.environ.get("OVERNOTE_METRICS_ENABLED") == "1"
+OVERNOTE_LOG_PAYLOADS = False
+OVERNOTE_PAYLOAD_LOG_SAMPLE_RATE = 0.01
+
+
+# Response compression (annotations.compression)
+# Brotli is used when the `brotli` package is installed, gzip otherwise.
+
+OVERNOTE_COMPRESS_MIN_BYTES = 1024
+OVERNOTE_GZIP_LEVEL = 6
+OVERNOTE_BROTLI_QUALITY = 5
+
+
+# Deletion (annotations.tombstones)
+# Deleted notes and contexts are kept as tombstones for this long so offline
+# clients can learn about the deletions; `manage.py purge_tombstones` removes them.
+
+OVERNOTE_TOMBSTONE_RETENTION_DAYS = 30
+OVERNOTE_PURGE_BATCH_SIZE = 500
+
+
+# API authentication (annotations.auth)
+# Clients send "Authorization: Bearer <token>"; issue tokens through
+# POST /api/tokens or `manage.py create_api_token`. Token lookups are cached
+# for this many seconds, so a revoked token may work for up to that long
+# unless it is revoked through annotations.auth.revoke_token.
+# Notes saved before accounts existed are assigned to OVERNOTE_LEGACY_OWNER
+# by migration 0011.
+
+OVERNOTE_TOKEN_CACHE_TIMEOUT = 60
+OVERNOTE_LEGACY_OWNER = "legacy"
+
+
+# Autosave write-behind (annotations.writebehind)
+# Off by default. When on, update_all_notes keeps only the latest payload per
+# context for OVERNOTE_WRITE_BEHIND_WINDOW seconds and writes it from a
+# background thread. The buffer is per process: enable it only where losing the
+# last window of autosaves on a hard crash is acceptable.
+
+OVERNOTE_WRITE_BEHIND = os.environ.get("OVERNOTE_WRITE_BEHIND") == "1"
+OVERNOTE_WRITE_BEHIND_WINDOW = 2.0
+OVERNOTE_WRITE_BEHIND_BATCH_SIZE = 100
+OVERNOTE_WRITE_BEHIND_MAX_PENDING = 10000
+
+
+# Realtime push (annotations.events)
+# The in-process broker only reaches clients connected to the same worker.
+
+if os.environ.get("OVERNOTE_REDIS_URL"):
+    OVERNOTE_EVENT_BROKER = "annotations.events.RedisBroker"
+    OVERNOTE_EVENT_BROKER_OPTIONS = {"url": os.environ["OVERNOTE_REDIS_URL"]}
+else:
+    OVERNOTE_EVENT_BROKER = "annotations.events.InProcessBroker"
+    OVERNOTE_EVENT_BROKER_OPTIONS = {}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -128,6 +274,38 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 
+
+# Uploaded files
+# Image annotations live in the "annotation_images" storage (see annotations.images).
+# Point OVERNOTE_IMAGE_STORAGE_BACKEND at an object storage backend in production.
+
+MEDIA_ROOT = Path(os.environ.get("OVERNOTE_MEDIA_ROOT", BASE_DIR / "media"))
+MEDIA_URL = "media/"
+
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
+    },
+    "annotation_images": {
+        "BACKEND": os.environ.get(
+            "OVERNOTE_IMAGE_STORAGE_BACKEND", "django.core.files.storage.FileSystemStorage"
+        ),
+        "OPTIONS": {} if os.environ.get("OVERNOTE_IMAGE_STORAGE_BACKEND") else {
+            "location": MEDIA_ROOT / "annotations",
+            "base_url": "/" + MEDIA_URL + "annotations/",
+        },
+    },
+}
+
+OVERNOTE_IMAGE_STORAGE = "annotation_images"
+OVERNOTE_IMAGE_MAX_BYTES = 20 * 1024 * 1024
+# Threads generating image variants in each web process; set to 0 and run
+# `manage.py process_images` as a separate worker instead.
+OVERNOTE_IMAGE_INLINE_WORKERS = 2
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
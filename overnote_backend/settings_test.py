@@ -0,0 +1,24 @@
+"""
+Settings for running the test and benchmark suites locally without Postgres.
+This runs both; pass annotations.tests or annotations.benchmarks for one.
+
+    python manage.py test annotations --settings=overnote_backend.settings_test
+"""
+
+from .settings import *  # noqa: F401,F403
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / "test.sqlite3",
+    }
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
+OVERNOTE_EVENT_BROKER = "annotations.events.InProcessBroker"
+OVERNOTE_EVENT_BROKER_OPTIONS = {}